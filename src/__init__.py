@@ -1,3 +1,9 @@
-from src.gui.main import launch
-
 __all__ = ['launch']
+
+
+def __getattr__(name):
+    # The GUI is only imported when it's launched, so headless runs don't load it
+    if name == 'launch':
+        from src.gui.main import launch
+        return launch
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
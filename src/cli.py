@@ -0,0 +1,189 @@
+"""
+Runs an agent or workflow without the GUI, for scripts, batch jobs and servers without a display.
+
+    python -m src.cli "Dev Help" -m "How do I reverse a list in python?"
+    cat question.txt | python -m src.cli 99 --format jsonl
+    python -m src.cli "Dev Help" --batch prompts.jsonl --output results.db --concurrency 8
+
+The input is sent as the first member's message, the output of the final member is streamed to stdout.
+In batch mode each row of the JSONL file runs in its own context, results go to a JSONL or SQLite file.
+"""
+import time
+
+START_TIME = time.perf_counter()  # before the slow imports, to measure the startup
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+from typing import Any, Dict, Optional, TextIO
+
+EXIT_OK = 0
+EXIT_ERROR = 1  # the workflow raised an error
+EXIT_USAGE = 2  # bad arguments or no input
+EXIT_NOT_FOUND = 3  # no agent or workflow with that name or id
+EXIT_INTERRUPTED = 130
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m src.cli', description='Run an agent or workflow without the GUI.')
+    parser.add_argument('target', help='The name or id of the agent or workflow')
+    parser.add_argument('-m', '--message', help='The input message, otherwise it is read from --input or stdin')
+    parser.add_argument('-i', '--input', help='A file to read the input message from')
+    parser.add_argument('-f', '--format', choices=('text', 'jsonl'), default='text', help='The output format')
+    parser.add_argument('--db', help='The database file, defaults to the data.db of the application')
+    parser.add_argument('--persist', action='store_true', help='Save the run as a chat')
+    parser.add_argument('--timing', action='store_true', help='Print the startup, first token and total times to stderr')
+    parser.add_argument('--batch', help='A JSONL file of inputs to run one by one instead of a single message')
+    parser.add_argument('--output', help='The batch results file, .db / .sqlite for SQLite, otherwise JSONL (default: <batch>.results.jsonl)')
+    parser.add_argument('--concurrency', type=int, default=4, help='The number of batch rows to run at the same time')
+    return parser
+
+
+def read_input(args) -> str:
+    if args.message is not None:
+        return args.message
+    if args.input:
+        with open(args.input, 'r', encoding='utf-8') as f:
+            return f.read()
+    return sys.stdin.read()
+
+
+def get_entity_config(target: str) -> Optional[Dict[str, Any]]:
+    """Returns the config of the agent or workflow with the id or name `target`"""
+    from src.utils import sql
+    config = None
+    if target.isdigit():
+        config = sql.get_scalar("SELECT config FROM entities WHERE id = ?", (int(target),))
+    if config is None:
+        config = sql.get_scalar("SELECT config FROM entities WHERE name = ?", (target,))
+    return None if config is None else json.loads(config)
+
+
+class OutputWriter:
+    def __init__(self, stream: TextIO, output_format: str = 'text'):
+        self.stream = stream
+        self.output_format = output_format
+        self.first_token_time: Optional[float] = None
+
+    def write_chunk(self, role: str, chunk: str):
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        if self.output_format == 'jsonl':
+            self.write_event({'type': 'chunk', 'role': role, 'content': chunk})
+        else:
+            self.stream.write(chunk)
+            self.stream.flush()
+
+    def write_event(self, event: Dict[str, Any]):
+        if self.output_format != 'jsonl':
+            return
+        self.stream.write(json.dumps(event) + '\n')
+        self.stream.flush()
+
+    def finish(self):
+        if self.output_format == 'text':
+            self.stream.write('\n')
+            self.stream.flush()
+
+
+async def run_workflow(workflow, message: str, writer: OutputWriter):
+    first_member = next(iter(workflow.members.values()), None)
+    if first_member is None:
+        return
+    workflow.save_message('user', message, member_id=first_member.member_id)
+    async for key, chunk in workflow.behaviour.receive(from_member_id=first_member.member_id):
+        if chunk:
+            writer.write_chunk(key, chunk)
+
+
+def run_batch_file(args, config: Dict[str, Any], writer: OutputWriter) -> int:
+    from src.utils.batch import open_batch_results, read_batch_rows, run_batch
+    try:
+        rows = read_batch_rows(args.batch)
+    except (OSError, ValueError) as e:
+        print(f'Error: {e}', file=sys.stderr)
+        return EXIT_USAGE
+
+    def on_result(result):
+        writer.write_event({'type': 'result', **result})
+
+    results = open_batch_results(args.output or f'{args.batch}.results.jsonl')
+    start = time.perf_counter()
+    try:
+        summary = asyncio.run(run_batch(config, rows, results, concurrency=args.concurrency, on_result=on_result))
+    finally:
+        results.close()
+    elapsed = time.perf_counter() - start
+
+    writer.write_event({'type': 'done', **summary})
+    ran_count = summary['ok'] + summary['error']
+    print(f"{summary['ok']} ok, {summary['error']} failed, {summary['skipped']} already done"
+          f" ({ran_count / elapsed if elapsed else 0:.1f} rows/s)", file=sys.stderr)
+    return EXIT_OK if summary['error'] == 0 else EXIT_ERROR
+
+
+def main(argv=None, stdout: TextIO = None) -> int:
+    args = get_parser().parse_args(argv)
+    writer = OutputWriter(stdout or sys.stdout, args.format)
+
+    def fail(message, exit_code):
+        writer.write_event({'type': 'error', 'message': message, 'exit_code': exit_code})
+        print(f'Error: {message}', file=sys.stderr)
+        return exit_code
+
+    message = None
+    if not args.batch:
+        try:
+            message = read_input(args)
+        except OSError as e:
+            return fail(str(e), EXIT_USAGE)
+        if not message.strip():
+            return fail('No input message, use --message, --input or stdin', EXIT_USAGE)
+
+    os.environ.setdefault('LITELLM_LOG', 'ERROR')
+    from src.utils import sql
+    sql.set_db_filepath(args.db)
+    try:
+        if sql.check_database_upgrade():
+            return fail('The database needs upgrading, open it with the app first', EXIT_ERROR)
+    except Exception as e:
+        return fail(str(e), EXIT_ERROR)
+
+    config = get_entity_config(args.target)
+    if config is None:
+        return fail(f"No agent or workflow named '{args.target}'", EXIT_NOT_FOUND)
+
+    try:
+        from src.system.base import manager
+        from src.members.workflow import Workflow
+        manager.load()
+        manager.initialize_custom_managers()
+        if args.batch:
+            return run_batch_file(args, config, writer)
+
+        workflow = Workflow(config=config, kind='CHAT', chat_title=args.target, persist=args.persist)
+        startup_time = time.perf_counter()
+        asyncio.run(run_workflow(workflow, message, writer))
+    except KeyboardInterrupt:
+        return fail('Interrupted', EXIT_INTERRUPTED)
+    except Exception as e:
+        return fail(str(e) or e.__class__.__name__, EXIT_ERROR)
+
+    end_time = time.perf_counter()
+    first_token_time = writer.first_token_time or end_time
+    timing = {
+        'startup_ms': round((startup_time - START_TIME) * 1000),
+        'first_token_ms': round((first_token_time - START_TIME) * 1000),
+        'total_ms': round((end_time - START_TIME) * 1000),
+    }
+    writer.finish()
+    writer.write_event({'type': 'done', 'context_id': workflow.context_id, **timing})
+    if args.timing:
+        print(', '.join(f'{k}: {v}' for k, v in timing.items()), file=sys.stderr)
+    return EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -28,6 +28,7 @@ import mistune
 from src.gui.config import CHBoxLayout, CVBoxLayout, ConfigFields
 from src.utils.media import play_file
 from src.utils.messages import Message
+from src.utils.prompt_log import delete_unused_prompts, get_prompt_hashes
 
 
 class MessageCollection(QWidget):
@@ -224,11 +225,7 @@ class MessageCollection(QWidget):
                 if bubble_msg_id == msg_id:
                     break
 
-            index = next((i for i, msg in enumerate(self.workflow.message_history.messages) if msg.id == msg_id),
-                         -1)
-
-            if index <= len(self.workflow.message_history.messages) - 1:
-                self.workflow.message_history.messages[:] = self.workflow.message_history.messages[:index]
+            self.workflow.message_history.truncate(msg_id)
 
     def send_message(
         self,
@@ -605,7 +602,8 @@ class MessageContainer(QWidget):
         if not self.bubble.log:
             return
 
-        pretty_json = json.dumps(self.bubble.log, indent=4)
+        from src.utils.prompt_log import expand_log
+        pretty_json = json.dumps(expand_log(self.bubble.log), indent=4)
 
         log_window = QMainWindow()
         log_window.setWindowTitle('Message Input')
@@ -738,18 +736,18 @@ class MessageContainer(QWidget):
         self.parent.delete_messages_since(editing_msg_id)
 
         # Create a new leaf context
-        sql.execute("""
-           INSERT INTO contexts (kind, parent_id, branch_msg_id)
+        new_leaf_id = sql.execute("""
+           INSERT INTO contexts (kind, parent_id, branch_msg_id, root_id)
             SELECT
 				c.kind,
 				cm.context_id,
-				cm.id
+				cm.id,
+				COALESCE(c.root_id, c.id)
 			FROM contexts_messages cm
 			LEFT JOIN contexts c
 				ON cm.context_id = c.id
 			WHERE cm.id = ?
         """, (branch_msg_id,))
-        new_leaf_id = sql.get_scalar('SELECT MAX(id) FROM contexts')
         self.parent.workflow.leaf_id = new_leaf_id
 
     class CountdownButton(QPushButton):
@@ -1098,6 +1096,12 @@ class MessageBubble(QTextEdit):
             view_log_action = menu.addAction("View log")
             view_log_action.triggered.connect(self.view_log)
 
+            usage = self.log.get('usage')
+            if usage:
+                from src.utils.usage import format_usage
+                usage_action = menu.addAction(format_usage(usage))
+                usage_action.setEnabled(False)
+
             if 'member_id' in self.log and find_workflow_widget(self):
                 view_member_action = menu.addAction("Goto member")
                 view_member_action.triggered.connect(self.goto_member)
@@ -1152,7 +1156,9 @@ class MessageBubble(QTextEdit):
         if retval != QMessageBox.Yes:
             return
 
+        prompt_hashes = get_prompt_hashes("id = ?", (self.msg_id,))
         sql.execute("DELETE FROM contexts_messages WHERE id = ?;", (self.msg_id,))
+        delete_unused_prompts(prompt_hashes)
         self.main.page_chat.load()
 
     class BubbleBranchButtons(QWidget):
@@ -23,6 +23,7 @@ from src.gui.widgets import BaseComboBox, CircularImageLabel, \
     find_ancestor_tree_item_id, find_page_editor_widget  # XML used dynamically
 
 from src.utils import sql
+from src.utils.prompt_log import delete_unused_prompts, get_prompt_hashes
 
 
 @set_module_class(module_type='Widgets')
@@ -1643,18 +1644,15 @@ class ConfigDBTree(ConfigTree):
                 if self.table_name == 'contexts':
                     context_id = item_id
                     all_context_ids = sql.get_results("""
-                        WITH RECURSIVE context_tree AS (
-                            SELECT id FROM contexts WHERE id = ?
-                            UNION ALL
-                            SELECT c.id
-                            FROM contexts c
-                            JOIN context_tree ct ON c.parent_id = ct.id
-                        )
-                        SELECT id FROM context_tree;""", (context_id,), return_type='list')
+                        SELECT id FROM contexts WHERE id = ?
+                        UNION ALL
+                        SELECT id FROM contexts WHERE root_id = ?;""", (context_id, context_id), return_type='list')
                     if all_context_ids:
                         all_context_ids = tuple(all_context_ids)
+                        prompt_hashes = get_prompt_hashes(f"context_id IN ({','.join('?' * len(all_context_ids))})", all_context_ids)
                         sql.execute(f"DELETE FROM contexts_messages WHERE context_id IN ({','.join('?' * len(all_context_ids))});", all_context_ids)
                         sql.execute(f"DELETE FROM contexts WHERE id IN ({','.join('?' * len(all_context_ids))});", all_context_ids)
+                        delete_unused_prompts(prompt_hashes)
 
                 elif self.table_name == 'apis':
                     api_id = item_id
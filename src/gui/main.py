@@ -4,7 +4,6 @@ import os
 import sys
 import uuid
 
-import nest_asyncio
 from PySide6.QtWidgets import *
 from PySide6.QtCore import Signal, QSize, QTimer, QThreadPool, QPropertyAnimation, QEasingCurve, \
     QObject, QDateTime
@@ -32,8 +31,6 @@ from src.gui.widgets import IconButton, colorize_pixmap, TextEnhancerButton, Tog
 
 os.environ["QT_OPENGL"] = "software"
 
-nest_asyncio.apply()
-
 BOTTOM_CORNER_X = 400
 BOTTOM_CORNER_Y = 450
 
@@ -435,7 +435,8 @@ class Page_Chat(QWidget):
             prompt = prompt.format(user_msg=user_msg['content'])  # todo
 
             try:
-                title = manager.providers.get_scalar(prompt, single_line=True, model_obj=model_obj)
+                title = manager.providers.get_scalar(prompt, single_line=True, model_obj=model_obj,
+                                                     usage_scope={'context_id': self.page_chat.workflow.context_id})
                 title = title.replace('\n', ' ').strip("'").strip('"')
                 self.page_chat.main.title_update_signal.emit(title)
             except Exception as e:
@@ -533,8 +534,10 @@ class Page_Chat(QWidget):
         else:
             return None, []
 
-    def goto_context(self, context_id=None):
+    def goto_context(self, context_id=None, msg_id=None):
         from src.members.workflow import Workflow
         self.workflow = Workflow(main=self.main, context_id=context_id, chat_page=self)
         self.workflow_kind = sql.get_scalar('SELECT kind FROM contexts WHERE id = ?', (context_id,))  # todo temp
+        if msg_id is not None:
+            self.workflow.message_history.activate_branch_path(msg_id)
         self.load()
@@ -2,6 +2,44 @@
 from PySide6.QtWidgets import *
 from src.gui.config import ConfigDBTree
 from src.gui.widgets import find_main_widget
+from src.utils.search import search_contexts
+
+CONTEXTS_QUERY = """
+    SELECT
+        c.name,
+        c.id,
+        CASE
+            WHEN json_extract(c.config, '$.members') IS NOT NULL THEN
+                CASE
+                    WHEN json_array_length(json_extract(c.config, '$.members')) > 2 THEN
+                        json_array_length(json_extract(c.config, '$.members')) || ' members'
+                    WHEN json_array_length(json_extract(c.config, '$.members')) = 2 THEN
+                        COALESCE(json_extract(json_extract(c.config, '$.members'), '$[1].config."info.name"'), 'Assistant')
+                    WHEN json_extract(json_extract(c.config, '$.members'), '$[1].config._TYPE') = 'agent' THEN
+                        json_extract(json_extract(c.config, '$.members'), '$[1].config."info.name"')
+                    ELSE
+                        json_array_length(json_extract(c.config, '$.members')) || ' members'
+                END
+            ELSE
+                CASE
+                    WHEN json_extract(c.config, '$._TYPE') = 'workflow' THEN
+                        '1 member'
+                    ELSE
+                        COALESCE(json_extract(c.config, '$."info.name"'), 'Assistant')
+                END
+        END as member_count,
+        c.config,
+        '' AS goto_button,
+        c.folder_id
+    FROM contexts c
+    WHERE c.parent_id IS NULL
+    AND c.kind = "{{kind}}"
+    GROUP BY c.id
+    ORDER BY
+        pinned DESC,
+        COALESCE((SELECT MAX(cm.id) FROM contexts_messages cm WHERE cm.context_id = c.id), 0) DESC,
+        c.id DESC
+    LIMIT ? OFFSET ?;"""
 
 
 class Page_Contexts(ConfigDBTree):
@@ -9,50 +47,7 @@ class Page_Contexts(ConfigDBTree):
         super().__init__(
             parent=parent,
             table_name='contexts',
-            query="""
-                SELECT
-                    c.name,
-                    c.id,
-                    CASE
-                        WHEN json_extract(c.config, '$.members') IS NOT NULL THEN
-                            CASE
-                                WHEN json_array_length(json_extract(c.config, '$.members')) > 2 THEN
-                                    json_array_length(json_extract(c.config, '$.members')) || ' members'
-                                WHEN json_array_length(json_extract(c.config, '$.members')) = 2 THEN
-                                    COALESCE(json_extract(json_extract(c.config, '$.members'), '$[1].config."info.name"'), 'Assistant')
-                                WHEN json_extract(json_extract(c.config, '$.members'), '$[1].config._TYPE') = 'agent' THEN
-                                    json_extract(json_extract(c.config, '$.members'), '$[1].config."info.name"')
-                                ELSE
-                                    json_array_length(json_extract(c.config, '$.members')) || ' members'
-                            END
-                        ELSE
-                            CASE
-                                WHEN json_extract(c.config, '$._TYPE') = 'workflow' THEN
-                                    '1 member'
-                                ELSE
-                                    COALESCE(json_extract(c.config, '$."info.name"'), 'Assistant')
-                            END
-                    END as member_count,
-                    c.config,
-                    '' AS goto_button,
-                    c.folder_id
-                FROM contexts c
-                LEFT JOIN (
-                    SELECT
-                        context_id,
-                        MAX(id) as latest_message_id
-                    FROM contexts_messages
-                    GROUP BY context_id
-                ) cmsg ON c.id = cmsg.context_id
-                WHERE c.parent_id IS NULL
-                AND c.kind = "{{kind}}"
-                GROUP BY c.id
-                ORDER BY
-                    pinned DESC,
-                    COALESCE(cmsg.latest_message_id, 0) DESC, 
-                    c.id DESC
-                LIMIT ? OFFSET ?;
-                """,
+            query=CONTEXTS_QUERY,
             schema=[
                 {
                     'text': 'name',
@@ -101,9 +96,55 @@ class Page_Contexts(ConfigDBTree):
             archiveable=True,
         )
         self.icon_path = ":/resources/icon-contexts.png"
+        self.search_msg_ids = {}  # {context_id: msg_id} of the message matched by the search
         self.tree.itemDoubleClicked.connect(self.on_row_double_clicked)
         self.try_add_breadcrumb_widget(root_title='Chats')
 
+    def get_search_text(self):
+        if not self.tree_buttons.search_box.isVisible():
+            return ''
+        return self.tree_buttons.search_box.text().strip()
+
+    def load(self, select_id=None, silent_select_id=None, append=False):
+        search_text = self.get_search_text()
+        if not search_text:
+            self.search_msg_ids = {}
+            super().load(select_id=select_id, silent_select_id=silent_select_id, append=append)
+            return
+
+        # Search the full-text index instead of filtering the loaded rows, so chats not loaded yet are found too
+        if not append:
+            self.load_count = 0
+            self.search_msg_ids = {}
+        limit = 100
+        results = search_contexts(search_text, kind=self.filter_widget.get_kind(), limit=limit, offset=self.load_count * limit)
+        data = []
+        for result in results:
+            self.search_msg_ids[result['context_id']] = result['msg_id']
+            name = result['name'] or ''
+            if result['msg_id'] is not None:
+                name = f"{name}  —  {result['snippet']}" if name else result['snippet']
+            data.append((name, result['context_id'], '', result['config'], '', None))
+
+        self.tree.load(
+            data=data,
+            append=append,
+            select_id=select_id,
+            silent_select_id=silent_select_id,
+            folder_key=None,
+            init_select=self.init_select,
+            readonly=self.readonly,
+            schema=self.schema,
+            group_folders=False,
+            default_item_icon=self.default_item_icon,
+        )
+        if len(data) == 0:
+            return
+        self.load_count += 1
+
+    def filter_rows(self):
+        self.load()
+
     def on_row_double_clicked(self):
         context_id = self.get_selected_item_id()
         if not context_id:
@@ -120,5 +161,5 @@ class Page_Contexts(ConfigDBTree):
         main = find_main_widget(self)
         if main.page_chat.workflow.responding:
             return
-        main.page_chat.goto_context(context_id=context_id)
+        main.page_chat.goto_context(context_id=context_id, msg_id=self.search_msg_ids.get(context_id))
         main.page_chat.ensure_visible()
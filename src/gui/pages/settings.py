@@ -21,6 +21,7 @@ from src.system.environments import EnvironmentSettings
 
 from src.gui.widgets import IconButton, find_main_widget
 from src.gui.pages.models import Page_Models_Settings
+from src.gui.pages.usage import Page_Usage_Settings
 from src.utils import sql
 from src.utils.reset import reset_application
 from src.utils.sql import define_table
@@ -57,6 +58,7 @@ class Page_Settings(ConfigPages):
             'Envs': self.Page_Environments_Settings(self),
             'Modules': Page_Module_Settings(self),
             'Addons': Page_Addon_Settings(self),
+            'Usage': Page_Usage_Settings(self),
             # 'Sets': self.Page_Sets_Settings(self),
             # 'VecDB': self.Page_VecDB_Settings(self),
             # 'Spaces': self.Page_Workspace_Settings(self),
@@ -316,6 +318,25 @@ class Page_Settings(ConfigPages):
                         'tooltip': 'Auto-run code messages (where role = code)',
                         'has_toggle': True,
                     },
+                    {
+                        'text': 'Persist tool runs',
+                        'key': 'persist_sub_workflows',
+                        'type': bool,
+                        'default': False,
+                        'label_width': 165,
+                        'tooltip': 'Save the chats and messages of tool and block runs, for debugging',
+                    },
+                    {
+                        'text': 'LLM cache size (MB)',
+                        'key': 'llm_cache_size_mb',
+                        'type': int,
+                        'minimum': 1,
+                        'maximum': 100000,
+                        'step': 50,
+                        'default': 200,
+                        'label_width': 165,
+                        'tooltip': 'The most disk space the responses of models with `Cache responses` set can use',
+                    },
                     {
                         'text': 'Voice input method',
                         'type': ('None',),
@@ -1064,11 +1085,11 @@ class Page_Settings(ConfigPages):
                     plugin_type='VectorDBSettings',
                     plugin_json_key='vec_db_provider',
                     plugin_label_text='VectorDB provider',
-                    none_text='LanceDB'
+                    none_text='Local'
                 )
-                self.default_class = self.LanceDB_VecDBConfig
+                self.default_class = self.Local_VecDBConfig
 
-            class LanceDB_VecDBConfig(ConfigTabs):
+            class Local_VecDBConfig(ConfigTabs):
                 def __init__(self, *args, **kwargs):
                     super().__init__(*args, **kwargs)
                     self.pages = {
@@ -0,0 +1,107 @@
+
+from src.gui.config import ConfigDBTree
+from src.gui.widgets import IconButton
+
+
+class Page_Usage_Settings(ConfigDBTree):
+    """The token usage, latency and cost of the LLM calls, per day and model"""
+    def __init__(self, parent):
+        super().__init__(
+            parent=parent,
+            table_name='llm_usage_daily',
+            query="""
+                SELECT
+                    day,
+                    day || '/' || provider || '/' || model AS id,
+                    model,
+                    calls,
+                    prompt_tokens,
+                    completion_tokens,
+                    cached_tokens,
+                    CASE WHEN first_token_calls > 0
+                        THEN printf('%.2fs', total_time_to_first_token / first_token_calls)
+                        ELSE ''
+                    END AS avg_time_to_first_token,
+                    printf('%.2fs', total_latency / calls) AS avg_latency,
+                    printf('$%.4f', cost) AS cost
+                FROM llm_usage_daily
+                ORDER BY day DESC, cost DESC, provider, model
+                LIMIT ? OFFSET ?""",
+            schema=[
+                {
+                    'text': 'Day',
+                    'key': 'day',
+                    'type': str,
+                    'width': 85,
+                },
+                {
+                    'text': 'id',
+                    'key': 'id',
+                    'type': str,
+                    'visible': False,
+                },
+                {
+                    'text': 'Model',
+                    'key': 'model',
+                    'type': str,
+                    'stretch': True,
+                },
+                {
+                    'text': 'Calls',
+                    'key': 'calls',
+                    'type': int,
+                    'width': 50,
+                },
+                {
+                    'text': 'Prompt',
+                    'key': 'prompt_tokens',
+                    'type': int,
+                    'width': 70,
+                },
+                {
+                    'text': 'Completion',
+                    'key': 'completion_tokens',
+                    'type': int,
+                    'width': 75,
+                },
+                {
+                    'text': 'Cached',
+                    'key': 'cached_tokens',
+                    'type': int,
+                    'width': 60,
+                },
+                {
+                    'text': 'TTFT',
+                    'key': 'avg_time_to_first_token',
+                    'type': str,
+                    'width': 50,
+                },
+                {
+                    'text': 'Latency',
+                    'key': 'avg_latency',
+                    'type': str,
+                    'width': 55,
+                },
+                {
+                    'text': 'Cost',
+                    'key': 'cost',
+                    'type': str,
+                    'width': 70,
+                },
+            ],
+            dynamic_load=True,
+            readonly=True,
+            layout_type='vertical',
+            config_widget=None,
+            init_select=False,
+        )
+
+    def after_init(self):
+        btn_refresh = IconButton(
+            parent=self.tree_buttons,
+            icon_path=':/resources/icon-refresh.png',
+            tooltip='Refresh',
+            size=18,
+        )
+        btn_refresh.clicked.connect(lambda: self.load())
+        self.tree_buttons.add_button(btn_refresh, 'btn_refresh')
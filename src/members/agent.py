@@ -192,6 +192,26 @@ class AgentSettings(ConfigPages):
                         'has_toggle': True,
                         'row_key': 1,
                     },
+                    {
+                        'text': 'Max context tokens',
+                        'type': int,
+                        'minimum': 256,
+                        'maximum': 2000000,
+                        'step': 1000,
+                        'default': 16000,
+                        'width': 80,
+                        'has_toggle': True,
+                        'tooltip': 'Token budget of the request, defaults to the context window of the model',
+                        'row_key': 2,
+                    },
+                    {
+                        'text': 'On context overflow',
+                        'type': ('Drop oldest', 'Truncate oldest'),
+                        'width': 110,
+                        'tooltip': 'How to cut the oldest messages when the history exceeds the token budget',
+                        'default': 'Drop oldest',
+                        'row_key': 2,
+                    },
                 ]
 
         class Page_Chat_Preload(ConfigJsonTree):
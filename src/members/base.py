@@ -4,12 +4,15 @@ from abc import abstractmethod
 from fnmatch import fnmatch
 from typing import Any, Dict, List, Optional
 
-import pyautogui
-
 # from src.plugins.realtimeai.modules.client import RealtimeAIClientWrapper
 
 from src.utils import sql
 from src.utils.helpers import convert_model_json_to_obj, convert_to_safe_case
+from src.utils.prompt_cache import get_prompt_cache_usage
+from src.utils.prompt_log import compact_log
+from src.utils.usage import get_log_usage
+
+RATE_LIMIT_NOTIFY_SECONDS = 1.0  # rate limit waits shown as a notification
 
 
 class Member:
@@ -66,13 +69,6 @@ class Member:
     @abstractmethod
     async def run_member(self):
         """The entry response method for the member."""
-        temp_has_looper_inputs = False
-        if hasattr(self, 'inputs') and self.workflow:
-            inputs = self.workflow.config.get('inputs', [])
-            any_looper = any(inp.get('config', {}).get('looper', False) for inp in inputs)
-            if any_looper:
-                raise NotImplementedError('Loops are not implemented yet. Coming soon.')
-
         if self.receivable_function:
             async for key, chunk in self.receivable_function():
                 if self.workflow and self.workflow.stop_requested:
@@ -97,6 +93,13 @@ class LlmMember(Member):
         self.realtime_client = None
         self.receivable_function = self.receive
 
+        self.token_budget: Optional[int] = None  # history token budget of the current run
+        self.context_cuts: List[Dict[str, Any]] = []  # messages cut from the history of the current run
+        self.cache_hit: bool = False  # whether the current run's response was replayed from the response cache
+        self.rate_limit_wait: float = 0.0  # seconds the current run was queued by its API's rate limits
+        self.prompt_cache_usage: Optional[Dict[str, int]] = None  # prompt cache token counts of the current run
+        self.call_usage: Optional[Dict[str, Any]] = None  # token usage, latency and cost of the current run's call
+
     # class MemberRealtimeClient:
     #     """
     #     A class to handle the realtime client for the member.
@@ -325,6 +328,7 @@ class LlmMember(Member):
             FROM tools
             WHERE 
                 uuid IN ({','.join(['?'] * len(agent_tools_ids))})
+            ORDER BY name, uuid  -- a stable order keeps the tools in the cached prompt prefix
         """, agent_tools_ids)
 
     @abstractmethod
@@ -336,7 +340,30 @@ class LlmMember(Member):
 
     @abstractmethod
     def get_messages(self):  # todo
-        return self.workflow.message_history.get_llm_messages(calling_member_id=self.full_member_id())
+        from src.system.base import manager  # todo
+        model_json = self.config.get(self.model_config_key, manager.config.dict.get('system.default_chat_model', 'mistral/mistral-large-latest'))
+        model_obj = convert_model_json_to_obj(model_json)
+        return self.workflow.message_history.get_llm_messages(
+            calling_member_id=self.full_member_id(),
+            token_budget=self.token_budget,
+            model_name=model_obj['model_name'],
+            context_cuts=self.context_cuts,
+        )
+
+    def get_token_budget(self, model_obj, system_msg=''):
+        """Returns the tokens available for the message history, after reserving the system message and completion"""
+        from src.system.base import manager  # todo
+        from src.utils.messages import count_tokens
+        max_context_tokens = self.config.get('chat.max_context_tokens', None)
+        if not max_context_tokens:
+            max_context_tokens = manager.providers.get_model_context_window(model_obj)
+        if not max_context_tokens:
+            return None
+
+        model_params = {**model_obj.get('model_params', {}), **(manager.providers.get_model(model_obj) or {})}
+        completion_tokens = model_params.get('max_tokens', None) or 1024
+        system_tokens = count_tokens(system_msg, model_obj['model_name'])
+        return max(max_context_tokens - completion_tokens - system_tokens, 0)
 
     async def receive(self):
         from src.system.base import manager  # todo
@@ -344,6 +371,13 @@ class LlmMember(Member):
         model_obj = convert_model_json_to_obj(model_json)
         structured_data = model_obj.get('model_params', {}).get('structure.data', [])
 
+        system_msg = self.system_message()
+        self.token_budget = self.get_token_budget(model_obj, system_msg)
+        self.context_cuts = []
+        self.cache_hit = False
+        self.rate_limit_wait = 0.0
+        self.prompt_cache_usage = None
+        self.call_usage = None
         messages = self.get_messages()
         # messages = [
         #     {
@@ -371,7 +405,6 @@ class LlmMember(Member):
         #         ]
         #     },
         # ]
-        system_msg = self.system_message()
 
         if model_obj['model_name'].startswith('gpt-4o-realtime'):  # temp todo
             # raise NotImplementedError('Realtime models are not implemented yet.')
@@ -407,6 +440,18 @@ class LlmMember(Member):
             'messages': messages,
             'role_responses': role_responses,
         }
+        if self.context_cuts:
+            logging_obj['context_cuts'] = self.context_cuts
+        if self.cache_hit:
+            logging_obj['cache_hit'] = True
+        if self.rate_limit_wait > 0.0:
+            logging_obj['rate_limit_wait'] = round(self.rate_limit_wait, 3)
+        if self.prompt_cache_usage:
+            logging_obj['prompt_cache'] = self.prompt_cache_usage
+        if self.call_usage:
+            logging_obj['usage'] = get_log_usage(self.call_usage)
+        if self.workflow.persist:
+            logging_obj = compact_log(logging_obj)  # the prompt is stored once, shared by following turns
 
         for key, response in role_responses.items():
             if key == 'tools':
@@ -414,7 +459,7 @@ class LlmMember(Member):
                 for tool in all_tools:
                     tool_args_json = tool['function']['arguments']
                     # tool_name = tool_name.replace('_', ' ').capitalize()
-                    tools = self.main.system.tools.to_dict()
+                    tools = manager.tools.to_dict()
                     first_matching_name = next((k for k, v in tools.items()
                                               if convert_to_safe_case(k) == tool['function']['name']),
                                              None)  # todo add duplicate check, or
@@ -432,6 +477,19 @@ class LlmMember(Member):
                 if response != '':
                     self.workflow.save_message(key, response, self.full_member_id(), logging_obj)
 
+    def on_rate_limit_wait(self, seconds: float):
+        """Records the time a call was queued by its API's rate limits, and shows the long waits in the GUI"""
+        self.rate_limit_wait += seconds
+        if seconds >= RATE_LIMIT_NOTIFY_SECONDS and self.main is not None:
+            self.main.show_notification_signal.emit(f'Waited {seconds:.1f}s for the API rate limit', '#438BB9')
+
+    def on_usage(self, record: Dict[str, Any]):
+        self.call_usage = record
+
+    def usage_scope(self) -> Dict[str, Any]:
+        """The context and member a call's usage is recorded under"""
+        return {'context_id': self.workflow.context_id, 'member_id': self.full_member_id()}
+
     async def stream(self, model, messages):
         from src.system.base import manager
         tools = self.get_function_call_tools()
@@ -444,11 +502,19 @@ class LlmMember(Member):
         stream = await manager.providers.run_model(
             model_obj=model,
             messages=messages,
-            tools=tools
+            tools=tools,
+            on_wait=self.on_rate_limit_wait,
+            usage_scope=self.usage_scope(),
+            on_usage=self.on_usage,
         )
         collected_tools = []
 
         async for resp in stream:
+            if not self.cache_hit:
+                self.cache_hit = bool((getattr(resp, '_hidden_params', None) or {}).get('cache_hit'))
+            usage = getattr(resp, 'usage', None)
+            if usage:
+                self.prompt_cache_usage = get_prompt_cache_usage(usage) or self.prompt_cache_usage
             delta = resp.choices[0].get('delta', {})
             if not delta:
                 continue
@@ -479,14 +545,15 @@ class LlmMember(Member):
 
     async def stream_structured_output(self, model, messages):
         from src.system.base import manager
-        tools = self.get_function_call_tools()
-        resp = await manager.providers.get_structured_output(
+        stream = await manager.providers.stream_structured_output(
             model_obj=model,
             messages=messages,
-            tools=tools
+            on_wait=self.on_rate_limit_wait,
+            usage_scope=self.usage_scope(),
+            on_usage=self.on_usage,
         )
-        yield 'STRUCT', str(resp)
-        # return resp
+        async for chunk in stream:
+            yield 'STRUCT', chunk
 
     def get_function_call_tools(self):
         formatted_tools = []
@@ -511,6 +578,7 @@ class LlmMember(Member):
                     }
                 )
             elif tool_type.startswith('computer_'):
+                import pyautogui  # needs a display
                 screen_width, screen_height = pyautogui.size()
                 formatted_tools.append(
                     {
@@ -261,7 +261,7 @@ class PromptBlock(LlmMember):
         from src.system.base import manager
         content = self.config.get('data', '')
 
-        if run_sub_blocks:
+        if run_sub_blocks and not self.config.get('_data_formatted', False):  # already formatted by compute_prompt_block
             block_type = self.config.get('block_type', 'Text')
             nestable_block_types = ['Text', 'Prompt']
             if block_type in nestable_block_types:
@@ -398,6 +398,17 @@ class PromptBlockSettings(ConfigFields):
                 'default': '',
                 'row_key': 0,
             },
+            {
+                'text': 'Cache (s)',
+                'key': 'cache_ttl',
+                'type': int,
+                'minimum': 0,
+                'maximum': 86400,
+                'step': 60,
+                'default': 0,
+                'tooltip': 'Seconds to reuse the response for the same prompt and model, 0 to always run the prompt.\nOnly set this if the same prompt should give the same answer',
+                'row_key': 0,
+            },
             {
                 'text': 'Data',
                 'type': str,
@@ -1,10 +1,14 @@
 import asyncio
 import json
+import re
 import sqlite3
 import uuid
+from contextvars import ContextVar
 from functools import partial
 from typing import Optional, Dict, Tuple, List, Any
 
+import nest_asyncio
+
 from src.members.base import Member
 from src.members.agent import Agent
 from src.members.block import TextBlock
@@ -14,7 +18,9 @@ from src.members.user import User, UserSettings
 from src.system.plugins import get_plugin_model_settings
 
 from src.utils import sql
-from src.utils.messages import MessageHistory
+from src.utils.messages import Message, MessageHistory
+from src.utils.prompt_log import delete_unused_prompts, get_prompt_hashes
+from src.utils.workflow_plan import compile_stop_condition, get_workflow_plan
 
 from PySide6.QtCore import QPointF, QRectF, QPoint, Signal, QTimer
 from PySide6.QtGui import Qt, QPen, QColor, QBrush, QPainter, QPainterPath, QCursor, QRadialGradient, \
@@ -30,9 +36,14 @@ from src.gui.widgets import IconButton, ToggleIconButton, TreeDialog, BaseTreeWi
 from src.utils.helpers import path_to_pixmap, display_message_box, get_avatar_paths_from_config, \
     merge_config_into_workflow_config, get_member_name_from_config, block_signals, display_message, apply_alpha_to_hex
 
+# blocks and tools run workflows with asyncio.run from inside a running workflow
+nest_asyncio.apply()
 loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
 
+# (message_history, [message]) of the running member, its messages are added when it finishes
+_held_messages: ContextVar[Optional[Tuple[MessageHistory, List[Message]]]] = ContextVar('held_messages', default=None)
+
 
 class Workflow(Member):
     def __init__(self, **kwargs):
@@ -53,6 +64,7 @@ class Workflow(Member):
             self._chat_name: str = ''
             self._chat_title: str = kwargs.get('chat_title', '')
             self._leaf_id: int = self.context_id
+            self._persist: bool = kwargs.get('persist', True)  # ephemeral workflows only live in memory
             self._message_history = MessageHistory(self)
             kind = kwargs.get('kind', 'CHAT')
 
@@ -77,14 +89,16 @@ class Workflow(Member):
                 if not self.config:
                     init_member_config = {'_TYPE': kind_init_members.get(kind, 'block')}
                     self.config = merge_config_into_workflow_config(init_member_config)
-                sql.execute("INSERT INTO contexts (kind, config, name) VALUES (?, ?, ?)", (kind, json.dumps(self.config), self.chat_title))
-                self.context_id = sql.get_scalar("SELECT id FROM contexts WHERE kind = ? ORDER BY id DESC LIMIT 1", (kind,))
+                if self.persist:
+                    self.context_id = sql.execute("INSERT INTO contexts (kind, config, name) VALUES (?, ?, ?)",
+                                                  (kind, json.dumps(self.config), self.chat_title))
 
         self.loop = asyncio.get_event_loop()
         self.responding = False
         self.stop_requested = False
 
         self.members: Dict[str, Member] = {}  # id: member
+        self.plan = None
         self.boxes: List[set] = []
 
         self.autorun = True
@@ -113,6 +127,10 @@ class Workflow(Member):
     def message_history(self) -> MessageHistory:
         return self.get_from_root('_message_history')
 
+    @property
+    def persist(self) -> bool:
+        return self.get_from_root('_persist')
+
     @context_id.setter
     def context_id(self, value):
         self._context_id = value
@@ -159,7 +177,8 @@ class Workflow(Member):
         if self._parent_workflow is None:
             # Load base workflow
             self.message_history.load()
-            self.chat_title = sql.get_scalar("SELECT name FROM contexts WHERE id = ?", (self.context_id,))
+            if self.persist:
+                self.chat_title = sql.get_scalar("SELECT name FROM contexts WHERE id = ?", (self.context_id,))
 
     def load_members(self):
         from src.system.plugins import get_plugin_class
@@ -171,42 +190,17 @@ class Workflow(Member):
             members = wf_config.get('members', [])
         inputs = self.config.get('inputs', [])
 
-        last_member_id = None
-        last_loc_x = -100
-        current_box_member_ids = set()
-
-        members = sorted(members, key=lambda x: x['loc_x'])
+        self.plan = get_workflow_plan(members, inputs)
+        member_dicts = {str(member_dict['id']): member_dict for member_dict in members}
 
         self.members = {}  #!looper!#
-        self.boxes = []
-        iterable = iter(members)
-        while len(members) > 0:
-            try:
-                member_dict = next(iterable)
-            except StopIteration:  # todo temp make nicer
-                iterable = iter(members)
-                continue
-
-            member_id = str(member_dict['id'])
-            if self._parent_workflow:
-                pass
+        for member_id in self.plan.order:
+            member_dict = member_dicts[member_id]
             entity_id = member_dict.get('agent_id', None)
             member_config = member_dict['config']
             loc_x = member_dict.get('loc_x', 50)
             loc_y = member_dict.get('loc_y', 0)
 
-            member_input_ids = [
-                input_info['source_member_id']
-                for input_info in inputs
-                if input_info['target_member_id'] == member_id
-                and not input_info['config'].get('looper', False)
-            ]
-
-            # Order based on the inputs
-            if len(member_input_ids) > 0:
-                if not all((inp_id in self.members) for inp_id in member_input_ids):
-                    continue
-
             # Instantiate the member
             member_type = member_dict.get('config', {}).get('_TYPE', 'agent')
             kwargs = dict(main=self.main,
@@ -216,7 +210,7 @@ class Workflow(Member):
                           agent_id=entity_id,
                           loc_x=loc_x,
                           loc_y=loc_y,
-                          inputs=member_input_ids)
+                          inputs=list(self.plan.inputs[member_id]))
             if member_type == 'agent':  #!membermod!#
                 use_plugin = member_config.get('info.use_plugin', None)
                 member_class = get_plugin_class(plugin_type='Agent', plugin_name=use_plugin, default_class=Agent)
@@ -241,37 +235,10 @@ class Workflow(Member):
                 raise NotImplementedError(f"Member type '{member_type}' not implemented")
 
             member.load()
-
-            if member_type in ('workflow', 'agent', 'block'):
-                if abs(loc_x - last_loc_x) < 10:  # 10px threshold
-                    if last_member_id is not None:
-                        current_box_member_ids |= {last_member_id}
-                    current_box_member_ids |= {member_id}
-
-                else:
-                    if current_box_member_ids:
-                        self.boxes.append(current_box_member_ids)
-                        current_box_member_ids = set()
-
-                last_loc_x = loc_x
-                last_member_id = member_id
-
             self.members[member_id] = member
-            members.remove(member_dict)
-            iterable = iter(members)
-
-        if current_box_member_ids:
-            self.boxes.append(current_box_member_ids)
-
-        del_boxes = []
-        for box in self.boxes:
-            for member_id in box:
-                fnd = self.walk_inputs_recursive(member_id, box)
-                if fnd:
-                    del_boxes.append(box)
-                    break
-        for box in del_boxes:
-            self.boxes.remove(box)
+
+        # Members sharing a level of the plan can't depend on each other, so they run together
+        self.boxes = [set(group) for group in self.plan.parallel_groups]
 
         counted_members = self.count_members()
         if counted_members == 1:
@@ -327,12 +294,6 @@ class Workflow(Member):
         only_one_empty = len([member for member in self.get_members() if member.turn_output is None]) == 1
         return only_one_empty  #!99!#  #!looper!#
 
-    def get_member_async_group(self, member_id) -> Optional[List[str]]:
-        for box in self.boxes:
-            if member_id in box:
-                return [b for b in box if self.last_output is None]
-        return None  # [member_id]
-
     def get_member_config(self, member_id) -> Dict[str, Any]:
         member = self.members.get(member_id)
         return member.config if member else {}
@@ -375,28 +336,38 @@ class Workflow(Member):
         member_id: str = None,  # '1',
         log_obj=None
     ):
-        """Saves a message to the database and returns the message_id"""
+        """
+        Saves a message to the database and returns the message.
+        A running member's messages are held until it finishes, then added in plan order,
+        the returned message's `id` is None until then.
+        """
         if role == 'output':
             content = 'The code executed without any output' if content.strip() == '' else content
 
         if content == '':
             return None
 
+        held_messages = _held_messages.get()
+        if held_messages is not None and held_messages[0] is self.message_history:
+            held_msg = Message(None, role, content, member_id, log=log_obj)
+            held_messages[1].append(held_msg)
+            return held_msg
+
         return self.message_history.add(role, content, member_id=member_id, log_obj=log_obj)
 
     def deactivate_all_branches_with_msg(self, msg_id):
+        sibling_key = sql.get_results("""
+            SELECT c.parent_id, c.branch_msg_id
+            FROM contexts_messages cm
+            JOIN contexts c ON c.id = cm.context_id
+            WHERE cm.id = ?""", (msg_id,))
+        if not sibling_key or sibling_key[0][1] is None:
+            return
         sql.execute("""
             UPDATE contexts
             SET active = 0
-            WHERE branch_msg_id = (
-                SELECT branch_msg_id
-                FROM contexts
-                WHERE id = (
-                    SELECT context_id
-                    FROM contexts_messages
-                    WHERE id = ?
-                )
-            );""", (msg_id,))
+            WHERE parent_id = ?
+                AND branch_msg_id = ?;""", sibling_key[0])
 
     # def get_active_states(self):  # todo temp helper
     #     return sql.get_results("""
@@ -450,38 +421,72 @@ class Workflow(Member):
 
 
 class WorkflowBehaviour:
+    DEFAULT_MAX_CONCURRENCY = 4
+    DEFAULT_MAX_ITERATIONS = 5
+    MAX_QUEUED_EVENTS = 16  # member tasks wait while the consumer is this far behind, so a slow reader pauses the model
+
     def __init__(self, workflow):
         self.workflow: Workflow = workflow
+        self.stop_requested = False
         # self.tasks = []
 
     async def start(self, from_member_id: int = None, feed_back: bool = False):
         async for key, chunk in self.receive(from_member_id, feed_back):
             pass
 
-    async def receive(self, from_member_id: int = None, feed_back: bool = False):
-        processed_members = set()
-
-        def create_async_group_task(member_ids):
-            """ Helper function to create and return a coroutine that runs all members in the member_async_group """
-            async def run_group():
-                group_tasks = []
-                for member_id in member_ids:
-                    if member_id not in processed_members:
-                        m = self.workflow.members[member_id]
-                        sub_task = asyncio.create_task(run_member_task(m))
-                        group_tasks.append(sub_task)
-                        processed_members.add(member_id)
-                try:
-                    await asyncio.gather(*group_tasks)
-                except StopIteration:
-                    return
-
-            return run_group
-
-        async def run_member_task(member):  # todo dirty
-            async for _ in member.run_member():
-                pass
+    def get_run_member_ids(self, from_member_id=None, feed_back=False) -> List[str]:
+        """Returns the ids of the members to run this turn, in plan order"""
+        run_member_ids = []
+        found_source = from_member_id is None
+        for member in self.workflow.members.values():
+            if not found_source and member.member_id == from_member_id:
+                found_source = True
+            if not found_source:
+                continue
+            ignore_turn_output = feed_back and member.member_id == from_member_id
+            if member.turn_output is not None and not ignore_turn_output:
+                continue
+            run_member_ids.append(member.member_id)
+        return run_member_ids
+
+    def get_loops(self) -> Dict[str, List[Tuple[str, Dict[str, Any], Optional[re.Pattern]]]]:
+        """
+        Returns {source_member_id: [(target_member_id, input_config, stop_pattern)]} of the looper inputs.
+        Raises LoopConfigError for an invalid stop condition, before any member runs.
+        """
+        loops = {}
+        for input_dict in self.workflow.config.get('inputs', []):
+            input_config = input_dict.get('config', {})
+            if not input_config.get('looper', False):
+                continue
+            source_id, target_id = str(input_dict['source_member_id']), str(input_dict['target_member_id'])
+            if self.workflow.plan.get_loop_body(target_id, source_id):
+                stop_pattern = compile_stop_condition(source_id, target_id, input_config.get('stop_condition', ''))
+                loops.setdefault(source_id, []).append((target_id, input_config, stop_pattern))
+        return loops
+
+    def next_loop_iteration(self, member_id, loops, loop_iterations) -> Optional[List[str]]:
+        """Returns the members to run again when a loop ends at `member_id` and it should continue, otherwise None"""
+        for target_id, input_config, stop_pattern in loops.get(member_id, []):
+            loop_key = (target_id, member_id)
+            iteration = loop_iterations.get(loop_key, 1)
+            max_iterations = input_config.get('max_iterations', self.DEFAULT_MAX_ITERATIONS)
+            if iteration >= max_iterations:
+                continue
+            if stop_pattern and stop_pattern.search(self.workflow.members[member_id].last_output or ''):
+                continue
+            loop_iterations[loop_key] = iteration + 1
+            return self.workflow.plan.get_loop_body(target_id, member_id)
+        return None
 
+    async def receive(self, from_member_id: int = None, feed_back: bool = False):
+        """
+        Runs every member as soon as the members it depends on have finished, up to `max_concurrency` at a time.
+        The messages of a member are held until it finishes, then added in plan order,
+        so the message history doesn't depend on which member responds first.
+        A looper input runs the members between its target and source again, until its stop condition
+        matches the source's output or it reaches `max_iterations`.
+        """
         if len(self.workflow.members) == 0:
             return
 
@@ -489,67 +494,134 @@ class WorkflowBehaviour:
         # if first_member.config.get('_TYPE', 'agent') == 'user':  #!33!#
         #     from_member_id = first_member.member_id
 
-        filter_role = self.workflow.config.get('config', {}).get('filter_role', 'All').lower()
+        workflow_config = self.workflow.config.get('config', {})
+        filter_role = workflow_config.get('filter_role', 'All').lower()
+        max_concurrency = max(int(workflow_config.get('max_concurrency', self.DEFAULT_MAX_CONCURRENCY) or 1), 1)
+        is_base_workflow = self.workflow._parent_workflow is None
+
+        run_member_ids = self.get_run_member_ids(from_member_id, feed_back)
+        run_member_set = set(run_member_ids)
+        final_member_id = run_member_ids[-1] if run_member_ids else None
+
+        plan = self.workflow.plan
+        loops = self.get_loops()  # {source_member_id: [(target_member_id, input_config, stop_pattern)]}
+        loop_members = {member_id for source_id, source_loops in loops.items()
+                        for target_id, _, _ in source_loops for member_id in plan.get_loop_body(target_id, source_id)}
+        loop_iterations = {}  # {(target_member_id, source_member_id): iteration}
+        member_iterations = {member_id: 1 for member_id in loop_members}
+
+        events = asyncio.Queue(maxsize=self.MAX_QUEUED_EVENTS)  # (event, member_id, value) from the member tasks
+        pending = list(run_member_ids)
+        running: Dict[str, asyncio.Task] = {}
+        held_messages: Dict[str, list] = {}
+        final_chunks = []  # the final member's output is only returned by its last iteration
+        finished = set()
+        committed = set()
+        commit_queue = list(run_member_ids)  # messages are added in this order
+        commit_index = 0
+        launching = True
+        paused = False  # a user member is waiting for input
+
+        async def run_member_task(member):
+            _held_messages.set((self.workflow.message_history, held_messages[member.member_id]))
+            is_final_member = member.member_id == final_member_id
+            try:
+                async for key, chunk in member.run_member():
+                    if key == 'SYS' and chunk == 'BREAK':
+                        await events.put(('break', member.member_id, None))
+                        break
+                    if is_final_member and (key == filter_role or filter_role == 'all'):
+                        await events.put(('chunk', member.member_id, (key, chunk)))
+                await events.put(('done', member.member_id, None))
+            except Exception as e:
+                await events.put(('error', member.member_id, e))
+
+        self.stop_requested = False
         self.workflow.responding = True
         try:
-            found_source = True if from_member_id is None else False
-            for member in self.workflow.members.values():
-                if not found_source and member.member_id == from_member_id:
-                    found_source = True
-                if not found_source:
-                    continue  # todo clean mechanism
-                ignore_turn_output = feed_back and member.member_id == from_member_id
-                if (member.turn_output is not None and not ignore_turn_output) or member.member_id in processed_members:
-                    continue
-                if self.workflow.chat_page:
-                    self.workflow.chat_page.workflow_settings.refresh_member_highlights()
-
-                async_group_member_ids = self.workflow.get_member_async_group(member.member_id)
-                if async_group_member_ids:
-                    self.workflow.gen_members = async_group_member_ids
-                    # Create a single coroutine to handle the entire member async group
-                    run_method = create_async_group_task(async_group_member_ids)
-                    result = await run_method()
-                    if result is True:
-                        return
-                else:
-                    nem = self.workflow.next_expected_member()
-                    is_final_message = self.workflow.next_expected_is_last_member() and member == nem
-                    # # Run individual member
-                    try:
-                        async for key, chunk in member.run_member():
-                            if key == 'SYS' and chunk == 'BREAK':
-                                # break
-                                is_base_workflow = self.workflow._parent_workflow is None
-                                if is_base_workflow:
-                                    return
-                                break
-
-                            if is_final_message and (key == filter_role or filter_role == 'all'):
-                                yield key, chunk
-
-                    except StopIteration:  # todo still needed?
-                        return
+            while pending or running:
+                if self.stop_requested:
+                    launching = False
+                if launching:
+                    for member_id in list(pending):
+                        if len(running) >= max_concurrency:
+                            break
+                        dependencies = plan.dependencies.get(member_id, [])
+                        if any(dep_id in run_member_set and dep_id not in committed for dep_id in dependencies):
+                            continue
+                        pending.remove(member_id)
+                        held_messages[member_id] = []
+                        running[member_id] = asyncio.create_task(run_member_task(self.workflow.members[member_id]))
+                    if self.workflow.chat_page:
+                        self.workflow.chat_page.workflow_settings.refresh_member_highlights()
+                    if not self.workflow.autorun:
+                        launching = False  # only the members that are ready now
+                if not running:
+                    break
 
-                if not self.workflow.autorun:
-                    return
+                event, member_id, value = await events.get()
+                if event == 'chunk':
+                    if member_id in loop_members:
+                        final_chunks.append(value)
+                    else:
+                        yield value
+                elif event == 'break':
+                    if is_base_workflow:
+                        launching = False
+                        paused = True
+                elif event == 'error':
+                    raise value
+                elif event == 'done':
+                    running.pop(member_id)
+                    finished.add(member_id)
+                    while commit_index < len(commit_queue) and commit_queue[commit_index] in finished:
+                        commit_member_id = commit_queue[commit_index]
+                        for held_msg in held_messages.pop(commit_member_id):
+                            if commit_member_id in loop_members:
+                                held_msg.log = {**(held_msg.log or {}), 'loop_iteration': member_iterations[commit_member_id]}
+                            self.workflow.message_history.add_message(held_msg)
+                        committed.add(commit_member_id)
+                        commit_index += 1
+
+                        loop_body = None if self.stop_requested else self.next_loop_iteration(commit_member_id, loops, loop_iterations)
+                        if not loop_body:
+                            if commit_member_id == final_member_id:
+                                for final_chunk in final_chunks:
+                                    yield final_chunk
+                            continue
+
+                        # Run the loop body again with the same member objects, before anything that follows it
+                        for body_member_id in loop_body:
+                            member_iterations[body_member_id] += 1
+                            finished.discard(body_member_id)
+                            committed.discard(body_member_id)
+                        run_member_set.update(loop_body)
+                        commit_queue[commit_index:commit_index] = loop_body
+                        pending = sorted(pending + loop_body, key=lambda m_id: plan.member_indexes[m_id])
+                        final_chunks = []
+
+            if paused or not self.workflow.autorun:
+                return
 
             if self.workflow._parent_workflow is not None:  # todo
                 # last_member = list(self.workflow.members.values())[-1]
                 final_message = self.workflow.get_final_message(filter_role=filter_role)
                 if final_message:
                     full_member_id = self.workflow.full_member_id()
-                    log_obj = sql.get_scalar("SELECT log FROM contexts_messages WHERE id = ?", (final_message['id'],))
-                    self.workflow.save_message(final_message['role'], final_message['content'], full_member_id, json.loads(log_obj))
+                    log_obj = next((msg.log for msg in self.workflow.message_history.messages if msg.id == final_message['id']), None)
+                    self.workflow.save_message(final_message['role'], final_message['content'], full_member_id, dict(log_obj or {}))
 
         except asyncio.CancelledError:
             pass  # task was cancelled, so we ignore the exception
         except Exception as e:
             raise e
         finally:
+            for task in running.values():
+                task.cancel()
             self.workflow.responding = False
 
     def stop(self):
+        self.stop_requested = True
         self.workflow.stop_requested = True
 
 
@@ -774,55 +846,21 @@ class WorkflowSettings(ConfigWidget):
             self.scene.removeItem(box)
         self.boxes_in_view = []
 
-        last_member_id = None
-        last_member_pos = None
-        last_loc_x = -100
-        current_box_member_positions = []
-        current_box_member_ids = []
-
-        members = self.members_in_view.values()
-        members = sorted(members, key=lambda m: m.x())
-
-        for member in members:
-            loc_x = member.x()
-            loc_y = member.y()
-            pos = QPointF(loc_x, loc_y)
-
-            member_type = member.member_config.get('_TYPE', 'agent')
-            if member_type in ('workflow', 'agent', 'block'):
-                if abs(loc_x - last_loc_x) < 10:
-                    current_box_member_positions += [last_member_pos, pos]
-                    current_box_member_ids += [last_member_id, member.id]
-                else:
-                    if current_box_member_positions:
-                        box = RoundedRectWidget(self, points=current_box_member_positions, member_ids=current_box_member_ids)
-                        self.scene.addItem(box)
-                        self.boxes_in_view.append(box)
-                        current_box_member_positions = []
-                        current_box_member_ids = []
-
-                last_loc_x = loc_x
-                last_member_pos = pos
-                last_member_id = member.id
-
-        # Handle the last group after finishing the loop
-        if current_box_member_positions:
-            box = RoundedRectWidget(self, points=current_box_member_positions, member_ids=current_box_member_ids)
+        members = [{'id': member_id, 'loc_x': int(member.x()), 'loc_y': int(member.y()), 'config': {'_TYPE': member.member_type}}
+                   for member_id, member in self.members_in_view.items()]
+        inputs = [{'source_member_id': source_member_id, 'target_member_id': target_member_id, 'config': line.config}
+                  for (source_member_id, target_member_id), line in self.inputs_in_view.items()]
+        try:
+            plan = get_workflow_plan(members, inputs)
+        except ValueError:  # circular inputs, nothing to group until they're fixed
+            return
+
+        for group in plan.parallel_groups:
+            points = [QPointF(self.members_in_view[member_id].x(), self.members_in_view[member_id].y()) for member_id in group]
+            box = RoundedRectWidget(self, points=points, member_ids=group)
             self.scene.addItem(box)
             self.boxes_in_view.append(box)
 
-        del_boxes = []
-        for box in self.boxes_in_view:
-            for member_id in box.member_ids:
-                fnd = self.walk_inputs_recursive(member_id, box.member_ids)
-                if fnd:
-                    del_boxes.append(box)
-                    break
-
-        for box in del_boxes:
-            self.scene.removeItem(box)
-            self.boxes_in_view.remove(box)
-
     def load_inputs(self):
         for _, line in self.inputs_in_view.items():
             self.scene.removeItem(line)
@@ -1473,27 +1511,18 @@ class WorkflowSettings(ConfigWidget):
             if not workflow:
                 return
 
+            prompt_hashes = get_prompt_hashes("context_id IN (SELECT ? UNION ALL SELECT id FROM contexts WHERE root_id = ?)",
+                                              (workflow.context_id, workflow.context_id))
             sql.execute("""
-                WITH RECURSIVE delete_contexts(id) AS (
-                    SELECT id FROM contexts WHERE id = ?
-                    UNION ALL
-                    SELECT contexts.id FROM contexts
-                    JOIN delete_contexts ON contexts.parent_id = delete_contexts.id
-                )
-                DELETE FROM contexts_messages WHERE context_id IN delete_contexts;
-            """, (workflow.context_id,))
-            sql.execute("""
-            DELETE FROM contexts_messages WHERE context_id = ?""",
-                        (workflow.context_id,))
-            sql.execute("""
-                WITH RECURSIVE delete_contexts(id) AS (
-                    SELECT id FROM contexts WHERE id = ?
-                    UNION ALL
-                    SELECT contexts.id FROM contexts
-                    JOIN delete_contexts ON contexts.parent_id = delete_contexts.id
-                )
-                DELETE FROM contexts WHERE id IN delete_contexts AND id != ?;
+                DELETE FROM contexts_messages
+                WHERE context_id IN (
+                    SELECT ? UNION ALL SELECT id FROM contexts WHERE root_id = ?
+                );
             """, (workflow.context_id, workflow.context_id,))
+            sql.execute("""
+                DELETE FROM contexts WHERE root_id = ?;
+            """, (workflow.context_id,))
+            delete_unused_prompts(prompt_hashes)
 
             if hasattr(self.parent.parent, 'main'):
                 self.parent.parent.main.page_chat.load()
@@ -1824,6 +1853,16 @@ class WorkflowSettings(ConfigWidget):
                         'default': 'All',
                         'row_key': 0,
                     },
+                    {
+                        'text': 'Max concurrency',
+                        'type': int,
+                        'minimum': 1,
+                        'maximum': 64,
+                        'step': 1,
+                        'default': 4,
+                        'tooltip': 'The maximum number of members that can run at the same time.',
+                        'row_key': 0,
+                    },
                     {
                         'text': 'Member options',
                         'type': 'MemberPopupButton',
@@ -2938,6 +2977,21 @@ class DynamicMemberConfigWidget(ConfigWidget):
                         'type': bool,
                         'default': False,
                     },
+                    {
+                        'text': 'Max iterations',
+                        'type': int,
+                        'minimum': 1,
+                        'maximum': 1000,
+                        'step': 1,
+                        'default': 5,
+                        'tooltip': 'The maximum number of times the looped members run.',
+                    },
+                    {
+                        'text': 'Stop condition',
+                        'type': str,
+                        'default': '',
+                        'tooltip': 'Stop looping when the output of the source member matches this regular expression.',
+                    },
                 ]
 
         class InputMappings(ConfigJsonTree):
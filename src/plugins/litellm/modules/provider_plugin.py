@@ -1,17 +1,73 @@
 import asyncio
-from typing import List, Dict, Any, Optional
+from functools import lru_cache
+from typing import Dict, Any, Optional, Tuple, Type
 
-import instructor
-import litellm
-from litellm import acompletion, completion
-from pydantic import create_model
+from pydantic import BaseModel, create_model
 
 from src.gui.config import ConfigFields
 from src.utils import sql
-from src.utils.helpers import network_connected, convert_model_json_to_obj, convert_to_safe_case
+from src.utils.helpers import convert_model_json_to_obj, convert_to_safe_case
+from src.utils.rate_limit import is_rate_limit_error
+from src.utils.retry import MAX_ATTEMPTS, CircuitOpenError, NETWORK_ERROR, TRANSIENT_ERRORS, classify_error, endpoint_reachable, get_backoff
 from src.system.providers import Provider
 
-litellm.log_level = 'ERROR'
+
+REQUEST_PARAM_KEYS = (
+    'temperature',
+    'top_p',
+    'presence_penalty',
+    'frequency_penalty',
+    'max_tokens',
+    'api_key',
+    'api_base',
+    'api_version',
+    'custom_provider',
+)
+STRUCTURED_TYPES = {
+    'str': str,
+    'int': int,
+    'float': float,
+    'bool': bool,
+}
+
+
+def import_litellm():
+    """litellm takes seconds to import, so it's only imported once a model is used"""
+    import litellm
+    litellm.log_level = 'ERROR'
+    return litellm
+
+
+def get_response_model(model_obj: Dict[str, Any]) -> Type[BaseModel]:
+    """Returns the pydantic model of a member's structured output config, reused until the config changes"""
+    model_params = model_obj.get('model_params', {})
+    structured_data = model_params.get('structure.data', [])
+    return create_response_model(
+        model_params.get('structured.class_name', 'Untitled'),
+        tuple((attr['attribute'], attr['type'], bool(attr['req'])) for attr in structured_data),
+    )
+
+
+@lru_cache(maxsize=256)
+def streams_usage(model_name: str, custom_provider: Optional[str] = None) -> bool:
+    """Whether the model's API accepts `stream_options`, to send the token usage at the end of a stream"""
+    try:
+        supported_params = import_litellm().get_supported_openai_params(model=model_name, custom_llm_provider=custom_provider)
+    except Exception:
+        return False
+    return 'stream_options' in (supported_params or [])
+
+
+@lru_cache(maxsize=256)
+def create_response_model(class_name: str, attributes: Tuple[Tuple[str, str, bool], ...]) -> Type[BaseModel]:
+    field_definitions = {}
+    for attribute, attribute_type, required in attributes:
+        field_type = STRUCTURED_TYPES.get(attribute_type, Any)
+        if not required:
+            field_type = Optional[field_type]
+        field_definitions[convert_to_safe_case(attribute)] = (field_type, ... if required else None)
+    return create_model(class_name, **field_definitions)
+
 
 class LitellmProvider(Provider):
     def __init__(self, parent, api_id=None):
@@ -90,117 +146,154 @@ class LitellmProvider(Provider):
         cleaned_model_config = {k: v for k, v in model_config.items() if k in accepted_keys}
         return cleaned_model_config
 
+    def get_model_context_window(self, model_obj):
+        try:
+            model_info = import_litellm().get_model_info(model_obj.get('model_name'))
+        except Exception:
+            return None
+        return model_info.get('max_input_tokens') or model_info.get('max_tokens')
+
     async def run_model(self, model_obj, **kwargs):
         from src.system.base import manager
-        accepted_keys = [
-            'temperature',
-            'top_p',
-            'presence_penalty',
-            'frequency_penalty',
-            'max_tokens',
-            'api_key',
-            'api_base',
-            'api_version',
-            'custom_provider',
-        ]
         model_obj = convert_model_json_to_obj(model_obj)
-        model_s_params = manager.providers.get_model(model_obj)
-        model_obj['model_params'] = {**model_obj.get('model_params', {}), **model_s_params}
-        model_obj['model_params'] = {k: v for k, v in model_obj['model_params'].items() if k in accepted_keys}
+        include_usage = manager.providers.uses_prompt_caching(model_obj)  # for the prompt cache counts
 
         # print('Model params: ', json.dumps(model_obj['model_params']))
 
         stream = kwargs.get('stream', True)
         messages = kwargs.get('messages', [])
         tools = kwargs.get('tools', None)
+        tool_choice = kwargs.get('tool_choice', 'auto')
 
         model_name = model_obj['model_name']
-        model_params = model_obj.get('model_params', {})
+        model_params = self.get_request_params(model_obj)
 
         # if not all(msg['content'] for msg in messages):
         #     pass
 
+        circuit_breaker = manager.providers.get_circuit_breaker(model_obj)
         ex = None
-        for i in range(5):
+        for i in range(MAX_ATTEMPTS):
+            try:
+                circuit_breaker.check()
+            except CircuitOpenError:
+                if ex is not None:
+                    raise ex  # the circuit opened on this call's own failures
+                raise
             try:
                 kwargs = dict(
                     model=model_name,
                     messages=messages,
                     stream=stream,
                     request_timeout=100,
+                    max_retries=0,  # retried here, with the circuit breaker
                     **(model_params or {}),
                 )
                 if tools:
                     kwargs['tools'] = tools
-                    kwargs['tool_choice'] = "auto"
+                    kwargs['tool_choice'] = tool_choice
+                if stream and (include_usage or streams_usage(model_name, model_params.get('custom_provider') or None)):
+                    kwargs['stream_options'] = {'include_usage': True}
 
                 if next(iter(messages), {}).get('role') != 'user':
                     pass
-                return await acompletion(**kwargs)
+                response = await import_litellm().acompletion(**kwargs)
             except Exception as e:
-                if not network_connected():
-                    ex = ConnectionError('No network connection.')
-                    break
+                if is_rate_limit_error(e):
+                    circuit_breaker.record_success()  # the API is up
+                    raise  # retried by the provider manager, after the wait the server asks for
+                error_type = classify_error(e)
+                if error_type not in TRANSIENT_ERRORS:
+                    circuit_breaker.record_success()
+                    raise  # auth and bad request errors fail the same way again
+                circuit_breaker.record_failure()
+                if error_type == NETWORK_ERROR and not await endpoint_reachable(model_params.get('api_base')):
+                    raise ConnectionError('No network connection.') from e
                 ex = e
-                await asyncio.sleep(0.3 * i)
+                if i < MAX_ATTEMPTS - 1:
+                    await asyncio.sleep(get_backoff(i))
+                continue
+            except BaseException:
+                circuit_breaker.release_trial()  # cancelled, it says nothing about the API
+                raise
+
+            circuit_breaker.record_success()
+            return response
         raise ex
 
-    async def get_structured_output(self, model_obj, **kwargs):
-        def create_dynamic_model(model_name: str, attributes: List[Dict[str, Any]]) -> Any:
-            field_definitions = {}
-
-            type_mapping = {
-                "str": str,
-                "int": int,
-                "float": float,
-                "bool": bool
-            }
-
-            for attr in attributes:
-                field_type = type_mapping.get(attr["type"], Any)
-                if not attr["req"]:
-                    field_type = Optional[field_type]
-
-                attr["attribute"] = convert_to_safe_case(attr["attribute"])
-                field_definitions[attr["attribute"]] = (field_type, ... if attr["req"] else None)
-
-            return create_model(model_name, **field_definitions)
-
-        structured_class_name = model_obj.get('model_params', {}).get('structured.class_name', 'Untitled')
-        structured_data = model_obj.get('model_params', {}).get('structure.data', [])
-        pydantic_model = create_dynamic_model(structured_class_name, structured_data)
-
-        from src.system.base import manager  # todo de-dupe
-        accepted_keys = [
-            'temperature',
-            'top_p',
-            'presence_penalty',
-            'frequency_penalty',
-            'max_tokens',
-            'api_key',
-            'api_base',
-            'api_version',
-            'custom_provider',
-        ]
-        model_s_params = manager.providers.get_model(model_obj)
-        model_obj['model_params'] = {**model_obj.get('model_params', {}), **model_s_params}
-        model_obj['model_params'] = {k: v for k, v in model_obj['model_params'].items() if k in accepted_keys}
-
-        client = instructor.from_litellm(completion)
-
-        model_name = model_obj['model_name']
-        model_params = model_obj.get('model_params', {})
-        messages = kwargs.get('messages', [])
+    def get_cost(self, model_obj, prompt_tokens, completion_tokens, cached_tokens=0) -> Optional[float]:
+        """Returns the cost of a call from the model's configured prices, or litellm's price list if they aren't set"""
+        cost = super().get_cost(model_obj, prompt_tokens, completion_tokens, cached_tokens)
+        if cost is not None:
+            return cost
+        try:
+            prompt_cost, completion_cost = import_litellm().cost_per_token(
+                model=model_obj.get('model_name'),
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                cache_read_input_tokens=cached_tokens,
+            )
+        except Exception:
+            return None  # not in the price list
+        return prompt_cost + completion_cost
+
+    def get_request_params(self, model_obj) -> Dict[str, Any]:
+        """Returns the saved and request params of a model that litellm accepts, without changing the model object"""
+        from src.system.base import manager
+        model_params = {**model_obj.get('model_params', {}), **(manager.providers.get_model(model_obj) or {})}
+        return {k: v for k, v in model_params.items() if k in REQUEST_PARAM_KEYS}
 
-        resp = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            response_model=pydantic_model,
-            **(model_params or {}),
+    async def get_structured_output(self, model_obj, **kwargs):
+        model_obj = convert_model_json_to_obj(model_obj)
+        response_model = get_response_model(model_obj)
+
+        import instructor
+        client = instructor.from_litellm(import_litellm().acompletion)
+        resp = await client.chat.completions.create(
+            model=model_obj['model_name'],
+            messages=kwargs.get('messages', []),
+            response_model=response_model,
+            **self.get_request_params(model_obj),
         )
-        assert isinstance(resp, pydantic_model)
+        assert isinstance(resp, response_model)
         return resp.json()
 
+    async def stream_structured_output(self, model_obj, **kwargs):
+        """
+        Starts a structured output request as a forced call of a tool shaped like the response model.
+        Returns a stream of the JSON text as it arrives, checked against the response model once complete.
+        """
+        model_obj = convert_model_json_to_obj(model_obj)
+        response_model = get_response_model(model_obj)
+        tool_name = convert_to_safe_case(response_model.__name__).replace('.', '_')
+        tool = {
+            'type': 'function',
+            'function': {
+                'name': tool_name,
+                'description': f'Respond with a {response_model.__name__}',
+                'parameters': response_model.model_json_schema(),
+            },
+        }
+        request_model_obj = {**model_obj, 'model_params': self.get_request_params(model_obj)}
+        stream = await self.run_model(
+            request_model_obj,
+            messages=kwargs.get('messages', []),
+            tools=[tool],
+            tool_choice={'type': 'function', 'function': {'name': tool_name}},
+        )
+        return self.iter_structured_output(stream, response_model)
+
+    async def iter_structured_output(self, stream, response_model):
+        output = ''
+        async for resp in stream:
+            delta = resp.choices[0].get('delta') or {}
+            for tool_chunk in delta.get('tool_calls') or []:
+                arguments = tool_chunk.function.arguments
+                if arguments:
+                    output += arguments
+                    yield arguments
+        response_model.model_validate_json(output)  # raises if the model didn't follow the structure
+
     async def get_scalar_async(self, prompt, single_line=False, num_lines=0, model_obj=None):
         if single_line:
             num_lines = 1
@@ -339,6 +432,38 @@ class LitellmProvider(Provider):
                     'row_key': 'D',
                     'default': 0.0,
                 },
+                {
+                    'text': 'Requests per minute',
+                    'type': int,
+                    'label_width': 150,
+                    'minimum': 0,
+                    'maximum': 1000000,
+                    'step': 10,
+                    'row_key': 'G',
+                    'tooltip': 'The max requests a minute to this API, shared by all members and workflows. 0 is unlimited',
+                    'default': 0,
+                },
+                {
+                    'text': 'Tokens per minute',
+                    'type': int,
+                    'label_width': 140,
+                    'minimum': 0,
+                    'maximum': 100000000,
+                    'step': 1000,
+                    'row_key': 'G',
+                    'tooltip': 'The max prompt and completion tokens a minute to this API. 0 is unlimited',
+                    'default': 0,
+                },
+                {
+                    'text': 'Max in flight',
+                    'type': int,
+                    'label_width': 150,
+                    'minimum': 0,
+                    'maximum': 10000,
+                    'step': 1,
+                    'tooltip': 'The max requests running at once to this API, the rest queue. 0 is unlimited',
+                    'default': 0,
+                },
             ]
 
     class ChatModelParameters(ConfigFields):
@@ -408,6 +533,44 @@ class LitellmProvider(Provider):
                     'maximum': 999999,
                     'step': 1,
                     'default': 100,
+                    'row_key': 'C',
+                },
+                {
+                    'text': 'Cache responses',
+                    'type': bool,
+                    'label_width': 140,
+                    'tooltip': 'Replay the saved response of an identical request instead of calling the API again',
+                    'default': False,
+                    'row_key': 'C',
+                },
+                {
+                    'text': 'Prompt caching',
+                    'type': bool,
+                    'label_width': 125,
+                    'tooltip': 'Mark the system message and conversation as a cacheable prefix, for providers with prompt caching',
+                    'default': False,
+                },
+                {
+                    'text': 'Input cost',
+                    'type': float,
+                    'label_width': 125,
+                    'minimum': 0.0,
+                    'maximum': 1000.0,
+                    'step': 0.05,
+                    'tooltip': 'USD per million prompt tokens, overrides the known price of the model',
+                    'default': 0.0,
+                    'row_key': 'D',
+                },
+                {
+                    'text': 'Output cost',
+                    'type': float,
+                    'label_width': 140,
+                    'minimum': 0.0,
+                    'maximum': 1000.0,
+                    'step': 0.05,
+                    'tooltip': 'USD per million completion tokens',
+                    'default': 0.0,
+                    'row_key': 'D',
                 },
             ]
 
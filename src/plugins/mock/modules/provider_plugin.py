@@ -0,0 +1,492 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+import json
+import random
+import re
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from src.gui.config import ConfigFields
+from src.utils import sql
+from src.utils.helpers import convert_model_json_to_obj, convert_to_safe_case
+from src.utils.llm_cache import ResponseObject
+from src.utils.prompt_cache import strip_cache_control
+from src.system.providers import Provider
+
+
+MAX_CACHED_PREFIXES = 1024
+MOCK_MODELS = {
+    'Mock echo': {'model_name': 'echo'},
+    'Mock slow': {'model_name': 'slow', 'time_to_first_token': 0.5, 'tokens_per_second': 20.0},
+}
+
+
+class MockProviderError(Exception):
+    def __init__(self, message: str, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def split_tokens(text: str) -> List[str]:
+    """Splits text into word tokens that join back into the same text"""
+    return re.findall(r'\s+|\S+\s*', text)
+
+
+def count_prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+    from src.utils.messages import count_tokens
+    return sum(count_tokens(m['content'] if isinstance(m.get('content'), str) else json.dumps(m.get('content'))) for m in messages)
+
+
+def add_mock_api() -> int:
+    """
+    Adds a Mock API with the `MOCK_MODELS` to the database if it has none, and returns its id.
+    It isn't shipped, so tests and benchmarks add it to their own database before loading the providers.
+    """
+    api_id = sql.get_scalar("SELECT id FROM apis WHERE provider_plugin = 'mock'")
+    if api_id:
+        return api_id
+    api_id = sql.execute("""
+        INSERT INTO apis (name, provider_plugin, config) VALUES ('Mock', 'mock', '{}')""")
+    for model_name, model_config in MOCK_MODELS.items():
+        sql.execute("""
+            INSERT INTO models (api_id, name, kind, config) VALUES (?, ?, 'CHAT', ?)""",
+                    (api_id, model_name, json.dumps(model_config)))
+    return api_id
+
+
+class MockProvider(Provider):
+    """
+    A local provider with deterministic responses, for tests, benchmarks and working offline.
+    Streams the same chunk format as litellm, so the members consume it exactly like a real model.
+    The response is the `Response` parameter with `{input}` replaced by the last message, or the last message if it's empty.
+    """
+    def __init__(self, parent, api_id=None):
+        super().__init__(parent=parent)
+        self.visible_tabs = ['Chat']
+        self.cached_prefixes = OrderedDict()  # hashes of the prompt prefixes in the mock prompt cache, oldest first
+
+    def get_model(self, model_obj):
+        kind, model_name = model_obj.get('kind'), model_obj.get('model_name')
+        return self.models.get((kind, model_name), {})
+
+    def get_model_parameters(self, model_obj, incl_api_data=True):
+        return dict(self.get_model(model_obj))
+
+    def get_model_context_window(self, model_obj):
+        return self.get_params(model_obj).get('context_window') or None
+
+    def get_params(self, model_obj) -> Dict[str, Any]:
+        model_obj = convert_model_json_to_obj(model_obj)
+        return {**self.get_model(model_obj), **model_obj.get('model_params', {})}
+
+    def get_response(self, params: Dict[str, Any], messages: List[Dict[str, Any]]) -> str:
+        last_message = next((m for m in reversed(messages) if isinstance(m.get('content'), str)), {}).get('content', '')
+        response = params.get('response') or '{input}'
+        return response.replace('{input}', last_message).replace('{count}', str(len(messages)))
+
+    def get_tool_calls(self, params: Dict[str, Any], tools: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        tool_name = params.get('tool_call')
+        if not tool_name or not tools:
+            return []
+        tool_name = convert_to_safe_case(tool_name)
+        if not any(tool['function']['name'] == tool_name for tool in tools):
+            return []  # a model only calls the tools it's given
+        return [{'id': f'call_{uuid.uuid4().hex[:24]}', 'name': tool_name, 'arguments': params.get('tool_arguments') or '{}'}]
+
+    def get_error(self, params: Dict[str, Any], messages: List[Dict[str, Any]]) -> Optional[Exception]:
+        """Returns the error to inject into this call, `Error rate` errors are seeded by the prompt so a rerun fails the same calls"""
+        error_rate = params.get('error_rate') or 0.0
+        if not params.get('error') and error_rate <= 0.0:
+            return None
+        if error_rate > 0.0:
+            seed = hashlib.sha1(f"{params.get('seed', 0)}:{json.dumps(messages)}".encode('utf-8')).hexdigest()
+            if random.Random(seed).random() >= error_rate:
+                return None
+
+        message = params.get('error') or 'Injected mock error'
+        error_type = params.get('error_type', 'Server')
+        if error_type == 'Timeout':
+            return TimeoutError(message)
+        if error_type == 'Connection':
+            return ConnectionError(message)
+        if error_type == 'Rate limit':
+            return MockProviderError(message, status_code=429, retry_after=params.get('retry_after') or None)
+        return MockProviderError(message, status_code=500)
+
+    async def run_model(self, model_obj, **kwargs):
+        model_obj = convert_model_json_to_obj(model_obj)
+        params = self.get_params(model_obj)
+        marked_messages = kwargs.get('messages', [])
+        messages = [strip_cache_control(msg) for msg in marked_messages]
+
+        text = self.get_response(params, messages)
+        tool_calls = self.get_tool_calls(params, kwargs.get('tools'))
+        error = self.get_error(params, messages)
+        error_after = params.get('error_after', 0)
+        if error is not None and error_after <= 0:
+            await asyncio.sleep(params.get('time_to_first_token', 0.0))
+            raise error
+
+        usage = ResponseObject(prompt_tokens=count_prompt_tokens(messages))
+        if params.get('prompt_caching'):
+            usage.update(self.get_prompt_cache_usage(marked_messages))
+        chunk_info = {
+            'id': f'chatcmpl-{uuid.uuid4()}',
+            'created': int(time.time()),
+            'model': model_obj['model_name'],
+        }
+        if not kwargs.get('stream', True):
+            return await self.complete(params, text, tool_calls, error, usage, chunk_info)
+        return self.stream(params, text, tool_calls, error, usage, chunk_info)
+
+    def get_prompt_cache_usage(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Reads the longest cached prefix of the messages and caches the prefixes up to each breakpoint, like a provider's prompt cache.
+        A prefix only matches if every message in it is byte-identical to the cached one.
+        """
+        prefix_hash = hashlib.sha1()
+        prefix_tokens, hit_tokens, write_tokens = 0, 0, 0
+        for msg in messages:
+            plain_msg = strip_cache_control(msg)
+            prefix_hash.update(json.dumps(plain_msg, sort_keys=True).encode('utf-8'))
+            prefix_tokens += count_prompt_tokens([plain_msg])
+            prefix_key = prefix_hash.hexdigest()
+            if prefix_key in self.cached_prefixes:
+                self.cached_prefixes.move_to_end(prefix_key)
+                hit_tokens = prefix_tokens
+            elif plain_msg is not msg:  # a breakpoint
+                self.cached_prefixes[prefix_key] = True
+                write_tokens = prefix_tokens - hit_tokens
+        while len(self.cached_prefixes) > MAX_CACHED_PREFIXES:
+            self.cached_prefixes.popitem(last=False)
+        return {
+            'prompt_tokens_details': ResponseObject(cached_tokens=hit_tokens),
+            'cache_creation_input_tokens': write_tokens,
+        }
+
+    async def complete(self, params, text, tool_calls, error, usage, chunk_info):
+        await asyncio.sleep(params.get('time_to_first_token', 0.0) + self.get_generation_time(params, len(split_tokens(text))))
+        if error is not None:
+            raise error
+        from src.utils.messages import count_tokens
+        usage['completion_tokens'] = count_tokens(text)
+        usage['total_tokens'] = usage.prompt_tokens + usage.completion_tokens
+        message = ResponseObject(role='assistant', content=text, tool_calls=[
+            ResponseObject(id=t['id'], type='function', function=ResponseObject(name=t['name'], arguments=t['arguments']))
+            for t in tool_calls
+        ] or None)
+        return ResponseObject(**chunk_info, object='chat.completion', usage=usage, choices=[
+            ResponseObject(index=0, message=message, finish_reason='tool_calls' if tool_calls else 'stop'),
+        ])
+
+    def get_generation_time(self, params: Dict[str, Any], token_count: int) -> float:
+        tokens_per_second = params.get('tokens_per_second', 0.0)
+        return token_count / tokens_per_second if tokens_per_second > 0 else 0.0
+
+    async def stream(self, params, text, tool_calls, error, usage, chunk_info):
+        def chunk(finish_reason=None, **delta):
+            return ResponseObject(**chunk_info, object='chat.completion.chunk', choices=[
+                ResponseObject(index=0, delta=ResponseObject(delta), finish_reason=finish_reason),
+            ])
+
+        # the deltas a real model streams: content tokens, then each tool call's name followed by its arguments in pieces
+        deltas = [{'role': 'assistant', 'content': token} if i == 0 else {'content': token}
+                  for i, token in enumerate(split_tokens(text))]
+        for index, tool_call in enumerate(tool_calls):
+            deltas.append({'tool_calls': [ResponseObject(index=index, id=tool_call['id'], type='function',
+                                                         function=ResponseObject(name=tool_call['name'], arguments=''))]})
+            for argument_token in split_tokens(tool_call['arguments']) or ['']:
+                deltas.append({'tool_calls': [ResponseObject(index=index, id=None, type=None,
+                                                             function=ResponseObject(name=None, arguments=argument_token))]})
+
+        # sleeps until each token is due, so slow event loop turns don't add up
+        start_time = time.perf_counter() + params.get('time_to_first_token', 0.0)
+        error_after = params.get('error_after', 0)
+        for i, delta in enumerate(deltas):
+            if error is not None and i >= error_after:
+                raise error
+            await asyncio.sleep(max(start_time + self.get_generation_time(params, i) - time.perf_counter(), 0.0))
+            yield chunk(**delta)
+        if error is not None:
+            raise error
+
+        from src.utils.messages import count_tokens
+        usage['completion_tokens'] = count_tokens(text)
+        usage['total_tokens'] = usage.prompt_tokens + usage.completion_tokens
+        final_chunk = chunk(finish_reason='tool_calls' if tool_calls else 'stop')
+        final_chunk['usage'] = usage
+        yield final_chunk
+
+    def get_structured_response(self, params: Dict[str, Any], messages: List[Dict[str, Any]]) -> str:
+        if params.get('structured_response'):
+            return params['structured_response']
+        text = self.get_response(params, messages)
+        type_defaults = {'str': text, 'int': 0, 'float': 0.0, 'bool': False}
+        structured_data = params.get('structure.data', [])
+        return json.dumps({convert_to_safe_case(attr['attribute']): type_defaults.get(attr['type']) for attr in structured_data})
+
+    async def get_structured_output(self, model_obj, **kwargs):
+        model_obj = convert_model_json_to_obj(model_obj)
+        params = self.get_params(model_obj)
+        messages = kwargs.get('messages', [])
+        await asyncio.sleep(params.get('time_to_first_token', 0.0))
+        error = self.get_error(params, messages)
+        if error is not None:
+            raise error
+        return self.get_structured_response(params, messages)
+
+    async def stream_structured_output(self, model_obj, **kwargs):
+        """Streams the structured response JSON in tokens, at the speed of a streamed response"""
+        model_obj = convert_model_json_to_obj(model_obj)
+        params = self.get_params(model_obj)
+        messages = kwargs.get('messages', [])
+        error = self.get_error(params, messages)
+        if error is not None and params.get('error_after', 0) <= 0:
+            await asyncio.sleep(params.get('time_to_first_token', 0.0))
+            raise error
+        return self.stream_structured_response(params, self.get_structured_response(params, messages), error)
+
+    async def stream_structured_response(self, params, response, error):
+        start_time = time.perf_counter() + params.get('time_to_first_token', 0.0)
+        error_after = params.get('error_after', 0)
+        for i, token in enumerate(split_tokens(response)):
+            if error is not None and i >= error_after:
+                raise error
+            await asyncio.sleep(max(start_time + self.get_generation_time(params, i) - time.perf_counter(), 0.0))
+            yield token
+        if error is not None:
+            raise error
+
+    async def get_scalar_async(self, prompt, single_line=False, num_lines=0, model_obj=None):
+        response = await self.run_model(model_obj=model_obj, messages=[{'role': 'user', 'content': prompt}], stream=False)
+        output = response.choices[0]['message']['content']
+        if single_line:
+            num_lines = 1
+        if num_lines > 0:
+            output = '\n'.join(output.split('\n')[:num_lines])
+        return output
+
+    def get_scalar(self, prompt, single_line=False, num_lines=0, model_obj=None):
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(self.get_scalar_async(prompt, single_line, num_lines, model_obj))
+
+    class ChatConfig(ConfigFields):
+        def __init__(self, parent):
+            super().__init__(parent=parent)
+            self.label_width = 125
+            self.schema = [
+                {
+                    'text': 'Requests per minute',
+                    'type': int,
+                    'label_width': 150,
+                    'minimum': 0,
+                    'maximum': 1000000,
+                    'step': 10,
+                    'row_key': 'A',
+                    'tooltip': 'The max requests a minute to this API, shared by all members and workflows. 0 is unlimited',
+                    'default': 0,
+                },
+                {
+                    'text': 'Tokens per minute',
+                    'type': int,
+                    'label_width': 140,
+                    'minimum': 0,
+                    'maximum': 100000000,
+                    'step': 1000,
+                    'row_key': 'A',
+                    'tooltip': 'The max prompt and completion tokens a minute to this API. 0 is unlimited',
+                    'default': 0,
+                },
+                {
+                    'text': 'Max in flight',
+                    'type': int,
+                    'label_width': 150,
+                    'minimum': 0,
+                    'maximum': 10000,
+                    'step': 1,
+                    'tooltip': 'The max requests running at once to this API, the rest queue. 0 is unlimited',
+                    'default': 0,
+                },
+            ]
+
+    class ChatModelParameters(ConfigFields):
+        def __init__(self, parent):
+            super().__init__(parent=parent)
+            self.parent = parent
+            self.schema = [
+                {
+                    'text': 'Model name',
+                    'type': str,
+                    'label_width': 125,
+                    'width': 265,
+                    'tooltip': 'Any name, the mock model behaves the same',
+                    'default': '',
+                },
+                {
+                    'text': 'Response',
+                    'type': str,
+                    'label_width': 125,
+                    'width': 265,
+                    'num_lines': 3,
+                    'tooltip': 'The scripted response, {input} is the last message. Empty echoes the last message',
+                    'default': '',
+                },
+                {
+                    'text': 'Time to first token',
+                    'type': float,
+                    'label_width': 125,
+                    'minimum': 0.0,
+                    'maximum': 600.0,
+                    'step': 0.1,
+                    'tooltip': 'Seconds before the first chunk',
+                    'default': 0.0,
+                    'row_key': 'A',
+                },
+                {
+                    'text': 'Tokens per second',
+                    'type': float,
+                    'label_width': 140,
+                    'minimum': 0.0,
+                    'maximum': 100000.0,
+                    'step': 10.0,
+                    'tooltip': 'The speed the response streams at, 0 streams it all at once',
+                    'default': 0.0,
+                    'row_key': 'A',
+                },
+                {
+                    'text': 'Tool call',
+                    'type': str,
+                    'label_width': 125,
+                    'width': 118,
+                    'tooltip': 'The name of a tool to call after the response, when the member has it',
+                    'default': '',
+                    'row_key': 'B',
+                },
+                {
+                    'text': 'Tool arguments',
+                    'type': str,
+                    'label_width': 140,
+                    'width': 118,
+                    'tooltip': 'The JSON arguments of the tool call',
+                    'default': '{}',
+                    'row_key': 'B',
+                },
+                {
+                    'text': 'Structured response',
+                    'type': str,
+                    'label_width': 125,
+                    'width': 265,
+                    'tooltip': 'The JSON returned for structured output, empty fills the structure with defaults',
+                    'default': '',
+                },
+                {
+                    'text': 'Error',
+                    'type': str,
+                    'label_width': 125,
+                    'width': 118,
+                    'tooltip': 'The message of an injected error, empty injects no errors unless an error rate is set',
+                    'default': '',
+                    'row_key': 'C',
+                },
+                {
+                    'text': 'Error type',
+                    'type': ('Server', 'Rate limit', 'Timeout', 'Connection',),
+                    'label_width': 140,
+                    'default': 'Server',
+                    'row_key': 'C',
+                },
+                {
+                    'text': 'Error after',
+                    'type': int,
+                    'label_width': 125,
+                    'minimum': 0,
+                    'maximum': 999999,
+                    'step': 1,
+                    'tooltip': 'The number of chunks streamed before the error, 0 fails the request',
+                    'default': 0,
+                    'row_key': 'D',
+                },
+                {
+                    'text': 'Error rate',
+                    'type': float,
+                    'label_width': 140,
+                    'minimum': 0.0,
+                    'maximum': 1.0,
+                    'step': 0.05,
+                    'tooltip': 'The share of requests that fail, picked by the prompt and seed so reruns fail the same ones',
+                    'default': 0.0,
+                    'row_key': 'D',
+                },
+                {
+                    'text': 'Retry after',
+                    'type': float,
+                    'label_width': 125,
+                    'minimum': 0.0,
+                    'maximum': 600.0,
+                    'step': 0.5,
+                    'tooltip': 'The seconds a rate limit error asks to wait, 0 sends no retry-after hint',
+                    'default': 0.0,
+                },
+                {
+                    'text': 'Seed',
+                    'type': int,
+                    'label_width': 125,
+                    'minimum': 0,
+                    'maximum': 999999,
+                    'step': 1,
+                    'default': 0,
+                    'row_key': 'E',
+                },
+                {
+                    'text': 'Context window',
+                    'type': int,
+                    'label_width': 140,
+                    'minimum': 0,
+                    'maximum': 10000000,
+                    'step': 1000,
+                    'tooltip': 'The max input tokens, 0 is unknown',
+                    'default': 0,
+                    'row_key': 'E',
+                },
+                {
+                    'text': 'Cache responses',
+                    'type': bool,
+                    'label_width': 125,
+                    'tooltip': 'Replay the saved response of an identical request',
+                    'default': False,
+                    'row_key': 'F',
+                },
+                {
+                    'text': 'Prompt caching',
+                    'type': bool,
+                    'label_width': 140,
+                    'tooltip': 'Report the prompt tokens read from a prefix cache, like a provider with prompt caching',
+                    'default': False,
+                    'row_key': 'F',
+                },
+                {
+                    'text': 'Input cost',
+                    'type': float,
+                    'label_width': 125,
+                    'minimum': 0.0,
+                    'maximum': 1000.0,
+                    'step': 0.05,
+                    'tooltip': 'USD per million prompt tokens',
+                    'default': 0.0,
+                    'row_key': 'G',
+                },
+                {
+                    'text': 'Output cost',
+                    'type': float,
+                    'label_width': 140,
+                    'minimum': 0.0,
+                    'maximum': 1000.0,
+                    'step': 0.05,
+                    'tooltip': 'USD per million completion tokens',
+                    'default': 0.0,
+                    'row_key': 'G',
+                },
+            ]
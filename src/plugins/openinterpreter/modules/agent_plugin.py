@@ -7,7 +7,6 @@ from src.members.agent import AgentSettings, Agent
 # from interpreter.core.core import OpenInterpreter
 # from plugins.openinterpreter.src.core.core import OpenInterpreter
 # from interpreter import OpenInterpreter
-from src.plugins.openinterpreter.src import OpenInterpreter
 from src.utils.helpers import split_lang_and_code, convert_model_json_to_obj
 
 
@@ -34,6 +33,7 @@ class Open_Interpreter(Agent):
             'code_output_sender': self.config.get('code.code_output_sender', 'user'),
             'import_skills': False,
         }
+        from src.plugins.openinterpreter.src import OpenInterpreter  # slow to import
         self.agent_object = OpenInterpreter(**param_dict)
         # print('## Loaded OpenInterpreter obj')
 
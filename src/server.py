@@ -0,0 +1,213 @@
+"""
+Serves agents and workflows over HTTP to other local processes, many contexts share one process and event loop.
+
+    python -m src.server --port 8765
+
+    GET    /workflows                      the agents and workflows
+    POST   /contexts {"target": ...}       starts a context, returns its id
+    POST   /contexts/{id}/messages         sends {"message": ...}, the response is streamed from /events
+    GET    /contexts/{id}/events           streams the response as server-sent events
+    DELETE /contexts/{id}                  stops and removes a context
+    WS     /contexts/{id}/ws               sends {"message": ...} and receives the events of each response
+
+Events are the same JSON objects as the `--format jsonl` output of src.cli.
+The events of a response wait in a bounded queue, when a client reads slower than the model writes the workflow pauses.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+
+from src.cli import get_entity_config
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_MAX_QUEUED_EVENTS = 64  # per context, a full queue pauses the workflow until the client catches up
+
+
+class ServerContext:
+    def __init__(self, workflow, max_queued_events: int):
+        self.id = uuid.uuid4().hex
+        self.workflow = workflow
+        self.events: asyncio.Queue = asyncio.Queue(maxsize=max_queued_events)
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def send(self, message: str):
+        """Starts a response to `message`, its events are put on the queue"""
+        self.task = asyncio.create_task(self.respond(message))
+
+    async def respond(self, message: str):
+        first_member = next(iter(self.workflow.members.values()), None)
+        try:
+            if first_member is None:
+                raise ValueError('The workflow has no members')
+            self.workflow.save_message('user', message, member_id=first_member.member_id)
+            async for key, chunk in self.workflow.behaviour.receive(from_member_id=first_member.member_id):
+                if chunk:
+                    await self.events.put({'type': 'chunk', 'role': key, 'content': chunk})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self.events.put({'type': 'error', 'message': str(e) or e.__class__.__name__})
+            return
+        await self.events.put({'type': 'done', 'context_id': self.workflow.context_id})
+
+    async def stream_events(self):
+        """Yields the events of the current response, a client that disconnects can stream the rest again"""
+        while True:
+            if not self.events.empty():
+                event = self.events.get_nowait()
+            elif self.running:
+                get_event = asyncio.ensure_future(self.events.get())
+                done, _ = await asyncio.wait({get_event, self.task}, return_when=asyncio.FIRST_COMPLETED)
+                if get_event not in done:
+                    get_event.cancel()
+                    continue
+                event = get_event.result()
+            else:
+                return
+            yield event
+            if event['type'] in ('done', 'error'):
+                return
+
+    async def close(self):
+        if self.running:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+
+def create_app(persist: bool = False, max_queued_events: int = DEFAULT_MAX_QUEUED_EVENTS) -> FastAPI:
+    from src.utils import sql
+    from src.members.workflow import Workflow
+
+    contexts: Dict[str, ServerContext] = {}
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        yield
+        for context in list(contexts.values()):
+            await context.close()
+        contexts.clear()
+
+    app = FastAPI(title='AgentPilot', lifespan=lifespan)
+    app.state.contexts = contexts
+
+    def get_context(context_id: str) -> ServerContext:
+        context = contexts.get(context_id)
+        if context is None:
+            raise HTTPException(status_code=404, detail=f"No context '{context_id}'")
+        return context
+
+    @app.get('/workflows')
+    async def list_workflows():
+        rows = sql.get_results("SELECT id, name, kind FROM entities ORDER BY id")
+        return [{'id': entity_id, 'name': name, 'kind': kind} for entity_id, name, kind in rows]
+
+    @app.post('/contexts')
+    async def start_context(payload: Dict[str, Any]):
+        target = str(payload.get('target', ''))
+        config = get_entity_config(target) if target else None
+        if config is None:
+            raise HTTPException(status_code=404, detail=f"No agent or workflow named '{target}'")
+        workflow = Workflow(config=config, kind='CHAT', chat_title=target, persist=payload.get('persist', persist))
+        context = ServerContext(workflow, max_queued_events)
+        contexts[context.id] = context
+        return {'id': context.id, 'context_id': workflow.context_id}
+
+    @app.post('/contexts/{context_id}/messages', status_code=202)
+    async def send_message(context_id: str, payload: Dict[str, Any]):
+        context = get_context(context_id)
+        message = payload.get('message')
+        if not isinstance(message, str) or not message.strip():
+            raise HTTPException(status_code=400, detail='No message')
+        if context.running:
+            raise HTTPException(status_code=409, detail='The context is still responding')
+        context.send(message)
+        return {'id': context.id}
+
+    @app.get('/contexts/{context_id}/events')
+    async def stream_response(context_id: str):
+        context = get_context(context_id)
+
+        async def sse():
+            async for event in context.stream_events():
+                yield f'data: {json.dumps(event)}\n\n'
+
+        return StreamingResponse(sse(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    @app.delete('/contexts/{context_id}')
+    async def delete_context(context_id: str):
+        context = get_context(context_id)
+        del contexts[context_id]
+        await context.close()
+        return {'id': context_id}
+
+    @app.websocket('/contexts/{context_id}/ws')
+    async def websocket_endpoint(websocket: WebSocket, context_id: str):
+        await websocket.accept()
+        context = contexts.get(context_id)
+        if context is None:
+            await websocket.close(code=4404, reason=f"No context '{context_id}'")
+            return
+        try:
+            while True:
+                payload = await websocket.receive_json()
+                message = payload.get('message')
+                if context.running or not isinstance(message, str) or not message.strip():
+                    await websocket.send_json({'type': 'error', 'message': 'No message' if not context.running else 'The context is still responding'})
+                    continue
+                context.send(message)
+                async for event in context.stream_events():
+                    await websocket.send_json(event)
+        except WebSocketDisconnect:
+            pass
+
+    return app
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m src.server', description='Serve agents and workflows over HTTP.')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='The host to listen on, only local processes can connect by default')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='The port to listen on')
+    parser.add_argument('--db', help='The database file, defaults to the data.db of the application')
+    parser.add_argument('--persist', action='store_true', help='Save new contexts as chats')
+    parser.add_argument('--max-queued-events', type=int, default=DEFAULT_MAX_QUEUED_EVENTS,
+                        help='The events a context buffers for a slow client before its workflow pauses')
+    return parser
+
+
+def main(argv=None) -> int:
+    args = get_parser().parse_args(argv)
+    os.environ.setdefault('LITELLM_LOG', 'ERROR')
+    from src.utils import sql
+    sql.set_db_filepath(args.db)
+    if sql.check_database_upgrade():
+        print('Error: The database needs upgrading, open it with the app first', file=sys.stderr)
+        return 1
+
+    from src.system.base import manager
+    manager.load()
+    manager.initialize_custom_managers()
+    app = create_app(persist=args.persist, max_queued_events=args.max_queued_events)
+    # workflows run nested event loops, which uvloop doesn't support
+    uvicorn.run(app, host=args.host, port=args.port, loop='asyncio', log_level='warning')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
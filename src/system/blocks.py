@@ -1,45 +1,175 @@
 import asyncio
+import copy
 import json
 import re
+import time
+from functools import lru_cache
+from typing import Dict, List, Set, Tuple
 
 from PySide6.QtWidgets import QMessageBox
 
 from src.utils import sql
 from src.utils.helpers import receive_workflow, display_message
 
+NESTABLE_BLOCK_TYPES = ('Text', 'Prompt')
+
+
+@lru_cache(maxsize=1024)
+def compile_template(content: str) -> Tuple[Tuple[bool, str], ...]:
+    """Splits a template into ((is_placeholder, text), ...) segments, placeholders are `{name}`"""
+    segments = []
+    last_end = 0
+    for match in re.finditer(r'\{(.+?)\}', content):
+        if match.start() > last_end:
+            segments.append((False, content[last_end:match.start()]))
+        segments.append((True, match.group(1)))
+        last_end = match.end()
+    if last_end < len(content):
+        segments.append((False, content[last_end:]))
+    return tuple(segments)
+
+
+def get_template_placeholders(content: str) -> List[str]:
+    return list(dict.fromkeys(text for is_placeholder, text in compile_template(content) if is_placeholder))
+
 
 class BlockManager:
     def __init__(self, parent):
         self.parent = parent
         self.blocks = {}
+        self.block_configs = {}  # {name: config json}, to find the blocks changed by a reload
+        self.dependencies: Dict[str, Set[str]] = {}  # {name: placeholders in its templates}
+        self.acyclic_blocks: Set[str] = set()
 
-        self.prompt_cache = {}  # dict((prompt, model_obj): response)
+        self.block_cache = {}  # {name: output} of deterministic blocks
+        self.prompt_cache = {}  # {(prompt, model_json): (expires_at, response)}
 
     def load(self):
-        self.blocks = sql.get_results("""
+        block_configs = sql.get_results("""
             SELECT
                 name,
                 config
             FROM blocks""", return_type='dict')
-        self.blocks = {k: json.loads(v) for k, v in self.blocks.items()}
+        changed_blocks = {name for name in set(block_configs) | set(self.block_configs)
+                          if block_configs.get(name) != self.block_configs.get(name)}
+
+        self.block_configs = block_configs
+        self.blocks = {k: json.loads(v) for k, v in block_configs.items()}
+        self.dependencies = {name: self.get_config_dependencies(config) for name, config in self.blocks.items()}
+        self.acyclic_blocks = set()
+        self.invalidate(changed_blocks)
 
     def to_dict(self):
         return self.blocks
 
-    async def receive_block(self, name, params=None):
-        self.load()  # todo temp, find out why model_params getting reset
-        wf_config = self.blocks[name]
+    def get_config_dependencies(self, config) -> Set[str]:
+        """Returns the placeholders used by the nestable blocks of a block config, including workflow members"""
+        if config.get('_TYPE') == 'workflow':
+            dependencies = set()
+            for member in config.get('members', []):
+                dependencies |= self.get_config_dependencies(member.get('config', {}))
+            return dependencies
+        if config.get('_TYPE') == 'block' and config.get('block_type', 'Text') in NESTABLE_BLOCK_TYPES:
+            return set(get_template_placeholders(config.get('data', '')))
+        return set()
+
+    def invalidate(self, names):
+        """Clears the cached output of the blocks and every block that references them"""
+        dependents = {}  # {name: blocks referencing it}
+        for name, dependencies in self.dependencies.items():
+            for dependency in dependencies:
+                dependents.setdefault(dependency, set()).add(name)
+
+        pending = list(names)
+        invalidated = set()
+        while pending:
+            name = pending.pop()
+            if name in invalidated:
+                continue
+            invalidated.add(name)
+            self.block_cache.pop(name, None)
+            pending.extend(dependents.get(name, ()))
+
+    def check_cycles(self, name):
+        """Raises a RecursionError if the block references itself through its nested blocks"""
+        if name in self.acyclic_blocks:
+            return
+        path = []
+
+        def visit(block_name):
+            if block_name in self.acyclic_blocks:
+                return
+            if block_name in path:
+                cycle = path[path.index(block_name):] + [block_name]
+                raise RecursionError(f"Circular reference detected in blocks: {' -> '.join(cycle)}")
+            path.append(block_name)
+            for dependency in self.dependencies.get(block_name, ()):
+                if dependency in self.blocks:
+                    visit(dependency)
+            path.pop()
+            self.acyclic_blocks.add(block_name)
+
+        visit(name)
+
+    def is_deterministic(self, name) -> bool:
+        """Text blocks that only reference other deterministic blocks always produce the same output"""
+        config = self.blocks.get(name, {})
+        if config.get('_TYPE') != 'block' or config.get('block_type', 'Text') != 'Text':
+            return False
+        return all(self.is_deterministic(dependency) for dependency in self.dependencies.get(name, ()) if dependency in self.blocks)
+
+    async def receive_block(self, name, params=None, prompt=None):
+        """Runs a block's workflow, a prompt block runs `prompt` instead of formatting its data again, if given"""
+        wf_config = copy.deepcopy(self.blocks[name])  # running a workflow can modify its config
+        if prompt is not None:
+            wf_config['data'] = prompt
+            wf_config['_data_formatted'] = True
         async for key, chunk in receive_workflow(wf_config, kind='BLOCK', params=params, chat_title=name, main=self.parent._main_gui):
             yield key, chunk
 
-    async def compute_block_async(self, name, params=None):
+    async def compute_block_async(self, name, params=None, prompt=None):
         response = ''
-        async for key, chunk in self.receive_block(name, params=params):
+        async for key, chunk in self.receive_block(name, params=params, prompt=prompt):
             response += chunk
         return response
 
     def compute_block(self, name, params=None):  # , visited=None, ):
-        return asyncio.run(self.compute_block_async(name, params))
+        self.check_cycles(name)
+        if not params and name in self.block_cache:
+            return self.block_cache[name]
+
+        config = self.blocks[name]
+        block_type = config.get('block_type', 'Text') if config.get('_TYPE') == 'block' else None
+        if block_type == 'Text':
+            # Text blocks only format their data, no need for a workflow
+            response = self.format_string(config.get('data', ''), additional_blocks=params)
+        elif block_type == 'Prompt':
+            response = self.compute_prompt_block(name, params)
+        else:
+            response = asyncio.run(self.compute_block_async(name, params))
+
+        if not params and self.is_deterministic(name):
+            self.block_cache[name] = response
+        return response
+
+    def compute_prompt_block(self, name, params=None):
+        """Runs a prompt block, reusing its response for the same prompt and model for `cache_ttl` seconds if the block sets it"""
+        config = self.blocks[name]
+        prompt = self.format_string(config.get('data', ''), additional_blocks=params)
+        cache_ttl = config.get('cache_ttl', 0)
+        if not cache_ttl:
+            return asyncio.run(self.compute_block_async(name, params, prompt=prompt))
+
+        cache_key = (prompt, json.dumps(config.get('prompt_model'), sort_keys=True))
+        now = time.monotonic()
+        expires_at, response = self.prompt_cache.get(cache_key, (0, None))
+        if expires_at > now:
+            return response
+
+        response = asyncio.run(self.compute_block_async(name, params, prompt=prompt))  # the prompt the key was made from
+        self.prompt_cache = {k: v for k, v in self.prompt_cache.items() if v[0] > now}
+        self.prompt_cache[cache_key] = (now + cache_ttl, response)
+        return response
 
     def format_string(self, content, ref_workflow=None, additional_blocks=None):  # , ref_config=None):
         all_params = {}
@@ -60,27 +190,20 @@ class BlockManager:
             all_params.update(additional_blocks)
 
         try:
-            # Recursively process placeholders
-            placeholders = re.findall(r'\{(.+?)\}', content)
-
-            visited = set()
-
-            # Process each placeholder  todo clean duplicate code
-            for placeholder in placeholders:
+            replacements = {}
+            for placeholder in get_template_placeholders(content):
                 if placeholder in self.blocks:
-                    replacement = self.compute_block(placeholder)
-                    content = content.replace(f'{{{placeholder}}}', replacement)
+                    replacements[placeholder] = self.compute_block(placeholder)
                 elif placeholder in all_params:
-                    replacement = all_params[placeholder]
-                    content = content.replace(f'{{{placeholder}}}', replacement)
-                else:
-                    # Leave content unchanged
-                    pass
-
-            # for key, text in all_params.items():
-            #     content = content.replace(f'{{{key}}}', text)
-
-            return content
+                    replacements[placeholder] = all_params[placeholder]
+                # else leave the placeholder unchanged
+
+            if not replacements:
+                return content
+            return ''.join(
+                replacements.get(text, f'{{{text}}}') if is_placeholder else text
+                for is_placeholder, text in compile_template(content)
+            )
 
         except RecursionError as e:
             display_message(self,
@@ -4,15 +4,11 @@ import json
 from PySide6.QtCore import QRunnable
 from PySide6.QtWidgets import QHBoxLayout, QVBoxLayout
 
-from src.plugins.openinterpreter.src import interpreter
 from src.gui.config import ConfigJsonTree, ConfigDBTree, ConfigExtTree, ConfigJoined, ConfigFields, ConfigTabs
 from src.gui.widgets import IconButton, find_main_widget
 from src.utils import sql
 
 
-OI_EXECUTOR = interpreter
-
-
 class EnvironmentManager:
     def __init__(self, parent):
         self.environments = {}  # dict of id: (name, Environment)
@@ -48,6 +44,7 @@ class Environment:
         # self.update(config)
 
     def run_code(self, lang, code, venv_path=None):
+        from src.plugins.openinterpreter.src import interpreter as OI_EXECUTOR  # slow to import
         OI_EXECUTOR.venv_path = venv_path
         oi_res = OI_EXECUTOR.computer.run(lang, code)
         output = next(r for r in oi_res if r['format'] == 'output').get('content', '')
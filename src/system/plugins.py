@@ -9,6 +9,7 @@ from src.plugins.elevenlabs.modules.provider_plugin import ElevenLabsProvider
 # PROVIDER PLUGINS
 from src.plugins.fakeyou.modules.provider_plugin import FakeYouProvider
 from src.plugins.litellm.modules.provider_plugin import LitellmProvider
+from src.plugins.mock.modules.provider_plugin import MockProvider
 
 # AGENT PLUGINS
 from src.plugins.openaiassistant.modules.agent_plugin import OpenAI_Assistant, OAIAssistantSettings
@@ -72,6 +73,7 @@ ALL_PLUGINS = {
         'elevenlabs': ElevenLabsProvider,
         'fakeyou': FakeYouProvider,
         'routellm': RoutellmProvider,
+        'mock': MockProvider,
     },
     'Environment': [
         # E2BEnvironment,
@@ -87,6 +89,7 @@ ALL_PLUGINS = {
     'WorkflowConfig': {
         # 'CrewAI': CrewAI_WorkflowConfig,
     },
+    'VectorDB': {},
     'VectorDBSettings': {}
     # # 'FineTune': [
     # #     OpenAI_Finetune,
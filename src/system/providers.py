@@ -1,9 +1,16 @@
 import json
 import os
 from abc import abstractmethod
+from typing import Optional
 
 from src.utils import sql
+from src.utils.coalesce import coalesce_call, join_stream
 from src.utils.helpers import convert_model_json_to_obj
+from src.utils.llm_cache import get_request_key, get_response_cache, record_stream, replay_stream
+from src.utils.prompt_cache import mark_cache_prefix
+from src.utils.rate_limit import RateLimiter, estimate_request_tokens, get_rate_limiter, run_rate_limited
+from src.utils.retry import CircuitBreaker, get_circuit_breaker
+from src.utils.usage import CHAT_CALL, SCALAR_CALL, STRUCTURED_CALL, CallUsage, record_usage_stream
 
 
 class ProviderManager:
@@ -58,18 +65,161 @@ class ProviderManager:
     def to_dict(self):
         return self.providers
 
+    def get_cache_key(self, model_obj, request) -> Optional[str]:
+        """Returns the response cache key of a request, or None if the model doesn't have `cache_responses` set"""
+        model_config = self.get_model(model_obj) or {}
+        if not {**model_config, **model_obj.get('model_params', {})}.get('cache_responses', False):
+            return None
+        return get_request_key(model_obj, model_config, request)
+
+    def get_api_key(self, model_obj):
+        """Returns the id of the model's API, or its provider and name if it isn't saved under one"""
+        model_obj = convert_model_json_to_obj(model_obj)
+        provider = self.providers.get(model_obj['provider'])
+        model_key = (model_obj.get('kind'), model_obj.get('model_name'))
+        api_id = getattr(provider, 'model_api_ids', {}).get(model_key)
+        return api_id if api_id is not None else (model_obj['provider'], model_obj.get('model_name'))
+
+    def get_rate_limiter(self, model_obj) -> RateLimiter:
+        """Returns the limiter shared by every call to the model's API, with the limits in the API config"""
+        return get_rate_limiter(self.get_api_key(model_obj), self.get_model(model_obj) or {})
+
+    def get_circuit_breaker(self, model_obj) -> CircuitBreaker:
+        """Returns the circuit breaker shared by every call to the model's API"""
+        return get_circuit_breaker(self.get_api_key(model_obj))
+
+    def start_usage(self, model_obj, call_type, kwargs) -> CallUsage:
+        """Starts recording a call's usage, popping the `usage_scope` ({context_id, member_id}) and `on_usage` callback from the request kwargs"""
+        return CallUsage(
+            self.providers.get(model_obj['provider']),
+            model_obj,
+            call_type,
+            scope=kwargs.pop('usage_scope', None),
+            messages=kwargs.get('messages', []),
+            on_usage=kwargs.pop('on_usage', None),
+        )
+
+    async def run_limited(self, model_obj, run, messages, on_wait=None, usage=None):
+        """Runs a provider call within its API's rate limits, `on_wait` is called with the seconds it was queued for"""
+        limiter = self.get_rate_limiter(model_obj)
+        tokens, count_tokens = 0, None
+        if limiter.tokens.per_minute > 0:
+            from src.utils.messages import count_tokens
+            tokens = estimate_request_tokens(messages)
+        response, waited = await run_rate_limited(limiter, run, tokens=tokens, count_tokens=count_tokens)
+        if waited > 0.0:
+            if usage:
+                usage.on_wait(waited)
+            if on_wait:
+                on_wait(waited)
+        return response
+
+    def uses_prompt_caching(self, model_obj) -> bool:
+        model_config = self.get_model(model_obj) or {}
+        return bool({**model_config, **model_obj.get('model_params', {})}.get('prompt_caching', False))
+
     async def run_model(self, model_obj, **kwargs):
         model_obj = convert_model_json_to_obj(model_obj)
         provider = self.providers.get(model_obj['provider'])
-        rr = await provider.run_model(model_obj, **kwargs)
-        return rr
+        on_wait = kwargs.pop('on_wait', None)
+        usage = self.start_usage(model_obj, CHAT_CALL, kwargs)
+        if model_obj.get('kind', 'CHAT') != 'CHAT':
+            usage = None  # eg. speech, which isn't counted in tokens and isn't streamed as chunks
+        if 'messages' in kwargs and hasattr(provider, 'mark_prompt_cache') and self.uses_prompt_caching(model_obj):
+            kwargs['messages'] = provider.mark_prompt_cache(model_obj, kwargs['messages'])
+        stream = kwargs.get('stream', True)
+        cache_key = self.get_cache_key(model_obj, kwargs) if stream else None
+        run = lambda: provider.run_model(model_obj, **kwargs)
+
+        async def open_response():
+            try:
+                if cache_key is None:
+                    response = await self.run_limited(model_obj, run, kwargs.get('messages', []), on_wait, usage)
+                else:
+                    cache = get_response_cache()
+                    cached_response = cache.get(cache_key)
+                    if cached_response is not None:
+                        response = replay_stream(cached_response, model_obj['model_name'])
+                    else:
+                        response = await self.run_limited(model_obj, run, kwargs.get('messages', []), on_wait, usage)
+                        response = record_stream(response, cache, cache_key)
+            except Exception as e:
+                if usage is not None:
+                    usage.finish(e)
+                raise
+
+            if usage is None:
+                return response
+            if stream:
+                return record_usage_stream(response, usage)
+            usage.on_chunk(response)
+            usage.finish()
+            return response
+
+        if usage is None or not stream:
+            return await open_response()
+        return await self.open_coalesced(self.get_flight_key(model_obj, kwargs), open_response, usage)
 
     async def get_structured_output(self, model_obj, **kwargs):
         model_obj = convert_model_json_to_obj(model_obj)
         provider = self.providers.get(model_obj['provider'])
         if not hasattr(provider, 'get_structured_output'):
             return None
-        return await provider.get_structured_output(model_obj, **kwargs)
+        on_wait = kwargs.pop('on_wait', None)
+        usage = self.start_usage(model_obj, STRUCTURED_CALL, kwargs)
+        run = lambda: provider.get_structured_output(model_obj, **kwargs)
+        try:
+            output = await self.run_limited(model_obj, run, kwargs.get('messages', []), on_wait, usage)
+        except Exception as e:
+            usage.finish(e)
+            raise
+        usage.on_chunk(str(output))
+        usage.finish()
+        return output
+
+    async def stream_structured_output(self, model_obj, **kwargs):
+        """Returns a stream of the structured output JSON as it arrives, in one piece if the provider can't stream it"""
+        model_obj = convert_model_json_to_obj(model_obj)
+        provider = self.providers.get(model_obj['provider'])
+        if not hasattr(provider, 'stream_structured_output'):
+            output = await self.get_structured_output(model_obj, **kwargs)
+            return single_chunk_stream(str(output))
+        on_wait = kwargs.pop('on_wait', None)
+        usage = self.start_usage(model_obj, STRUCTURED_CALL, kwargs)
+        run = lambda: provider.stream_structured_output(model_obj, **kwargs)
+
+        async def open_stream():
+            try:
+                stream = await self.run_limited(model_obj, run, kwargs.get('messages', []), on_wait, usage)
+            except Exception as e:
+                usage.finish(e)
+                raise
+            return record_usage_stream(stream, usage)
+
+        request_key = self.get_flight_key(model_obj, {'structured_output': True, **kwargs})
+        return await self.open_coalesced(request_key, open_stream, usage)
+
+    def get_flight_key(self, model_obj, request) -> str:
+        """Returns the key identical requests in flight share, the same one a cached response is saved under"""
+        return get_request_key(model_obj, self.get_model(model_obj) or {}, request)
+
+    async def open_coalesced(self, request_key, open_stream, usage: CallUsage):
+        """
+        Returns a stream shared by the identical requests in flight, so only the first one reaches the provider.
+        A request that joins another is recorded like a response cache hit, as it didn't call the API.
+        """
+        shared, joined = join_stream(request_key, open_stream)
+        if not joined:
+            await shared.wait_opened()  # the request's usage is recorded by `open_stream`
+            return shared.read()
+
+        usage.cache_hit = True
+        try:
+            await shared.wait_opened()
+        except Exception as e:
+            usage.finish(e)
+            raise
+        return record_usage_stream(shared.read(), usage)
 
     def get_model_parameters(self, model_obj, incl_api_data=True):
         model_obj = convert_model_json_to_obj(model_obj)
@@ -78,12 +228,43 @@ class ProviderManager:
             return {}
         return model_provider.get_model_parameters(model_obj, incl_api_data)
 
-    def get_scalar(self, prompt, single_line=False, num_lines=0, model_obj=None):
+    def get_model_context_window(self, model_obj):
+        model_obj = convert_model_json_to_obj(model_obj)
+        model_provider = self.providers.get(model_obj.get('provider'))
+        if not model_provider:
+            return None
+        return model_provider.get_model_context_window(model_obj)
+
+    def get_scalar(self, prompt, single_line=False, num_lines=0, model_obj=None, usage_scope=None):
         model_obj = convert_model_json_to_obj(model_obj)
         provider = self.providers.get(model_obj['provider'])
         if not hasattr(provider, 'get_scalar'):
             return None
-        return provider.get_scalar(prompt, single_line, num_lines, model_obj)
+        usage = CallUsage(provider, model_obj, SCALAR_CALL, scope=usage_scope, messages=[{'role': 'user', 'content': prompt}])
+        request = {'scalar': prompt, 'single_line': single_line, 'num_lines': num_lines}
+        cache_key = self.get_cache_key(model_obj, request)
+        cache = get_response_cache() if cache_key is not None else None
+        cached_response = cache.get(cache_key) if cache is not None else None
+        if cached_response is not None:
+            usage.cache_hit = True
+            output = cached_response['scalar']
+        else:
+            try:
+                # an identical call from another thread, eg. a repeated auto title, waits for this one's result
+                call = lambda: provider.get_scalar(prompt, single_line, num_lines, model_obj)
+                output, usage.cache_hit = coalesce_call(self.get_flight_key(model_obj, request), call)
+            except Exception as e:
+                usage.finish(e)
+                raise
+            if cache is not None and not usage.cache_hit:
+                cache.put(cache_key, {'scalar': output})
+        usage.on_chunk(output or '')
+        usage.finish()
+        return output
+
+
+async def single_chunk_stream(chunk):
+    yield chunk
 
 
 class Provider:
@@ -113,6 +294,22 @@ class Provider:
     async def run_model(self, model_obj, **kwargs):  # kind, model_name,
         pass
 
+    def get_cost(self, model_obj, prompt_tokens, completion_tokens, cached_tokens=0) -> Optional[float]:
+        """Returns the cost of a call in USD from the model's `input_cost` and `output_cost` per million tokens, or None if they aren't set"""
+        model_config = {**(self.parent.get_model(model_obj) or {}), **model_obj.get('model_params', {})}
+        input_cost, output_cost = model_config.get('input_cost'), model_config.get('output_cost')
+        if not input_cost and not output_cost:
+            return None
+        return (prompt_tokens * (input_cost or 0.0) + completion_tokens * (output_cost or 0.0)) / 1_000_000
+
+    def mark_prompt_cache(self, model_obj, messages):
+        """Marks the stable prompt prefix as cacheable, for models with `prompt_caching` set. Override for providers that cache differently"""
+        return mark_cache_prefix(messages)
+
+    def get_model_context_window(self, model_obj):
+        """Implement this method to return the max input tokens of a model, if known"""
+        return None
+
     # def sync_chat(self):
     #     """Implement this method to show sync button for chat models"""
     #     pass
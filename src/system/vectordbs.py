@@ -1,4 +1,11 @@
 import json
+import os
+import shutil
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
 from src.utils import sql
 
 
@@ -6,6 +13,7 @@ class VectorDBManager:
     def __init__(self, parent):
         self.parent = parent
         self.vec_dbs = {}
+        self.vec_db_objs = {}
 
     def load(self):
         self.vec_dbs = sql.get_results("""
@@ -14,6 +22,18 @@ class VectorDBManager:
                 config -- json_extract(config, '$.data')
             FROM vectordbs""", return_type='dict')
         self.vec_dbs = {k: json.loads(v) for k, v in self.vec_dbs.items()}
+        self.vec_db_objs = {k: v for k, v in self.vec_db_objs.items() if k in self.vec_dbs}
+
+    def get_vec_db(self, name):
+        """Returns the VectorDB of a row in the `vectordbs` table, the local vector db if no provider is set"""
+        if name not in self.vec_dbs:
+            return None
+        if name not in self.vec_db_objs:
+            from src.system.plugins import get_plugin_class
+            config = self.vec_dbs[name]
+            vec_db_class = get_plugin_class('VectorDB', config.get('vec_db_provider', ''), default_class=LocalVectorDB)
+            self.vec_db_objs[name] = vec_db_class(name=name, config=config)
+        return self.vec_db_objs[name]
 
     def to_dict(self):
         return self.vec_dbs
@@ -35,3 +55,271 @@ class VectorDB:
     def delete_vec_store(self, *args, **kwargs):
         raise NotImplementedError
 
+
+def get_child_path(parent_path, name):
+    """Returns `parent_path/name`, raises ValueError if `name` is not a single folder name inside `parent_path`"""
+    if not isinstance(name, str) or name in ('', '.', '..') or any(sep in name for sep in ('/', '\\', os.sep)) or os.path.isabs(name):
+        raise ValueError(f"Invalid name '{name}'")
+    child_path = os.path.join(parent_path, name)
+    if os.path.dirname(os.path.realpath(child_path)) != os.path.realpath(parent_path):
+        raise ValueError(f"Invalid name '{name}'")
+    return child_path
+
+
+class LocalVectorDB(VectorDB):
+    """Vector db stored in files next to the database, each vec store is a folder"""
+    def __init__(self, name, config=None, path=None):
+        super().__init__()
+        self.name = name
+        self.config = config or {}
+        self.path = path or get_child_path(os.path.join(os.path.dirname(sql.get_db_path()), 'vectordbs'), name)
+        self.vec_stores = {}
+
+    def create_vec_store(self, store_name, dimensions, metric='cosine'):
+        store_path = get_child_path(self.path, store_name)
+        if os.path.exists(store_path):
+            raise ValueError(f"Vec store '{store_name}' already exists")
+        self.vec_stores[store_name] = LocalVecStore(store_path, dimensions=dimensions, metric=metric)
+        return self.vec_stores[store_name]
+
+    def list_vec_stores(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path)
+                      if os.path.isfile(os.path.join(self.path, name, LocalVecStore.META_FILENAME)))
+
+    def get_vec_store(self, store_name):
+        if store_name not in self.vec_stores:
+            if store_name not in self.list_vec_stores():
+                return None
+            self.vec_stores[store_name] = LocalVecStore(get_child_path(self.path, store_name))
+        return self.vec_stores[store_name]
+
+    def delete_vec_store(self, store_name):
+        store_path = get_child_path(self.path, store_name)
+        self.vec_stores.pop(store_name, None)
+        if os.path.isdir(store_path):
+            shutil.rmtree(store_path)
+
+
+class LocalVecStore:
+    """
+    Append-only vector store with exact top-k search.
+    Vectors and ids are appended to flat files, deletes are appended as tombstones and applied in memory,
+    so writes never rewrite the store. `compact` rewrites it without the deleted rows.
+    """
+    META_FILENAME = 'meta.json'
+    VECTORS_FILENAME = 'vectors.f32'
+    IDS_FILENAME = 'ids.i64'
+    TOMBSTONES_FILENAME = 'tombstones.i64'  # (id, row count when deleted) pairs
+    METRICS = ('cosine', 'dot', 'euclidean')
+    MIN_COMPACT_ROWS = 1024
+
+    def __init__(self, path, dimensions=None, metric='cosine'):
+        self.path = path
+        self.lock = threading.Lock()
+
+        meta_path = os.path.join(path, self.META_FILENAME)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            dimensions, metric = meta['dimensions'], meta['metric']
+        else:
+            if not dimensions:
+                raise ValueError('Dimensions are required to create a vec store')
+            if metric not in self.METRICS:
+                raise ValueError(f"Unknown metric '{metric}', expected one of {self.METRICS}")
+            os.makedirs(path, exist_ok=True)
+            with open(meta_path, 'w') as f:
+                json.dump({'dimensions': dimensions, 'metric': metric}, f)
+
+        self.dimensions: int = dimensions
+        self.metric: str = metric
+
+        self.count = 0  # rows in the store, including deleted rows
+        self.vectors = np.empty((0, dimensions), dtype=np.float32)
+        self.sq_norms = np.empty(0, dtype=np.float32)  # only used by the euclidean metric
+        self.ids = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.rows_by_id: Dict[int, int] = {}  # {id: row} of the alive rows
+        self.load()
+
+    def file_path(self, filename):
+        return os.path.join(self.path, filename)
+
+    def load(self):
+        ids = np.fromfile(self.file_path(self.IDS_FILENAME), dtype=np.int64) if os.path.exists(self.file_path(self.IDS_FILENAME)) else np.empty(0, dtype=np.int64)
+        vectors = np.fromfile(self.file_path(self.VECTORS_FILENAME), dtype=np.float32) if os.path.exists(self.file_path(self.VECTORS_FILENAME)) else np.empty(0, dtype=np.float32)
+        # A crash between the two appends can leave a partial row, the shorter file wins
+        count = min(len(ids), len(vectors) // self.dimensions)
+        self.count = 0
+        self.reserve(count)
+        self.ids[:count] = ids[:count]
+        self.vectors[:count] = vectors[:count * self.dimensions].reshape(count, self.dimensions)
+        self.sq_norms[:count] = np.einsum('ij,ij->i', self.vectors[:count], self.vectors[:count])
+        self.alive[:count] = True
+        self.count = count
+
+        if os.path.exists(self.file_path(self.TOMBSTONES_FILENAME)):
+            tombstones = np.fromfile(self.file_path(self.TOMBSTONES_FILENAME), dtype=np.int64).reshape(-1, 2)
+            deleted_before_rows = {}  # {id: row count at its last delete}
+            for deleted_id, deleted_before_row in tombstones.tolist():
+                deleted_before_rows[deleted_id] = max(deleted_before_row, deleted_before_rows.get(deleted_id, 0))
+            candidate_rows = np.flatnonzero(np.isin(self.ids[:count], list(deleted_before_rows)))
+            for row, row_id in zip(candidate_rows.tolist(), self.ids[candidate_rows].tolist()):
+                if row < deleted_before_rows[row_id]:
+                    self.alive[row] = False
+
+        alive_rows = np.flatnonzero(self.alive[:count])
+        self.rows_by_id = dict(zip(self.ids[alive_rows].tolist(), alive_rows.tolist()))
+
+    def reserve(self, count):
+        capacity = len(self.ids)
+        if count <= capacity:
+            return
+        new_capacity = max(count, capacity * 2, 1024)
+        for att_name in ('vectors', 'sq_norms', 'ids', 'alive'):
+            old_array = getattr(self, att_name)
+            new_array = np.zeros((new_capacity,) + old_array.shape[1:], dtype=old_array.dtype)
+            new_array[:self.count] = old_array[:self.count]
+            setattr(self, att_name, new_array)
+
+    def __len__(self):
+        return len(self.rows_by_id)
+
+    def __contains__(self, item_id):
+        return int(item_id) in self.rows_by_id
+
+    def prepare_vectors(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
+        if vectors.shape[1] != self.dimensions:
+            raise ValueError(f'Expected vectors of {self.dimensions} dimensions, got {vectors.shape[1]}')
+        if self.metric == 'cosine':
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.where(norms == 0, 1, norms)
+        return np.ascontiguousarray(vectors, dtype=np.float32)
+
+    def insert(self, ids: Sequence[int], vectors) -> None:
+        """Inserts vectors with the given ids, replacing any existing vectors with the same id"""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        vectors = self.prepare_vectors(vectors)
+        if len(ids) != len(vectors):
+            raise ValueError(f'Got {len(ids)} ids for {len(vectors)} vectors')
+        if len(set(ids.tolist())) != len(ids):
+            raise ValueError('Duplicate ids in insert')
+
+        with self.lock:
+            replaced_ids = [item_id for item_id in ids.tolist() if item_id in self.rows_by_id]
+            if replaced_ids:
+                self._delete(replaced_ids)
+
+            with open(self.file_path(self.VECTORS_FILENAME), 'ab') as f:
+                vectors.tofile(f)
+            with open(self.file_path(self.IDS_FILENAME), 'ab') as f:
+                ids.tofile(f)
+
+            start, end = self.count, self.count + len(ids)
+            self.reserve(end)
+            self.vectors[start:end] = vectors
+            self.sq_norms[start:end] = np.einsum('ij,ij->i', vectors, vectors)
+            self.ids[start:end] = ids
+            self.alive[start:end] = True
+            self.count = end
+            self.rows_by_id.update(zip(ids.tolist(), range(start, end)))
+
+    def delete(self, ids: Sequence[int]) -> int:
+        """Deletes the vectors with the given ids, returns the number deleted"""
+        with self.lock:
+            return self._delete([int(item_id) for item_id in ids])
+
+    def _delete(self, ids: List[int]) -> int:
+        deleted_ids = [item_id for item_id in dict.fromkeys(ids) if item_id in self.rows_by_id]
+        if not deleted_ids:
+            return 0
+        rows = [self.rows_by_id.pop(item_id) for item_id in deleted_ids]
+        tombstones = np.array([(item_id, self.count) for item_id in deleted_ids], dtype=np.int64)
+        with open(self.file_path(self.TOMBSTONES_FILENAME), 'ab') as f:
+            tombstones.tofile(f)
+        self.alive[rows] = False
+
+        deleted_count = self.count - len(self.rows_by_id)
+        if deleted_count >= self.MIN_COMPACT_ROWS and deleted_count > len(self.rows_by_id):
+            self._compact()
+        return len(rows)
+
+    def get(self, item_id: int) -> Optional[np.ndarray]:
+        row = self.rows_by_id.get(int(item_id))
+        return None if row is None else self.vectors[row].copy()
+
+    def search(self, vector, k: int = 10) -> List[Tuple[int, float]]:
+        """Returns the top `k` [(id, score)], best first. Scores are similarities, or negative squared distances for euclidean"""
+        query = self.prepare_vectors(vector)[0]
+        with self.lock:
+            count = self.count
+            if count == 0 or k <= 0:
+                return []
+            scores = self.vectors[:count] @ query
+            if self.metric == 'euclidean':
+                scores = 2 * scores - self.sq_norms[:count] - query @ query
+            scores[~self.alive[:count]] = -np.inf
+
+            k = min(k, len(self.rows_by_id))
+            if k == 0:
+                return []
+            top_rows = np.argpartition(scores, count - k)[count - k:] if k < count else np.arange(count)
+            top_rows = top_rows[np.argsort(-scores[top_rows], kind='stable')][:k]
+            return [(int(self.ids[row]), float(scores[row])) for row in top_rows]
+
+    def compact(self):
+        """Rewrites the store files without the deleted rows, done automatically when most rows are deleted"""
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        alive_rows = np.flatnonzero(self.alive[:self.count])
+        vectors = self.vectors[alive_rows]
+        ids = self.ids[alive_rows]
+        for filename, array in ((self.VECTORS_FILENAME, vectors), (self.IDS_FILENAME, ids)):
+            temp_path = self.file_path(filename + '.tmp')
+            array.tofile(temp_path)
+            os.replace(temp_path, self.file_path(filename))
+        if os.path.exists(self.file_path(self.TOMBSTONES_FILENAME)):
+            os.remove(self.file_path(self.TOMBSTONES_FILENAME))
+
+        count = len(ids)
+        self.vectors[:count] = vectors
+        self.sq_norms[:count] = np.einsum('ij,ij->i', vectors, vectors)
+        self.ids[:count] = ids
+        self.alive[:count] = True
+        self.alive[count:] = False
+        self.count = count
+        self.rows_by_id = dict(zip(ids.tolist(), range(count)))
+
+
+def embed_messages(vec_store, embedding_func: Callable[[List[str]], Sequence[Sequence[float]]], context_id=None, batch_size=64):
+    """
+    Embeds the messages that have no embedding yet into `vec_store`, using the message id as the vector id,
+    and sets their `embedding_id`. Returns the number of messages embedded.
+    """
+    context_filter = '' if context_id is None else 'AND context_id = ?'
+    params = () if context_id is None else (context_id,)
+    rows = sql.get_results(f"""
+        SELECT id, msg
+        FROM contexts_messages
+        WHERE embedding_id IS NULL
+            AND role IN ('user', 'assistant')
+            AND msg != ''
+            {context_filter}
+        ORDER BY id""", params)
+
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        msg_ids = [msg_id for msg_id, _ in batch]
+        vec_store.insert(msg_ids, embedding_func([msg for _, msg in batch]))
+        sql.execute_multiple(
+            ["UPDATE contexts_messages SET embedding_id = ? WHERE id = ?"] * len(msg_ids),
+            [(msg_id, msg_id) for msg_id in msg_ids],
+        )
+    return len(rows)
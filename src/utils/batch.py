@@ -0,0 +1,194 @@
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+from src.utils.messages import count_tokens
+
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+
+def read_batch_rows(path: str) -> List[Tuple[str, str]]:
+    """
+    Returns [(row_id, input)] from a JSONL file, a row is an object with an `input` (or `message` / `prompt`) and optional `id`,
+    or a plain string. Rows without an id are numbered by their line.
+    """
+    rows = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            if isinstance(row, str):
+                rows.append((str(line_number), row))
+                continue
+            text = next((row[key] for key in ('input', 'message', 'prompt') if key in row), None)
+            if text is None:
+                raise ValueError(f"Row on line {line_number} has no `input`")
+            rows.append((str(row.get('id', line_number)), str(text)))
+    return rows
+
+
+def get_token_usage(messages) -> Dict[str, int]:
+    """
+    Returns the prompt and completion tokens of the LLM calls logged in the messages.
+    Uses the usage recorded for each call, and only counts the tokens of the logged prompt and response when a call has none.
+    """
+    input_tokens, output_tokens = 0, 0
+    counted_calls = set()
+    for msg in messages:
+        log = msg.log or {}
+        if 'messages' not in log and 'usage' not in log:
+            continue
+        logged_messages = log.get('messages', [])
+        call_key = (msg.member_id, log.get('prompt_hash'), len(logged_messages), json.dumps(logged_messages[-1:]))
+        first_message = call_key not in counted_calls  # a response split into several messages shares its call
+        counted_calls.add(call_key)
+
+        usage = log.get('usage')
+        if usage:
+            if first_message:
+                input_tokens += usage.get('prompt_tokens', 0)
+                output_tokens += usage.get('completion_tokens', 0)
+            continue
+        if 'messages' not in log:
+            continue
+        model_name = (log.get('model') or {}).get('model_name')
+        output_tokens += count_tokens(msg.content, model_name)
+        if first_message:
+            input_tokens += sum(count_tokens(m.get('content') if isinstance(m.get('content'), str) else json.dumps(m.get('content')), model_name)
+                                for m in logged_messages)
+    return {'input_tokens': input_tokens, 'output_tokens': output_tokens}
+
+
+class JsonlResults:
+    """Appends one result per line, a resumed batch appends after the existing results"""
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def finished_ids(self) -> Set[str]:
+        finished = set()
+        if not os.path.isfile(self.path):
+            return finished
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a line cut off by a crash
+                if result.get('status') == 'ok':
+                    finished.add(str(result['id']))
+        return finished
+
+    def write(self, result: Dict[str, Any]):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(json.dumps(result) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SqliteResults:
+    """Keeps the latest result of each row in a `results` table, in its own file so it doesn't share the app database lock"""
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                id TEXT PRIMARY KEY,
+                input TEXT,
+                output TEXT,
+                status TEXT,
+                error TEXT,
+                latency_ms INTEGER,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                finished_at REAL
+            )""")
+        self.conn.commit()
+
+    def finished_ids(self) -> Set[str]:
+        return {row[0] for row in self.conn.execute("SELECT id FROM results WHERE status = 'ok'")}
+
+    def write(self, result: Dict[str, Any]):
+        self.conn.execute("""
+            INSERT OR REPLACE INTO results (id, input, output, status, error, latency_ms, input_tokens, output_tokens, finished_at)
+            VALUES (:id, :input, :output, :status, :error, :latency_ms, :input_tokens, :output_tokens, :finished_at)""", result)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def open_batch_results(path: str):
+    if path.lower().endswith(SQLITE_EXTENSIONS):
+        return SqliteResults(path)
+    return JsonlResults(path)
+
+
+async def run_batch_row(config: Dict[str, Any], row_id: str, text: str) -> Dict[str, Any]:
+    """Runs one input through its own in-memory workflow, so rows don't share a context or write to the database"""
+    from src.members.workflow import Workflow
+    start = time.perf_counter()
+    output = ''
+    workflow = None
+    try:
+        workflow = Workflow(config=copy.deepcopy(config), kind='CHAT', persist=False)
+        first_member = next(iter(workflow.members.values()))
+        workflow.save_message('user', text, member_id=first_member.member_id)
+        async for key, chunk in workflow.behaviour.receive(from_member_id=first_member.member_id):
+            output += chunk or ''
+        status, error = 'ok', None
+    except Exception as e:
+        status, error = 'error', str(e) or e.__class__.__name__
+
+    usage = get_token_usage(workflow.message_history.messages) if workflow else {'input_tokens': 0, 'output_tokens': 0}
+    return {
+        'id': row_id,
+        'input': text,
+        'output': output,
+        'status': status,
+        'error': error,
+        'latency_ms': round((time.perf_counter() - start) * 1000),
+        **usage,
+        'finished_at': time.time(),
+    }
+
+
+async def run_batch(
+    config: Dict[str, Any],
+    rows: Iterable[Tuple[str, str]],
+    results,
+    concurrency: int = 4,
+    on_result=None,
+) -> Dict[str, int]:
+    """
+    Runs each (row_id, input) through the workflow `config`, up to `concurrency` rows at a time.
+    Rows already in `results` with an ok status are skipped, so a crashed batch resumes where it stopped.
+    """
+    rows = list(rows)
+    finished_ids = results.finished_ids()
+    pending_rows = [(row_id, text) for row_id, text in rows if row_id not in finished_ids]
+    summary = {'skipped': len(rows) - len(pending_rows), 'ok': 0, 'error': 0}
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def run_row(row_id, text):
+        async with semaphore:
+            result = await run_batch_row(config, row_id, text)
+        results.write(result)  # on the event loop thread, so writes never interleave
+        summary[result['status']] += 1
+        if on_result:
+            on_result(result)
+
+    await asyncio.gather(*(run_row(row_id, text) for row_id, text in pending_rows))
+    return summary
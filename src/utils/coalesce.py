@@ -0,0 +1,151 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+_streams: Dict[Tuple[asyncio.AbstractEventLoop, str], 'SharedStream'] = {}
+_calls: Dict[str, 'SharedCall'] = {}
+_calls_lock = threading.Lock()
+
+MAX_UNREAD_CHUNKS = 16  # the provider's stream is paused while every reader is this far behind
+
+
+class SharedStream:
+    """
+    One response stream read by every identical request in flight on an event loop.
+    Each reader gets every chunk from the start, so a request that joins late still gets the whole response.
+    The request is cancelled once every reader has gone away, and keeps running while any is left.
+    It's read as fast as the fastest reader, so a slow client pauses the provider's stream.
+    """
+    def __init__(self, flight_key: Tuple[asyncio.AbstractEventLoop, str]):
+        self.flight_key = flight_key
+        self.chunks: List[Any] = []
+        self.read_count = 0  # chunks the fastest reader is done with
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.readers = 0
+        self.opened = flight_key[0].create_future()
+        self.updated = asyncio.Event()
+        self.read_more = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    async def pump(self, open_stream: Callable[[], Awaitable[Any]]):
+        """Opens the stream and buffers its chunks for the readers, in a task of its own so a reader leaving doesn't stop it"""
+        try:
+            try:
+                stream = await open_stream()
+            except Exception as e:
+                self.opened.set_exception(e)
+                return
+            self.opened.set_result(None)
+            async for chunk in stream:
+                self.chunks.append(chunk)
+                self.notify()
+                while len(self.chunks) - self.read_count >= MAX_UNREAD_CHUNKS:
+                    self.read_more.clear()
+                    await self.read_more.wait()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.discard()
+            self.notify()
+            if not self.opened.done():
+                self.opened.cancel()
+
+    def notify(self):
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    def discard(self):
+        """Stops new requests joining this stream"""
+        if _streams.get(self.flight_key) is self:
+            del _streams[self.flight_key]
+
+    async def wait_opened(self):
+        """Waits for the provider to start the stream, raising its error if it didn't"""
+        try:
+            await asyncio.shield(self.opened)
+        except BaseException:
+            self.release()
+            raise
+
+    async def read(self):
+        try:
+            i = 0
+            while True:
+                while i < len(self.chunks):
+                    yield self.chunks[i]
+                    i += 1
+                    if i > self.read_count:
+                        self.read_count = i
+                        self.read_more.set()
+                if self.done:
+                    break
+                await self.updated.wait()
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.release()
+
+    def release(self):
+        self.readers -= 1
+        if self.readers <= 0 and not self.done:
+            self.discard()
+            self.task.cancel()  # nobody is reading it anymore
+
+
+def join_stream(request_key: str, open_stream: Callable[[], Awaitable[Any]]) -> Tuple[SharedStream, bool]:
+    """
+    Returns the stream of the identical request in flight on this event loop, or starts one with `open_stream()`.
+    Also returns whether an existing stream was joined. The caller must `wait_opened()` and then `read()` the stream once.
+    """
+    loop = asyncio.get_running_loop()
+    flight_key = (loop, request_key)
+    shared = _streams.get(flight_key)
+    joined = shared is not None
+    if not joined:
+        shared = _streams[flight_key] = SharedStream(flight_key)
+        shared.task = loop.create_task(shared.pump(open_stream))
+    shared.readers += 1
+    return shared, joined
+
+
+class SharedCall:
+    def __init__(self):
+        self.thread_id = threading.get_ident()
+        self.finished = threading.Event()
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+
+
+def coalesce_call(request_key: str, call: Callable[[], Any]) -> Tuple[Any, bool]:
+    """
+    Runs `call()` once for the identical blocking calls in flight from any thread, every caller gets its result or error.
+    Returns (result, whether it was joined). A call made again from the thread running it, eg. by a nested event loop, runs on its own.
+    """
+    with _calls_lock:
+        shared = _calls.get(request_key)
+        joined = shared is not None and shared.thread_id != threading.get_ident()
+        if shared is None:
+            shared = _calls[request_key] = SharedCall()
+        elif not joined:
+            shared = None
+
+    if shared is None:
+        return call(), False
+    if joined:
+        shared.finished.wait()
+        if shared.error is not None:
+            raise shared.error
+        return shared.result, True
+
+    try:
+        shared.result = call()
+    except Exception as e:
+        shared.error = e
+        raise
+    finally:
+        with _calls_lock:
+            _calls.pop(request_key, None)
+        shared.finished.set()
+    return shared.result, False
@@ -194,10 +194,15 @@ async def receive_workflow(
     tool_uuid: str = None,
     chat_title: str = '',
     main=None,
+    persist: bool = None,
 ):
+    """Runs a tool or block workflow, in memory only unless `persist` or the `system.persist_sub_workflows` setting is set"""
     from src.members.workflow import Workflow
+    from src.system.base import manager
+    if persist is None:
+        persist = manager.config.dict.get('system.persist_sub_workflows', False)
     wf_config = merge_config_into_workflow_config(config)
-    workflow = Workflow(main=main, config=wf_config, kind=kind, params=params, tool_uuid=tool_uuid, chat_title=chat_title)
+    workflow = Workflow(main=main, config=wf_config, kind=kind, params=params, tool_uuid=tool_uuid, chat_title=chat_title, persist=persist)
 
     try:
         async for key, chunk in workflow.run_member():
@@ -213,9 +218,10 @@ async def compute_workflow_async(  # todo rename, clean
     tool_uuid: str = None,
     chat_title: str = '',
     main=None,
+    persist: bool = None,
 ):
     response = ''
-    async for key, chunk in receive_workflow(config, kind=kind, params=params, tool_uuid=tool_uuid, chat_title=chat_title, main=main):
+    async for key, chunk in receive_workflow(config, kind=kind, params=params, tool_uuid=tool_uuid, chat_title=chat_title, main=main, persist=persist):
         response += chunk
     return response
 
@@ -227,8 +233,9 @@ def compute_workflow(  # todo rename
     tool_uuid: str = None,
     chat_title: str = '',
     main=None,
+    persist: bool = None,
 ):
-    return asyncio.run(compute_workflow_async(config, kind=kind, params=params, tool_uuid=tool_uuid, chat_title=chat_title, main=main))
+    return asyncio.run(compute_workflow_async(config, kind=kind, params=params, tool_uuid=tool_uuid, chat_title=chat_title, main=main, persist=persist))
 
 
 def params_to_schema(params):
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from src.utils import sql
+
+CACHE_FILENAME = 'llm_cache.db'
+DEFAULT_MAX_SIZE_MB = 200
+EXCLUDED_PARAMS = ('api_key', 'cache_responses')  # params that don't change the response
+
+_caches: Dict[str, 'ResponseCache'] = {}
+_caches_lock = threading.Lock()
+
+
+class ResponseObject(dict):
+    """A dict with attribute access, shaped like the litellm response objects, missing attributes are None like theirs"""
+    def __getattr__(self, name):
+        return self.get(name)
+
+
+def get_request_key(model_obj: Dict[str, Any], model_config: Dict[str, Any], request: Dict[str, Any]) -> str:
+    """
+    Hashes everything that decides a response: the model, its saved config and request params, the messages, tools and other request args.
+    The saved config and the request params are hashed apart, as providers differ in which one wins.
+    """
+    key_data = {
+        'provider': model_obj.get('provider'),
+        'kind': model_obj.get('kind'),
+        'model_name': model_obj.get('model_name'),
+        'model_config': {k: v for k, v in model_config.items() if k not in EXCLUDED_PARAMS},
+        'model_params': {k: v for k, v in model_obj.get('model_params', {}).items() if k not in EXCLUDED_PARAMS},
+        'request': request,
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    LLM responses stored in their own SQLite file, evicting the least recently used once they pass `max_bytes`.
+    The keys are also kept in memory, so a miss never touches the disk.
+    """
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_SIZE_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')  # a crash can lose the latest responses, never corrupt the file
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            ) WITHOUT ROWID""")
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)""")
+        self.conn.commit()
+        self.sizes: Dict[str, int] = dict(self.conn.execute("SELECT key, size FROM responses"))
+        self.total_size = sum(self.sizes.values())
+
+    def get(self, key: str) -> Optional[Any]:
+        if key not in self.sizes:
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.total_size -= self.sizes.pop(key, 0)
+                return None
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, response: Any):
+        response_json = json.dumps(response)
+        size = len(response_json.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                              (key, response_json, size, time.time()))
+            self.total_size += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        while self.total_size > self.max_bytes:
+            oldest = self.conn.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 64").fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_size -= self.sizes.pop(key, size)
+                if self.total_size <= self.max_bytes:
+                    break
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+            self.sizes.clear()
+            self.total_size = 0
+
+    def close(self):
+        self.conn.close()
+
+
+def get_response_cache() -> ResponseCache:
+    """Returns the cache next to the current database, sized by the `system.llm_cache_size_mb` setting"""
+    from src.system.base import manager
+    path = os.path.join(os.path.dirname(os.path.abspath(sql.get_db_path())), CACHE_FILENAME)
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = ResponseCache(path)
+    cache.max_bytes = int(manager.config.dict.get('system.llm_cache_size_mb', DEFAULT_MAX_SIZE_MB) * 1024 * 1024)
+    return cache
+
+
+def close_response_caches():
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.close()
+        _caches.clear()
+
+
+def get_chunk_record(chunk) -> Dict[str, Any]:
+    """Returns the parts of a streamed chunk that replaying it needs, as plain JSON"""
+    choice = chunk.choices[0]
+    delta = choice.get('delta') or {}
+    record = {}
+    if delta.get('content'):
+        record['content'] = delta.get('content')
+    if delta.get('tool_calls'):
+        record['tool_calls'] = [{
+            'index': t.index,
+            'id': t.id,
+            'type': t.type,
+            'function': {'name': t.function.name, 'arguments': t.function.arguments},
+        } for t in delta.get('tool_calls')]
+    finish_reason = choice.get('finish_reason')
+    if finish_reason:
+        record['finish_reason'] = finish_reason
+    usage = getattr(chunk, 'usage', None)
+    if usage:
+        record['usage'] = {k: getattr(usage, k, None) for k in ('prompt_tokens', 'completion_tokens', 'total_tokens')}
+    return record
+
+
+async def record_stream(stream, cache: ResponseCache, key: str):
+    """Passes the chunks through and caches them once the stream completes, a failed or abandoned stream isn't cached"""
+    records: List[Dict[str, Any]] = []
+    async for chunk in stream:
+        records.append(get_chunk_record(chunk))
+        yield chunk
+    cache.put(key, {'chunks': records})
+
+
+async def replay_stream(response: Dict[str, Any], model_name: str):
+    """Streams a cached response in the chunk format it was recorded from, marked as a cache hit"""
+    chunk_info = {
+        'id': f'chatcmpl-{uuid.uuid4()}',
+        'created': int(time.time()),
+        'model': model_name,
+        'object': 'chat.completion.chunk',
+        '_hidden_params': {'cache_hit': True},
+    }
+    for record in response['chunks']:
+        delta = ResponseObject()
+        if 'content' in record:
+            delta['content'] = record['content']
+        if 'tool_calls' in record:
+            delta['tool_calls'] = [
+                ResponseObject(t, function=ResponseObject(t['function'])) for t in record['tool_calls']
+            ]
+        chunk = ResponseObject(chunk_info, choices=[
+            ResponseObject(index=0, delta=delta, finish_reason=record.get('finish_reason')),
+        ])
+        if 'usage' in record:
+            chunk['usage'] = ResponseObject(record['usage'])
+        yield chunk
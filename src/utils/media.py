@@ -3,18 +3,28 @@ import os
 import tempfile
 import time
 
-from PySide6.QtMultimedia import QMediaPlayer, QAudioOutput
 from PySide6.QtCore import QUrl, QEventLoop
 
-media_player = QMediaPlayer()
-audio_output = QAudioOutput()
-media_player.setAudioOutput(audio_output)
+media_player = None
+audio_output = None
+
+
+def get_media_player():
+    """Creates the media player on first use, QtMultimedia needs audio libraries a headless machine may not have"""
+    global media_player, audio_output
+    if media_player is None:
+        from PySide6.QtMultimedia import QMediaPlayer, QAudioOutput
+        media_player = QMediaPlayer()
+        audio_output = QAudioOutput()
+        media_player.setAudioOutput(audio_output)
+    return media_player
 
 
 def play_url(url):
     if not url:
         return
 
+    media_player = get_media_player()
     media_player.setSource(QUrl(url))
     media_player.play()
 
@@ -47,6 +57,7 @@ def play_file(filepath, blocking=False, wait_percent=0.0):
     if not os.path.isfile(filepath):
         return
 
+    media_player = get_media_player()
     media_player.setSource(QUrl.fromLocalFile(filepath))
     file_duration = get_audio_file_duration(filepath)
     media_player.play()
@@ -1,6 +1,7 @@
 import json
 import threading
-from typing import List, Dict, Any
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
 
 import tiktoken
 
@@ -9,6 +10,41 @@ from src.members.user import User
 from src.utils import sql
 from src.utils.helpers import convert_to_safe_case, try_parse_json
 
+DEFAULT_ENCODING = 'cl100k_base'
+MESSAGE_TOKEN_OVERHEAD = 4  # role and separator tokens added by the chat format
+MIN_TRUNCATED_TOKENS = 32  # messages that would be truncated shorter than this are dropped instead
+TRUNCATED_SUFFIX = '\n... [truncated]'
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: Optional[str] = None) -> tiktoken.Encoding:
+    """Returns the process-wide tiktoken encoding for a model, falling back to cl100k_base"""
+    if model_name:
+        for name in (model_name, model_name.split('/')[-1]):
+            try:
+                return tiktoken.encoding_for_model(name)
+            except KeyError:
+                pass
+    return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+@lru_cache(maxsize=4096)
+def count_encoded_tokens(encoding_name: str, content: str) -> int:
+    return len(tiktoken.get_encoding(encoding_name).encode(content, disallowed_special=()))
+
+
+def count_tokens(content: str, model_name: Optional[str] = None) -> int:
+    return count_encoded_tokens(get_encoding(model_name).name, content or '')
+
+
+def truncate_tokens(content: str, max_tokens: int, model_name: Optional[str] = None) -> str:
+    """Keeps the first `max_tokens` tokens of `content`"""
+    encoding = get_encoding(model_name)
+    tokens = encoding.encode(content or '', disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return content
+    return encoding.decode(tokens[:max_tokens]) + TRUNCATED_SUFFIX
+
 
 class Message:
     def __init__(self,
@@ -17,17 +53,34 @@ class Message:
         content: str,
         member_id: str = None,
         alt_turn: int = None,
-        log=None
+        log=None,
+        token_counts=None,
     ):
         self.id: int = msg_id
         self.role: str = role
         self.content: str = content
         self.member_id: str = member_id
-        self.token_count = len(tiktoken.encoding_for_model("gpt-3.5-turbo").encode(content or ''))
         self.alt_turn: int = alt_turn
         if log is not None and not isinstance(log, str):
             log = json.dumps(log)  # todo clean
         self.log = None if not log else json.loads(log)
+        # {encoding_name: token_count}, counted lazily and persisted by MessageHistory.get_token_counts
+        self.token_counts: Dict[str, int] = json.loads(token_counts) if isinstance(token_counts, str) else (token_counts or {})
+
+    @property
+    def loop_iteration(self) -> Optional[int]:
+        """The iteration of the workflow loop that added the message, if any"""
+        return (self.log or {}).get('loop_iteration')
+
+    @property
+    def token_count(self) -> int:
+        return self.get_token_count()
+
+    def get_token_count(self, model_name: Optional[str] = None) -> int:
+        encoding_name = get_encoding(model_name).name
+        if encoding_name not in self.token_counts:
+            self.token_counts[encoding_name] = count_encoded_tokens(encoding_name, self.content or '')
+        return self.token_counts[encoding_name]
 
 
 class MessageHistory:
@@ -41,102 +94,184 @@ class MessageHistory:
 
         self.msg_id_buffer: List[int] = []
 
+        self.output_member_ids: List[str] = []
+        self.member_turn_outputs: Dict[str, Any] = {}
+        self.member_last_outputs: Dict[str, Any] = {}
+
     def load(self):
         self.messages = []
-        self.workflow.leaf_id = sql.get_scalar("""
-            WITH RECURSIVE leaf_contexts AS (
-                SELECT 
-                    c1.id
-                FROM contexts c1 
-                WHERE c1.id = ?
-            UNION ALL
-                SELECT 
-                    c2.id
-                FROM contexts c2 
-                JOIN leaf_contexts lc ON lc.id = c2.parent_id
-                WHERE c2.active = 1
-                AND NOT EXISTS (
-                    SELECT 1
-                    FROM contexts c3
-                    WHERE c3.parent_id = c2.parent_id
-                    AND c3.branch_msg_id < c2.branch_msg_id
-                    AND c3.active = 1
-                )
-            )
-            SELECT id
-            FROM leaf_contexts 
-            ORDER BY id DESC;""", (self.workflow.context_id,))
-
-        self.load_branches()
-        self.refresh_messages()
+        if not self.workflow.persist:
+            self.branches = {}
+            self.reset_member_outputs()
+            self.update_workflow_outputs()
+            self.load_msg_id_buffer()
+            return
+        context_tree = self.get_context_tree()
+        self.workflow.leaf_id = self.get_active_leaf_id(context_tree)
+
+        self.load_branches(context_tree)
+        self.refresh_messages(context_tree)
         self.load_msg_id_buffer()
 
-    def load_branches(self):
+    def get_context_tree(self) -> Dict[int, Tuple[Optional[int], Optional[int], int]]:
+        """Returns {context_id: (parent_id, branch_msg_id, active)} of all contexts in the chat, from the `root_id` index"""
         root_id = self.workflow.context_id
-        result = sql.get_results("""
-            WITH RECURSIVE context_chain(id, parent_id, branch_msg_id) AS (
-              SELECT id, parent_id, branch_msg_id
-              FROM contexts
-              WHERE id = ?
-              UNION ALL
-              SELECT c.id, c.parent_id, c.branch_msg_id
-              FROM contexts c
-              JOIN context_chain cc ON c.parent_id = cc.id
-            )
-            SELECT
-                cc.branch_msg_id,
-                group_concat((SELECT MIN(cm.id) FROM contexts_messages cm WHERE cm.context_id = cc.id)) AS context_set
-            FROM context_chain cc
-            WHERE cc.branch_msg_id IS NOT null
-            GROUP BY cc.branch_msg_id;
-        """, (root_id,), return_type='dict')
-        self.branches = {int(k): [int(i) for i in v.split(',')] for k, v in result.items() if v}
+        rows = sql.get_results("""
+            SELECT id, parent_id, branch_msg_id, active
+            FROM contexts
+            WHERE id = ?
+            UNION ALL
+            SELECT id, parent_id, branch_msg_id, active
+            FROM contexts
+            WHERE root_id = ?""", (root_id, root_id))
+        return {context_id: (parent_id, branch_msg_id, active) for context_id, parent_id, branch_msg_id, active in rows}
+
+    def get_active_leaf_id(self, context_tree) -> int:
+        """Follows the active branches from the root, the first active branch of a message wins"""
+        children = {}  # {parent_id: [(branch_msg_id, context_id)]}
+        for context_id, (parent_id, branch_msg_id, active) in context_tree.items():
+            if parent_id is not None and active == 1:
+                children.setdefault(parent_id, []).append((branch_msg_id, context_id))
+
+        leaf_id = self.workflow.context_id
+        reachable = [leaf_id]
+        while reachable:
+            context_id = reachable.pop()
+            leaf_id = max(leaf_id, context_id)
+            active_children = children.get(context_id, [])
+            if not active_children:
+                continue
+            first_branch_msg_id = min(branch_msg_id for branch_msg_id, _ in active_children)
+            reachable.extend(child_id for branch_msg_id, child_id in active_children
+                             if branch_msg_id == first_branch_msg_id)
+        return leaf_id
+
+    def get_context_path(self, context_tree) -> List[Tuple[int, Optional[int]]]:
+        """Returns [(context_id, before_msg_id)] from the leaf to the root, a context only includes messages before the branch of its child"""
+        context_path = []
+        context_id, before_msg_id = self.workflow.leaf_id, None
+        while context_id is not None and context_id in context_tree:
+            context_path.append((context_id, before_msg_id))
+            parent_id, branch_msg_id, _ = context_tree[context_id]
+            context_id, before_msg_id = parent_id, branch_msg_id
+        return context_path
+
+    def activate_branch_path(self, msg_id: int):
+        """Activates the branches leading to `msg_id` and deactivates any branch hiding it, so it is visible after `load`"""
+        msg_context_id = sql.get_scalar("SELECT context_id FROM contexts_messages WHERE id = ?", (msg_id,))
+        context_tree = self.get_context_tree()
+        if msg_context_id is None or msg_context_id not in context_tree:
+            return
+
+        queries, params_list = [], []
+        context_id, before_msg_id, path_child_id = msg_context_id, msg_id, -1
+        while context_id is not None:
+            queries.append("UPDATE contexts SET active = 0 WHERE parent_id = ? AND branch_msg_id <= ? AND id != ? AND active = 1")
+            params_list.append((context_id, before_msg_id, path_child_id))
+            parent_id, branch_msg_id, active = context_tree[context_id]
+            if parent_id is not None and active != 1:
+                queries.append("UPDATE contexts SET active = 1 WHERE id = ?")
+                params_list.append((context_id,))
+            context_id, before_msg_id, path_child_id = parent_id, branch_msg_id, context_id
+
+        sql.execute_multiple(queries, params_list)
+
+    def load_branches(self, context_tree=None):
+        if context_tree is None:
+            context_tree = self.get_context_tree()
+
+        branch_contexts = {context_id: branch_msg_id
+                           for context_id, (parent_id, branch_msg_id, _) in context_tree.items()
+                           if branch_msg_id is not None}
+        if not branch_contexts:
+            self.branches = {}
+            return
+
+        context_ids = list(branch_contexts.keys())
+        first_msg_ids = sql.get_results(f"""
+            SELECT context_id, MIN(id)
+            FROM contexts_messages
+            WHERE context_id IN ({','.join(['?'] * len(context_ids))})
+            GROUP BY context_id""", context_ids, return_type='dict')
+
+        self.branches = {}  # {branch_msg_id: [child_msg_ids]}
+        for context_id in sorted(first_msg_ids):
+            self.branches.setdefault(branch_contexts[context_id], []).append(int(first_msg_ids[context_id]))
         # print(f"BRANCHES: {self.branches}")
 
-    def refresh_messages(self):
+    def refresh_messages(self, context_tree=None):
+        if context_tree is None:
+            context_tree = self.get_context_tree()
         last_msg_id = self.messages[-1].id if len(self.messages) > 0 else 0
 
-        msg_log = sql.get_results("""
-            WITH RECURSIVE context_path(context_id, parent_id, branch_msg_id, prev_branch_msg_id) AS (
-              SELECT id, parent_id, branch_msg_id, null
-              FROM contexts 
-              WHERE id = ?
-              UNION ALL
-              SELECT c.id, c.parent_id, c.branch_msg_id, cp.branch_msg_id
-              FROM context_path cp
-              JOIN contexts c ON cp.parent_id = c.id
+        context_path = self.get_context_path(context_tree)
+        if not context_path:
+            return
+        path_values = ', '.join(['(?, ?)'] * len(context_path))
+        path_params = [param for context_id, before_msg_id in context_path for param in (context_id, before_msg_id)]
+        msg_log = sql.get_results(f"""
+            WITH context_path(context_id, before_msg_id) AS (
+                VALUES {path_values}
             )
-            SELECT m.id, m.role, m.msg, m.member_id, m.alt_turn, m.log
-            FROM contexts_messages m
-            JOIN context_path cp ON m.context_id = cp.context_id
+            SELECT m.id, m.role, m.msg, m.member_id, m.alt_turn, m.log, m.token_counts
+            FROM context_path cp
+            JOIN contexts_messages m ON m.context_id = cp.context_id
             WHERE m.id > ?
-                AND (cp.prev_branch_msg_id IS NULL OR m.id < cp.prev_branch_msg_id)
-            ORDER BY m.id;""", (self.workflow.leaf_id, last_msg_id,))
+                AND (cp.before_msg_id IS NULL OR m.id < cp.before_msg_id)
+            ORDER BY m.id;""", path_params + [last_msg_id])
+
+        new_messages = [Message(int(msg_id), role, content, member_id, alt_turn, log, token_counts)
+                        for msg_id, role, content, member_id, alt_turn, log, token_counts in msg_log]
+        if len(self.messages) == 0:
+            self.reset_member_outputs()
+        self.messages.extend(new_messages)
+
+        for msg in new_messages:
+            self.apply_member_outputs(msg)
+        self.update_workflow_outputs()
+
+    def truncate(self, msg_id):
+        """Removes `msg_id` and all following messages from memory, and recomputes the member outputs"""
+        index = next((i for i, msg in enumerate(self.messages) if msg.id == msg_id), -1)
+        if index <= len(self.messages) - 1:
+            self.messages[:] = self.messages[:index]
+
+        self.reset_member_outputs()
+        for msg in self.messages:
+            self.apply_member_outputs(msg)
+        self.update_workflow_outputs()
 
-        self.messages.extend([Message(int(msg_id), role, content, member_id, alt_turn, log)
-                              for msg_id, role, content, member_id, alt_turn, log in msg_log])
+    def reset_member_outputs(self):
+        self.output_member_ids = [member.member_id for member in self.workflow.get_members()]
+        self.member_turn_outputs = {member_id: None for member_id in self.output_member_ids}
+        self.member_last_outputs = {member_id: None for member_id in self.output_member_ids}
 
-        member_turn_outputs = {member.member_id: None for member in self.workflow.get_members()}
-        member_last_outputs = {member.member_id: None for member in self.workflow.get_members()}
-        for msg in self.messages:
-            if msg.alt_turn != self.alt_turn_state:
-                self.alt_turn_state = msg.alt_turn
-                member_turn_outputs = {member.member_id: None for member in self.workflow.get_members()}
+    def apply_member_outputs(self, msg: Message):
+        """Updates the turn and last outputs with a message, in order of the message history"""
+        if msg.alt_turn != self.alt_turn_state:
+            self.alt_turn_state = msg.alt_turn
+            self.member_turn_outputs = {member_id: None for member_id in self.output_member_ids}
 
-            member_turn_outputs[msg.member_id] = msg.content
-            member_last_outputs[msg.member_id] = msg.content
+        self.member_turn_outputs[msg.member_id] = msg.content
+        self.member_last_outputs[msg.member_id] = msg.content
 
-            run_finished = None not in member_turn_outputs.values()  #!looper!#  # ~~ #
-            if run_finished:
-                # self.alt_turn_state = 1 - self.alt_turn_state
-                member_turn_outputs = {member.member_id: None for member in self.workflow.get_members()}
+        run_finished = None not in self.member_turn_outputs.values()  #!looper!#  # ~~ #
+        if run_finished:
+            # self.alt_turn_state = 1 - self.alt_turn_state
+            self.member_turn_outputs = {member_id: None for member_id in self.output_member_ids}
 
+    def update_workflow_outputs(self):
         self.workflow.reset_last_outputs()
-        self.workflow.set_last_outputs(member_last_outputs)
-        self.workflow.set_turn_outputs(member_turn_outputs)
+        self.workflow.set_last_outputs(self.member_last_outputs)
+        self.workflow.set_turn_outputs(self.member_turn_outputs)
 
     def load_msg_id_buffer(self):
         self.msg_id_buffer = []
+        if not self.workflow.persist:
+            # ephemeral message ids only need to be unique within the history
+            last_msg_id = self.messages[-1].id if self.messages else 0
+            self.msg_id_buffer = list(range(last_msg_id + 1, last_msg_id + 100))
+            return
         last_msg_id = sql.get_scalar("SELECT seq FROM sqlite_sequence WHERE name = 'contexts_messages'")
         last_msg_id = last_msg_id if last_msg_id is not None else 0
         for msg_id in range(last_msg_id + 1, last_msg_id + 100):
@@ -153,21 +288,55 @@ class MessageHistory:
         member_id: str = '1',
         log_obj=None
     ) -> Message:
+        return self.add_message(Message(None, role, content, member_id, log=log_obj or {}))
+
+    def add_message(self, new_msg: Message) -> Message:
+        """Saves a message made without an id, setting its id and turn, and appends it to the history"""
         with self.thread_lock:
             next_id = self.get_next_msg_id()
-            if log_obj is None:
-                log_obj = {}
-            log_obj['id'] = next_id
-            new_msg = Message(next_id, role, content, member_id, self.alt_turn_state, log_obj)
+            new_msg.id = next_id
+            new_msg.alt_turn = self.alt_turn_state
+            new_msg.log = {**(new_msg.log or {}), 'id': next_id}
 
-            log_json_str = json.dumps(log_obj) if log_obj is not None else '{}'
-            sql.execute \
-                ("INSERT INTO contexts_messages (context_id, member_id, role, msg, alt_turn, embedding_id, log) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                        (self.workflow.leaf_id, member_id, role, content, new_msg.alt_turn, None, log_json_str))
-            self.refresh_messages()
+            log_json_str = json.dumps(new_msg.log)
+            if not self.workflow.persist:
+                msg_id = next_id
+            else:
+                msg_id = sql.execute \
+                    ("INSERT INTO contexts_messages (context_id, member_id, role, msg, alt_turn, embedding_id, log) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (self.workflow.leaf_id, new_msg.member_id, new_msg.role, new_msg.content, new_msg.alt_turn, None, log_json_str))
+
+            if msg_id != next_id:
+                # another history inserted messages since the buffer was loaded
+                new_msg.id = msg_id
+                new_msg.log['id'] = msg_id
+                sql.execute("UPDATE contexts_messages SET log = ? WHERE id = ?", (json.dumps(new_msg.log), msg_id))
+                self.load_msg_id_buffer()
+
+            # Append in place instead of reloading the history, it's only reloaded on branch switches and edits
+            if len(self.messages) == 0:
+                self.reset_member_outputs()
+            self.messages.append(new_msg)
+            self.apply_member_outputs(new_msg)
+            self.update_workflow_outputs()
 
             return new_msg
 
+    def get_token_counts(self, model_name: Optional[str] = None, messages: List[Message] = None) -> Dict[int, int]:
+        """Returns {msg_id: token_count} using the tokenizer of `model_name`, persisting any newly counted messages"""
+        if messages is None:
+            messages = self.messages
+        encoding_name = get_encoding(model_name).name
+
+        counted_msgs = [msg for msg in messages if encoding_name not in msg.token_counts]
+        token_counts = {msg.id: msg.get_token_count(model_name) for msg in messages}
+        if counted_msgs and self.workflow.persist:
+            sql.execute_multiple(
+                ["UPDATE contexts_messages SET token_counts = ? WHERE id = ?"] * len(counted_msgs),
+                [(json.dumps(msg.token_counts), msg.id) for msg in counted_msgs],
+            )
+        return token_counts
+
     def get_workflow_from_full_member_id(self, full_member_id: str):  # !nestmember!
         walk_ids = full_member_id.split('.')[:-1]
         workflow = self.workflow
@@ -263,6 +432,7 @@ class MessageHistory:
                 'member_id': msg.member_id,
                 'content': msg.content,
                 'alt_turn': msg.alt_turn,
+                'loop_iteration': msg.loop_iteration,
             } for msg in self.messages
             if (incl_roles == 'all' or msg.role in incl_roles)
             and (base_member_id is None or msg.member_id.startswith(f'{base_member_id}.'))
@@ -294,7 +464,7 @@ class MessageHistory:
 
         return expanded_msgs
 
-    def get_llm_messages(self, calling_member_id='0', msg_limit=None, max_turns=None):
+    def get_llm_messages(self, calling_member_id='0', msg_limit=None, max_turns=None, token_budget=None, model_name=None, context_cuts=None):
         msgs = self.get(incl_roles='all', calling_member_id=calling_member_id)
         llm_accepted_roles = ('user', 'assistant', 'system', 'function', 'code', 'output', 'tool', 'result')
 
@@ -336,6 +506,10 @@ class MessageHistory:
             if len(msgs) > msg_limit:
                 msgs = msgs[-msg_limit:]
 
+        if token_budget:
+            overflow_policy = member_config.get('chat.on_context_overflow', 'Drop oldest')
+            msgs = self.apply_token_budget(msgs, token_budget, model_name, overflow_policy, context_cuts)
+
         if len(msgs) == 0:
             return []
 
@@ -473,6 +647,57 @@ class MessageHistory:
 
         return llm_msgs
 
+    def apply_token_budget(self, msgs, token_budget, model_name=None, overflow_policy='Drop oldest', context_cuts=None):
+        """
+        Cuts the oldest history messages until `msgs` fit in `token_budget`.
+        Preloaded messages and the latest message are always kept.
+        Each cut is appended to `context_cuts` as {'msg_id', 'action', 'tokens'}
+        """
+        if context_cuts is None:
+            context_cuts = []
+
+        msg_objs = {msg.id: msg for msg in self.messages}
+        history_msgs = [msg_objs[msg['id']] for msg in msgs if msg.get('id') in msg_objs]
+        token_counts = self.get_token_counts(model_name, messages=history_msgs)
+        msg_tokens = [
+            MESSAGE_TOKEN_OVERHEAD + (token_counts[msg['id']] if msg.get('id') in token_counts
+                                      else count_tokens(msg['content'], model_name))
+            for msg in msgs
+        ]
+
+        excess = sum(msg_tokens) - token_budget
+        if excess <= 0:
+            return msgs
+
+        cut_msgs = []
+        dropped_tool_call = False
+        for i, msg in enumerate(msgs):
+            is_latest = i == len(msgs) - 1
+            if excess <= 0 or is_latest or 'id' not in msg:
+                if msg['role'] == 'result' and dropped_tool_call and excess <= 0 and not is_latest:
+                    # the tool call of this result was dropped, some providers reject orphan results
+                    context_cuts.append({'msg_id': msg['id'], 'action': 'dropped', 'tokens': msg_tokens[i]})
+                    continue
+                dropped_tool_call = False
+                cut_msgs.append(msg)
+                continue
+
+            keep_tokens = msg_tokens[i] - MESSAGE_TOKEN_OVERHEAD - excess
+            can_truncate = (overflow_policy == 'Truncate oldest'
+                            and msg['role'] not in ('tool', 'result', 'image')
+                            and keep_tokens >= MIN_TRUNCATED_TOKENS)
+            if can_truncate:
+                truncated_msg = {**msg, 'content': truncate_tokens(msg['content'], keep_tokens, model_name)}
+                context_cuts.append({'msg_id': msg['id'], 'action': 'truncated', 'tokens': excess})
+                cut_msgs.append(truncated_msg)
+                excess = 0
+            else:
+                context_cuts.append({'msg_id': msg['id'], 'action': 'dropped', 'tokens': msg_tokens[i]})
+                dropped_tool_call = msg['role'] == 'tool'
+                excess -= msg_tokens[i]
+
+        return cut_msgs
+
     def count(self, incl_roles=('user', 'assistant')):
         return len([msg for msg in self.messages if msg.role in incl_roles])
 
@@ -0,0 +1,61 @@
+from typing import Any, Dict, List, Optional
+
+CACHE_CONTROL = {'type': 'ephemeral'}
+
+
+def mark_cache_prefix(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Returns the messages with cache breakpoints on the system message and the last message, without changing them.
+    The system message stays cached when the history is cut, the last one lets the next turn reuse the whole conversation.
+    """
+    breakpoints = {len(messages) - 1}
+    system_index = next((i for i, msg in enumerate(messages) if msg.get('role') == 'system'), None)
+    if system_index is not None:
+        breakpoints.add(system_index)
+    return [with_cache_control(msg) if i in breakpoints else msg for i, msg in enumerate(messages)]
+
+
+def with_cache_control(message: Dict[str, Any]) -> Dict[str, Any]:
+    content = message.get('content')
+    if isinstance(content, str) and content:
+        blocks = [{'type': 'text', 'text': content, 'cache_control': CACHE_CONTROL}]
+    elif isinstance(content, list) and content:
+        blocks = [*content[:-1], {**content[-1], 'cache_control': CACHE_CONTROL}]
+    else:
+        return message
+    return {**message, 'content': blocks}
+
+
+def strip_cache_control(message: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the message as the provider caches it, a marked text block is the same prefix as the plain text"""
+    content = message.get('content')
+    if not isinstance(content, list):
+        return message
+    blocks = [{k: v for k, v in block.items() if k != 'cache_control'} for block in content]
+    if len(blocks) == 1 and blocks[0].get('type') == 'text':
+        return {**message, 'content': blocks[0]['text']}
+    return {**message, 'content': blocks}
+
+
+def get_prompt_cache_usage(usage) -> Optional[Dict[str, int]]:
+    """
+    Returns the prompt tokens read from (hit) and not found in (miss) the provider's prompt cache, and those written to it.
+    Reads both the OpenAI `prompt_tokens_details.cached_tokens` and the Anthropic `cache_read_input_tokens` fields.
+    Returns None if the usage has no prompt cache counts.
+    """
+    if not usage:
+        return None
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = getattr(details, 'cached_tokens', None) if details else None
+    read_tokens = getattr(usage, 'cache_read_input_tokens', None)
+    write_tokens = getattr(usage, 'cache_creation_input_tokens', None)
+    if cached_tokens is None and read_tokens is None and write_tokens is None:
+        return None
+
+    hit_tokens = cached_tokens or read_tokens or 0
+    prompt_tokens = getattr(usage, 'prompt_tokens', None) or 0
+    return {
+        'hit_tokens': hit_tokens,
+        'miss_tokens': max(prompt_tokens - hit_tokens, 0),
+        'write_tokens': write_tokens or 0,
+    }
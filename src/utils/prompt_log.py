@@ -0,0 +1,116 @@
+import hashlib
+import json
+from typing import Any, Dict, Iterable, List, Optional
+
+from src.utils import sql
+
+
+def prompt_node_hash(parent_hash: Optional[str], message_json: str) -> str:
+    return hashlib.sha256(f"{parent_hash or ''}\n{message_json}".encode('utf-8')).hexdigest()
+
+
+def prompt_exists(prompt_hash: str) -> bool:
+    return sql.get_scalar("SELECT 1 FROM prompt_messages WHERE hash = ?", (prompt_hash,)) is not None
+
+
+def save_prompt(messages: List[Dict[str, Any]]) -> Optional[str]:
+    """
+    Stores a prompt as a chain of messages, each node references the prompt prefix before it.
+    Prompts sharing a prefix share its nodes, so a conversation is stored once instead of once per turn.
+    Returns the hash of the last node, or None for an empty prompt.
+    """
+    nodes = []  # [(hash, parent_hash, message_json)]
+    parent_hash = None
+    for message in messages:
+        message_json = json.dumps(message)
+        node_hash = prompt_node_hash(parent_hash, message_json)
+        nodes.append((node_hash, parent_hash, message_json))
+        parent_hash = node_hash
+
+    if not nodes:
+        return None
+
+    # A node is only stored after its parent, so the stored nodes are always a prefix of the chain
+    lo, hi = 0, len(nodes)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if prompt_exists(nodes[mid][0]):
+            lo = mid + 1
+        else:
+            hi = mid
+
+    new_nodes = nodes[lo:]
+    if new_nodes:
+        sql.execute_multiple(
+            ["INSERT OR IGNORE INTO prompt_messages (hash, parent_hash, message) VALUES (?, ?, ?)"] * len(new_nodes),
+            new_nodes,
+        )
+    return parent_hash
+
+
+def load_prompt(prompt_hash: str) -> List[Dict[str, Any]]:
+    """Returns the messages of a prompt saved with `save_prompt`"""
+    rows = sql.get_results("""
+        WITH RECURSIVE prompt_chain(hash, parent_hash, message, depth) AS (
+            SELECT hash, parent_hash, message, 0
+            FROM prompt_messages
+            WHERE hash = ?
+            UNION ALL
+            SELECT pm.hash, pm.parent_hash, pm.message, pc.depth + 1
+            FROM prompt_messages pm
+            JOIN prompt_chain pc ON pm.hash = pc.parent_hash
+        )
+        SELECT message
+        FROM prompt_chain
+        ORDER BY depth DESC""", (prompt_hash,))
+    return [json.loads(row[0]) for row in rows]
+
+
+# the prompt a message log references, indexed by idx_contexts_messages_prompt_hash so this must match it exactly
+LOG_PROMPT_HASH = "(CASE WHEN json_valid(log) THEN json_extract(log, '$.prompt_hash') END)"
+
+
+def get_prompt_hashes(where: str, params: tuple = ()) -> List[str]:
+    """Returns the prompts referenced by the logs of the messages matching `where`, get them before deleting the messages"""
+    return sql.get_results(f"""
+        SELECT DISTINCT {LOG_PROMPT_HASH}
+        FROM contexts_messages
+        WHERE {where} AND {LOG_PROMPT_HASH} IS NOT NULL""", params, return_type='list')
+
+
+def delete_unused_prompts(prompt_hashes: Iterable[str]):
+    """
+    Deletes the nodes of these prompts that no message log uses any more, call it after deleting the messages.
+    Walks up each chain until a node still referenced by a log or by another chain, so it only touches the deleted prompts.
+    """
+    pending = list(prompt_hashes)
+    while pending:
+        node_hash = pending.pop()
+        if sql.get_scalar(f"SELECT 1 FROM contexts_messages WHERE {LOG_PROMPT_HASH} = ? LIMIT 1", (node_hash,)):
+            continue
+        if sql.get_scalar("SELECT 1 FROM prompt_messages WHERE parent_hash = ? LIMIT 1", (node_hash,)):
+            continue
+        parent_hash = sql.get_scalar("SELECT parent_hash FROM prompt_messages WHERE hash = ?", (node_hash,))
+        sql.execute("DELETE FROM prompt_messages WHERE hash = ?", (node_hash,))
+        if parent_hash:
+            pending.append(parent_hash)
+
+
+def compact_log(log: Dict[str, Any]) -> Dict[str, Any]:
+    """Replaces the `messages` of a message log with a reference to the deduplicated prompt"""
+    if not isinstance(log.get('messages', None), list):
+        return log
+    return {
+        (k if k != 'messages' else 'prompt_hash'): (v if k != 'messages' else save_prompt(v))
+        for k, v in log.items()
+    }
+
+
+def expand_log(log: Dict[str, Any]) -> Dict[str, Any]:
+    """Restores the `messages` of a message log compacted with `compact_log`"""
+    if 'prompt_hash' not in log:
+        return log
+    return {
+        (k if k != 'prompt_hash' else 'messages'): (v if k != 'prompt_hash' else (load_prompt(v) if v else []))
+        for k, v in log.items()
+    }
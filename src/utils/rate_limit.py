@@ -0,0 +1,219 @@
+import asyncio
+import email.utils
+import json
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+RATE_LIMIT_STATUS = 429
+MAX_RATE_LIMIT_RETRIES = 3
+DEFAULT_RATE_LIMIT_WAIT = 2.0  # seconds before the first retry of a rate limit error without a retry-after hint
+
+_rate_limiters: Dict[Any, 'RateLimiter'] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Allows `per_minute` units a minute, refilled continuously, 0 is unlimited"""
+    def __init__(self, per_minute: float = 0):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if self.per_minute > 0:
+            self.level = min(self.level + (now - self.updated) * self.per_minute / 60, self.per_minute)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        if self.per_minute <= 0:
+            return 0.0
+        self.refill(now)
+        amount = min(amount, self.per_minute)  # a request bigger than a whole minute's budget waits for a full bucket
+        return max(amount - self.level, 0.0) * 60 / self.per_minute
+
+    def take(self, amount: float, now: float):
+        if self.per_minute > 0:
+            self.refill(now)
+            self.level -= amount  # can go below zero when usage is counted after the request
+
+
+class RateLimiter:
+    """
+    The request, token and concurrency limits of one API, shared by every member and event loop in the process.
+    Calls wait for a free slot first, so queued calls don't use up the rate budget while they wait.
+    """
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0, max_in_flight: int = 0):
+        self.lock = threading.Lock()
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.waiters = deque()  # (loop, future) of the calls waiting for a slot
+        self.paused_until = 0.0
+
+    def configure(self, requests_per_minute: float = 0, tokens_per_minute: float = 0, max_in_flight: int = 0):
+        with self.lock:
+            if self.requests.per_minute != requests_per_minute:
+                self.requests = TokenBucket(requests_per_minute)
+            if self.tokens.per_minute != tokens_per_minute:
+                self.tokens = TokenBucket(tokens_per_minute)
+            self.max_in_flight = max_in_flight
+
+    async def acquire(self, tokens: int = 0) -> float:
+        """Waits until a call using `tokens` is allowed and takes a slot for it, returns the seconds waited"""
+        start = time.monotonic()
+        waited = await self.acquire_slot()
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    wait = max(self.paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+                    if wait <= 0:
+                        self.requests.take(1, now)
+                        self.tokens.take(tokens, now)
+                        break
+                await asyncio.sleep(wait)
+                waited = True
+        except BaseException:
+            self.release_slot()
+            raise
+        return time.monotonic() - start if waited else 0.0
+
+    def release(self, extra_tokens: int = 0):
+        """Frees the slot of a finished call, `extra_tokens` are the tokens it used beyond the ones acquired"""
+        if extra_tokens:
+            with self.lock:
+                self.tokens.take(extra_tokens, time.monotonic())
+        self.release_slot()
+
+    def pause(self, seconds: float):
+        """Holds back every call to the API, after the server asked to retry later"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire_slot(self) -> bool:
+        """Takes a slot, returns whether the call had to queue for it"""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.max_in_flight <= 0 or self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                return False
+            future = loop.create_future()
+            waiter = (loop, future)
+            self.waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.lock:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                    raise
+            if future.done() and not future.cancelled():
+                self.release_slot()  # the slot was handed over as the call was cancelled
+            raise
+        return True
+
+    def release_slot(self):
+        with self.lock:
+            if self.waiters:
+                loop, future = self.waiters.popleft()
+                loop.call_soon_threadsafe(self.hand_over_slot, future)  # the slot passes on, in_flight stays the same
+                return
+            self.in_flight = max(self.in_flight - 1, 0)
+
+    def hand_over_slot(self, future: asyncio.Future):
+        if future.done():
+            self.release_slot()  # the waiter was cancelled, pass the slot on
+        else:
+            future.set_result(None)
+
+
+def get_rate_limiter(limiter_key: Any, config: Dict[str, Any]) -> RateLimiter:
+    """Returns the process-wide limiter of an API, with the limits in its `config`"""
+    limits = {
+        'requests_per_minute': config.get('requests_per_minute', 0) or 0,
+        'tokens_per_minute': config.get('tokens_per_minute', 0) or 0,
+        'max_in_flight': config.get('max_in_flight', 0) or 0,
+    }
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(limiter_key)
+        if limiter is None:
+            limiter = _rate_limiters[limiter_key] = RateLimiter(**limits)
+            return limiter
+    limiter.configure(**limits)
+    return limiter
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Returns the seconds a rate limit or overload error asks to wait, from its retry-after header"""
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        return float(retry_after)
+
+    headers = getattr(error, 'litellm_response_headers', None) or getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers.get('retry-after-ms')) / 1000
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            retry_date = email.utils.parsedate_to_datetime(value)  # an HTTP date
+            return max(retry_date.timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def estimate_request_tokens(messages: List[Dict[str, Any]]) -> int:
+    """Counts the prompt tokens of a request, before the provider reports its usage"""
+    from src.utils.messages import count_tokens
+    return sum(count_tokens(m['content'] if isinstance(m.get('content'), str) else json.dumps(m.get('content')))
+               for m in messages)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    return getattr(error, 'status_code', None) == RATE_LIMIT_STATUS or get_retry_after(error) is not None
+
+
+async def run_rate_limited(limiter: RateLimiter, run: Callable, tokens: int = 0, count_tokens: Optional[Callable] = None):
+    """
+    Runs `run()` within the limits, retrying rate limit errors after the wait the server asks for.
+    Returns (response, seconds waited), a streamed response holds its slot until the stream ends.
+    """
+    waited = 0.0
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        waited += await limiter.acquire(tokens)
+        try:
+            response = await run()
+        except Exception as e:
+            limiter.release()
+            if attempt == MAX_RATE_LIMIT_RETRIES or not is_rate_limit_error(e):
+                raise
+            retry_after = get_retry_after(e)
+            limiter.pause(retry_after if retry_after is not None else DEFAULT_RATE_LIMIT_WAIT * 2 ** attempt)
+            continue
+
+        if not hasattr(response, '__aiter__'):
+            limiter.release()
+            return response, waited
+        return release_after_stream(response, limiter, count_tokens), waited
+
+
+async def release_after_stream(stream, limiter: RateLimiter, count_tokens: Optional[Callable] = None):
+    output = ''
+    try:
+        async for chunk in stream:
+            if count_tokens and isinstance(chunk, str):
+                output += chunk  # structured output streams its JSON text
+            elif count_tokens:
+                delta = chunk.choices[0].get('delta') or {}
+                output += delta.get('content') or ''
+            yield chunk
+    finally:
+        limiter.release(count_tokens(output) if count_tokens and output else 0)
@@ -25,6 +25,7 @@ def reset_application(force=False, preserve_audio_msgs=False):  # todo temp pres
         backup_filepath = sql.get_db_path() + f'.backup{counter}'
         counter += 1
 
+    sql.close_connections()  # flush the WAL into the db file before copying
     shutil.copyfile(sql.get_db_path(), backup_filepath)
 
     reset_table(table_name='pypi_packages')
@@ -220,8 +221,11 @@ def reset_application(force=False, preserve_audio_msgs=False):  # todo temp pres
         """, return_type='rows')
 
     sql.execute('DELETE FROM contexts_messages')
+    sql.execute('DELETE FROM prompt_messages')
     reset_table(table_name='contexts')
     sql.execute('DELETE FROM logs')
+    sql.execute('DELETE FROM llm_usage')
+    sql.execute('DELETE FROM llm_usage_daily')
     sql.execute('DELETE FROM folders WHERE locked != 1')
     sql.execute('DELETE FROM pypi_packages')
     if audio_msgs:
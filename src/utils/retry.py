@@ -0,0 +1,147 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+
+from src.utils.rate_limit import RATE_LIMIT_STATUS
+
+NETWORK_ERROR = 'network'
+AUTH_ERROR = 'auth'
+RATE_LIMIT_ERROR = 'rate_limit'
+SERVER_ERROR = 'server'
+BAD_REQUEST_ERROR = 'bad_request'
+UNKNOWN_ERROR = 'unknown'
+TRANSIENT_ERRORS = (NETWORK_ERROR, RATE_LIMIT_ERROR, SERVER_ERROR)
+
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF_BASE = 0.5  # seconds, doubled each attempt
+RETRY_BACKOFF_MAX = 8.0
+CIRCUIT_FAILURE_THRESHOLD = 5  # consecutive failures that open the circuit
+CIRCUIT_RESET_SECONDS = 30.0
+CONNECTIVITY_TIMEOUT = 3.0
+DEFAULT_CONNECTIVITY_URL = 'https://google.com'
+
+# litellm and openai exception names, checked by name so litellm isn't imported to classify an error
+ERROR_CLASS_TYPES = {
+    'AuthenticationError': AUTH_ERROR,
+    'PermissionDeniedError': AUTH_ERROR,
+    'RateLimitError': RATE_LIMIT_ERROR,
+    'BadRequestError': BAD_REQUEST_ERROR,
+    'NotFoundError': BAD_REQUEST_ERROR,
+    'UnprocessableEntityError': BAD_REQUEST_ERROR,
+    'UnsupportedParamsError': BAD_REQUEST_ERROR,
+    'APIConnectionError': NETWORK_ERROR,
+    'APITimeoutError': NETWORK_ERROR,
+    'Timeout': NETWORK_ERROR,
+    'InternalServerError': SERVER_ERROR,
+    'ServiceUnavailableError': SERVER_ERROR,
+    'BadGatewayError': SERVER_ERROR,
+}
+
+_circuit_breakers: Dict[Any, 'CircuitBreaker'] = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of calling an API that has kept failing, until its circuit resets"""
+
+
+def classify_error(error: Exception) -> str:
+    """Returns whether a provider error is a network, auth, rate limit, server or bad request error"""
+    for error_class in type(error).__mro__:
+        if error_class.__name__ in ERROR_CLASS_TYPES:
+            return ERROR_CLASS_TYPES[error_class.__name__]
+
+    status_code = getattr(error, 'status_code', None)
+    if isinstance(status_code, int):
+        if status_code == RATE_LIMIT_STATUS:
+            return RATE_LIMIT_ERROR
+        if status_code in (401, 403):
+            return AUTH_ERROR
+        if status_code == 408:
+            return NETWORK_ERROR
+        if 400 <= status_code < 500:
+            return BAD_REQUEST_ERROR
+        if status_code >= 500:
+            return SERVER_ERROR
+
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError, OSError)):
+        return NETWORK_ERROR
+    return UNKNOWN_ERROR
+
+
+def get_backoff(attempt: int) -> float:
+    """Returns a jittered wait before retry `attempt`, so clients that failed together don't retry together"""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+
+async def endpoint_reachable(url: Optional[str] = None) -> bool:
+    """Checks a TCP connection to the host of `url` without blocking the event loop"""
+    parsed = urlparse(url or DEFAULT_CONNECTIVITY_URL)
+    if not parsed.hostname:
+        return True  # nothing to check
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(parsed.hostname, port), timeout=CONNECTIVITY_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+
+class CircuitBreaker:
+    """
+    Stops calls to an API after `failure_threshold` consecutive transient failures, for `reset_seconds`.
+    After that one trial call is let through, its success closes the circuit and its failure opens it again.
+    """
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_seconds: float = CIRCUIT_RESET_SECONDS):
+        self.lock = threading.Lock()
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def check(self):
+        """Raises `CircuitOpenError` if the API shouldn't be called now"""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_seconds - time.monotonic()
+            if remaining <= 0 and not self.trial_running:
+                self.trial_running = True
+                return
+        raise CircuitOpenError(f'The API failed {self.failures} times in a row, retrying in {max(remaining, 0):.0f}s.')
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def release_trial(self):
+        """Lets another trial call through, for a trial call that ended without a result, eg. cancelled"""
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+def get_circuit_breaker(breaker_key: Any) -> CircuitBreaker:
+    """Returns the process-wide circuit breaker of an API"""
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(breaker_key)
+        if breaker is None:
+            breaker = _circuit_breakers[breaker_key] = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+        return breaker
@@ -0,0 +1,109 @@
+import re
+from typing import Any, Dict, List, Optional
+
+from src.utils import sql
+
+SNIPPET_TOKENS = 12
+
+
+def to_fts_query(text: str) -> Optional[str]:
+    """Converts user input to an fts5 query matching all words, the last word as a prefix for search-as-you-type"""
+    words = re.findall(r'\w+', text or '')
+    if not words:
+        return None
+    quoted_words = [f'"{word}"' for word in words]
+    quoted_words[-1] += '*'
+    return ' '.join(quoted_words)
+
+
+def search_messages(text: str, context_id: Optional[int] = None, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+    """
+    Full-text search over message content, best matches first.
+    `context_id` limits the search to one chat and its branches.
+    Returns [{'msg_id', 'context_id', 'root_id', 'role', 'snippet', 'rank'}]
+    """
+    fts_query = to_fts_query(text)
+    if fts_query is None:
+        return []
+
+    context_filter = '' if context_id is None else 'AND (c.id = ? OR c.root_id = ?)'
+    context_params = () if context_id is None else (context_id, context_id)
+    rows = sql.get_results(f"""
+        SELECT
+            m.id,
+            m.context_id,
+            COALESCE(c.root_id, c.id),
+            m.role,
+            snippet(messages_fts, 0, '', '', '...', {SNIPPET_TOKENS}),
+            bm25(messages_fts)
+        FROM messages_fts
+        JOIN contexts_messages m ON m.id = messages_fts.rowid
+        JOIN contexts c ON c.id = m.context_id
+        WHERE messages_fts MATCH ?
+            {context_filter}
+        ORDER BY bm25(messages_fts)
+        LIMIT ? OFFSET ?""", (fts_query, *context_params, limit, offset))
+    return [
+        {'msg_id': msg_id, 'context_id': msg_context_id, 'root_id': root_id, 'role': role, 'snippet': snippet, 'rank': rank}
+        for msg_id, msg_context_id, root_id, role, snippet, rank in rows
+    ]
+
+
+def search_contexts(text: str, kind: str = 'CHAT', limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+    """
+    Full-text search over context names and message content, one result per chat, best matches first.
+    Name matches rank above message matches, bm25 scores of names and messages are not comparable.
+    Returns [{'context_id', 'name', 'config', 'msg_id', 'snippet', 'rank'}], `msg_id` is None for name matches
+    """
+    fts_query = to_fts_query(text)
+    if fts_query is None:
+        return []
+
+    rows = sql.get_results(f"""
+        WITH hits(root_id, msg_id, snippet, rank) AS (
+            SELECT
+                c.id,
+                NULL,
+                snippet(contexts_fts, 0, '', '', '...', {SNIPPET_TOKENS}),
+                bm25(contexts_fts)
+            FROM contexts_fts
+            JOIN contexts c ON c.id = contexts_fts.rowid
+            WHERE contexts_fts MATCH ?
+                AND c.parent_id IS NULL
+            UNION ALL
+            SELECT
+                COALESCE(c.root_id, c.id),
+                m.id,
+                snippet(messages_fts, 0, '', '', '...', {SNIPPET_TOKENS}),
+                bm25(messages_fts)
+            FROM messages_fts
+            JOIN contexts_messages m ON m.id = messages_fts.rowid
+            JOIN contexts c ON c.id = m.context_id
+            WHERE messages_fts MATCH ?
+        ),
+        best_hits AS (
+            SELECT
+                root_id,
+                msg_id,
+                snippet,
+                rank,
+                ROW_NUMBER() OVER (PARTITION BY root_id ORDER BY msg_id IS NOT NULL, rank) AS hit_num
+            FROM hits
+        )
+        SELECT
+            r.id,
+            r.name,
+            r.config,
+            h.msg_id,
+            h.snippet,
+            h.rank
+        FROM best_hits h
+        JOIN contexts r ON r.id = h.root_id
+        WHERE h.hit_num = 1
+            AND r.kind = ?
+        ORDER BY h.msg_id IS NOT NULL, h.rank, r.id DESC
+        LIMIT ? OFFSET ?""", (fts_query, fts_query, kind, limit, offset))
+    return [
+        {'context_id': context_id, 'name': name, 'config': config, 'msg_id': msg_id, 'snippet': snippet, 'rank': rank}
+        for context_id, name, config, msg_id, snippet, rank in rows
+    ]
@@ -13,6 +13,101 @@ sql_thread_lock = threading.Lock()
 DB_FILEPATH = None  # None will use default
 WRITE_TO_COPY = False
 
+CONNECTION_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA busy_timeout = 30000',
+]
+
+
+class ConnectionPool:
+    """
+    Long-lived connections to a single database file.
+    Reads are served from a pool of connections so they can run concurrently from any thread,
+    writes go through one connection serialized by `sql_thread_lock`.
+    """
+    def __init__(self, db_path, max_idle_readers=8):
+        self.db_path = db_path
+        self.max_idle_readers = max_idle_readers
+        self.lock = threading.Lock()
+        self.idle_readers = []
+        self.writer_conn = None
+        self.closed = False
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        for pragma in CONNECTION_PRAGMAS:
+            try:
+                conn.execute(pragma)
+            except sqlite3.DatabaseError:
+                pass  # eg. WAL is unavailable on some filesystems
+        return conn
+
+    @contextmanager
+    def reader(self):
+        with self.lock:
+            conn = self.idle_readers.pop() if self.idle_readers else None
+        if conn is None:
+            conn = self.connect()
+            conn.isolation_level = None  # autocommit, never hold a read transaction open
+        try:
+            yield conn
+        finally:
+            with self.lock:
+                if self.closed or len(self.idle_readers) >= self.max_idle_readers:
+                    conn.close()
+                else:
+                    self.idle_readers.append(conn)
+
+    @contextmanager
+    def writer(self):
+        with sql_thread_lock:
+            if self.writer_conn is None:
+                self.writer_conn = self.connect()
+            yield self.writer_conn
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle_readers, self.idle_readers = self.idle_readers, []
+        for conn in idle_readers:
+            conn.close()
+        with sql_thread_lock:
+            if self.writer_conn is not None:
+                self.writer_conn.close()
+                self.writer_conn = None
+
+
+_pools = {}  # {db_path: ConnectionPool}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path=None) -> ConnectionPool:
+    db_path = db_path or get_db_path()
+    pool = _pools.get(db_path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_path)
+            if pool is None:
+                pool = ConnectionPool(db_path)
+                _pools[db_path] = pool
+    return pool
+
+
+def close_connections(db_path=None):
+    """Close pooled connections, must be called before the database file is copied, moved or replaced."""
+    with _pools_lock:
+        if db_path is None:
+            pools = list(_pools.values())
+            _pools.clear()
+        else:
+            pool = _pools.pop(db_path, None)
+            pools = [pool] if pool else []
+    for pool in pools:
+        pool.close()
+
 
 @contextmanager
 def write_to_copy():
@@ -60,9 +155,8 @@ def get_db_path():
 
 
 def execute(query, params=None):
-    with sql_thread_lock:
-        db_path = get_db_path()
-        with sqlite3.connect(db_path) as conn:
+    with get_pool().writer() as conn:
+        with conn:
             cursor = conn.cursor()
 
             if params:
@@ -75,8 +169,7 @@ def execute(query, params=None):
 
 
 def get_results(query, params=None, return_type='rows', incl_column_names=False):
-    db_path = get_db_path()
-    with sqlite3.connect(db_path) as conn:
+    with get_pool().reader() as conn:
         cursor = conn.cursor()
 
         if params:
@@ -117,8 +210,7 @@ def get_results(query, params=None, return_type='rows', incl_column_names=False)
 
 
 def get_scalar(query, params=None, return_type='single', load_json=False):
-    db_path = get_db_path()
-    with sqlite3.connect(db_path) as conn:
+    with get_pool().reader() as conn:
         cursor = conn.cursor()
 
         if params:
@@ -159,20 +251,18 @@ def check_database_upgrade():
 
 
 def execute_multiple(queries, params_list):
-    with sql_thread_lock:
-        db_path = get_db_path()
-        with sqlite3.connect(db_path) as conn:
-            cursor = conn.cursor()
+    with get_pool().writer() as conn:
+        cursor = conn.cursor()
 
-            try:
-                for query, params in zip(queries, params_list):
-                    cursor.execute(query, params)
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                raise
-            finally:
-                cursor.close()
+        try:
+            for query, params in zip(queries, params_list):
+                cursor.execute(query, params)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
 
 
 def define_table(table_name, relations=None):
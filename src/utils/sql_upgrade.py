@@ -6,6 +6,7 @@ from src.utils import sql
 from packaging import version
 
 from src.utils.reset import bootstrap, ensure_system_folders
+from src.utils.prompt_log import LOG_PROMPT_HASH, compact_log
 from src.utils.sql import ensure_column_in_tables
 
 
@@ -18,8 +19,189 @@ class SQLUpgrade:
             '0.3.0': self.v0_3_0,
             '0.4.0': self.v0_4_0,
             '0.5.0': self.v0_5_0,
+            '0.5.1': self.v0_5_1,
         }
 
+    def v0_5_1(self):
+        # indexes for the context tree and message lookups
+        sql.execute("""
+            CREATE INDEX IF NOT EXISTS "idx_contexts_messages_context_id" ON "contexts_messages" ("context_id", "id")""")
+        sql.execute("""
+            CREATE INDEX IF NOT EXISTS "idx_contexts_parent_id" ON "contexts" ("parent_id", "branch_msg_id")""")
+        sql.execute("""
+            CREATE INDEX IF NOT EXISTS "idx_contexts_kind" ON "contexts" ("kind", "parent_id")""")
+
+        # root context of each branch context, so a chat's context tree is one indexed lookup
+        ensure_column_in_tables(
+            tables=['contexts'],
+            column_name='root_id',
+            column_type='INTEGER',
+            default_value='NULL',
+        )
+        sql.execute("""
+            WITH RECURSIVE context_tree(id, root_id) AS (
+                SELECT id, id
+                FROM contexts
+                WHERE parent_id IS NULL
+                UNION ALL
+                SELECT c.id, ct.root_id
+                FROM contexts c
+                JOIN context_tree ct ON c.parent_id = ct.id
+            )
+            UPDATE contexts
+            SET root_id = (SELECT ct.root_id FROM context_tree ct WHERE ct.id = contexts.id)
+            WHERE parent_id IS NOT NULL""")
+        sql.execute("""
+            CREATE INDEX IF NOT EXISTS "idx_contexts_root_id" ON "contexts" ("root_id")""")
+
+        # cached token counts of each message, {encoding_name: count}
+        ensure_column_in_tables(
+            tables=['contexts_messages'],
+            column_name='token_counts',
+            column_type='TEXT',
+            default_value='{}',
+            not_null=True,
+        )
+
+        # deduplicated prompt logs, each message references the prompt prefix before it
+        sql.execute("""
+            CREATE TABLE IF NOT EXISTS "prompt_messages" (
+                "hash"	TEXT NOT NULL,
+                "parent_hash"	TEXT,
+                "message"	TEXT NOT NULL,
+                PRIMARY KEY("hash")
+            ) WITHOUT ROWID""")
+        sql.execute("""
+            CREATE INDEX IF NOT EXISTS "idx_prompt_messages_parent_hash" ON "prompt_messages" ("parent_hash")""")
+        sql.execute(f"""
+            CREATE INDEX IF NOT EXISTS "idx_contexts_messages_prompt_hash" ON "contexts_messages" ({LOG_PROMPT_HASH})""")
+
+        logged_msgs = sql.get_results("""
+            SELECT id, log
+            FROM contexts_messages
+            WHERE json_valid(log) AND json_type(log, '$.messages') = 'array'""")
+        for msg_id, log in logged_msgs:
+            compacted_log = compact_log(json.loads(log))
+            sql.execute("UPDATE contexts_messages SET log = ? WHERE id = ?", (json.dumps(compacted_log), msg_id))
+
+        if len(logged_msgs) > 0:
+            sql.execute("""
+                VACUUM""")
+
+        # full-text search over message content and context names, kept in sync by triggers
+        sql.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                msg,
+                content='contexts_messages',
+                content_rowid='id',
+                prefix='2 3'
+            )""")
+        sql.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON contexts_messages BEGIN
+                INSERT INTO messages_fts(rowid, msg) VALUES (new.id, new.msg);
+            END""")
+        sql.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON contexts_messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, msg) VALUES ('delete', old.id, old.msg);
+            END""")
+        sql.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF msg ON contexts_messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, msg) VALUES ('delete', old.id, old.msg);
+                INSERT INTO messages_fts(rowid, msg) VALUES (new.id, new.msg);
+            END""")
+        sql.execute("""
+            INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')""")
+
+        sql.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS contexts_fts USING fts5(
+                name,
+                content='contexts',
+                content_rowid='id',
+                prefix='2 3'
+            )""")
+        sql.execute("""
+            CREATE TRIGGER IF NOT EXISTS contexts_fts_insert AFTER INSERT ON contexts BEGIN
+                INSERT INTO contexts_fts(rowid, name) VALUES (new.id, new.name);
+            END""")
+        sql.execute("""
+            CREATE TRIGGER IF NOT EXISTS contexts_fts_delete AFTER DELETE ON contexts BEGIN
+                INSERT INTO contexts_fts(contexts_fts, rowid, name) VALUES ('delete', old.id, old.name);
+            END""")
+        sql.execute("""
+            CREATE TRIGGER IF NOT EXISTS contexts_fts_update AFTER UPDATE OF name ON contexts BEGIN
+                INSERT INTO contexts_fts(contexts_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                INSERT INTO contexts_fts(rowid, name) VALUES (new.id, new.name);
+            END""")
+        sql.execute("""
+            INSERT INTO contexts_fts(contexts_fts) VALUES ('rebuild')""")
+
+        # token usage, latency and cost of each provider call, with per day and model totals kept by a trigger
+        sql.execute("""
+            CREATE TABLE IF NOT EXISTS "llm_usage" (
+                "id"	INTEGER,
+                "context_id"	INTEGER,
+                "member_id"	TEXT,
+                "provider"	TEXT NOT NULL,
+                "model"	TEXT NOT NULL,
+                "call_type"	TEXT NOT NULL DEFAULT 'chat',
+                "day"	TEXT NOT NULL,
+                "created_at"	REAL NOT NULL,
+                "prompt_tokens"	INTEGER NOT NULL DEFAULT 0,
+                "completion_tokens"	INTEGER NOT NULL DEFAULT 0,
+                "cached_tokens"	INTEGER NOT NULL DEFAULT 0,
+                "estimated"	INTEGER NOT NULL DEFAULT 0,
+                "time_to_first_token"	REAL,
+                "latency"	REAL NOT NULL DEFAULT 0,
+                "cost"	REAL,
+                "cache_hit"	INTEGER NOT NULL DEFAULT 0,
+                "error"	TEXT,
+                PRIMARY KEY("id")
+            )""")
+        sql.execute("""
+            CREATE INDEX IF NOT EXISTS "idx_llm_usage_context_id" ON "llm_usage" ("context_id", "member_id")""")
+        sql.execute("""
+            CREATE INDEX IF NOT EXISTS "idx_llm_usage_day" ON "llm_usage" ("day", "model")""")
+        sql.execute("""
+            CREATE TABLE IF NOT EXISTS "llm_usage_daily" (
+                "day"	TEXT NOT NULL,
+                "provider"	TEXT NOT NULL,
+                "model"	TEXT NOT NULL,
+                "calls"	INTEGER NOT NULL DEFAULT 0,
+                "errors"	INTEGER NOT NULL DEFAULT 0,
+                "prompt_tokens"	INTEGER NOT NULL DEFAULT 0,
+                "completion_tokens"	INTEGER NOT NULL DEFAULT 0,
+                "cached_tokens"	INTEGER NOT NULL DEFAULT 0,
+                "cost"	REAL NOT NULL DEFAULT 0,
+                "total_latency"	REAL NOT NULL DEFAULT 0,
+                "total_time_to_first_token"	REAL NOT NULL DEFAULT 0,
+                "first_token_calls"	INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY("day", "provider", "model")
+            ) WITHOUT ROWID""")
+        sql.execute("""
+            CREATE TRIGGER IF NOT EXISTS llm_usage_daily_insert AFTER INSERT ON llm_usage BEGIN
+                INSERT INTO llm_usage_daily (
+                    day, provider, model, calls, errors, prompt_tokens, completion_tokens, cached_tokens,
+                    cost, total_latency, total_time_to_first_token, first_token_calls
+                ) VALUES (
+                    new.day, new.provider, new.model, 1, new.error IS NOT NULL, new.prompt_tokens, new.completion_tokens,
+                    new.cached_tokens, COALESCE(new.cost, 0), new.latency, COALESCE(new.time_to_first_token, 0),
+                    new.time_to_first_token IS NOT NULL
+                )
+                ON CONFLICT(day, provider, model) DO UPDATE SET
+                    calls = calls + 1,
+                    errors = errors + excluded.errors,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    completion_tokens = completion_tokens + excluded.completion_tokens,
+                    cached_tokens = cached_tokens + excluded.cached_tokens,
+                    cost = cost + excluded.cost,
+                    total_latency = total_latency + excluded.total_latency,
+                    total_time_to_first_token = total_time_to_first_token + excluded.total_time_to_first_token,
+                    first_token_calls = first_token_calls + excluded.first_token_calls;
+            END""")
+
+        sql.execute("""
+            UPDATE settings SET value = '0.5.1' WHERE field = 'app_version'""")
+
     def v0_5_0(self):
         sql.execute("""
             UPDATE tools
@@ -1757,6 +1939,7 @@ class SQLUpgrade:
         copy_to_path = db_path + '.copy'
         if os.path.isfile(copy_to_path):
             os.remove(copy_to_path)
+        sql.close_connections()  # flush the WAL into the db file before copying
         shutil.copyfile(db_path, copy_to_path)
 
         # run the upgrade scripts
@@ -1767,6 +1950,8 @@ class SQLUpgrade:
                     run_script()
                     current_version = ver
 
+        sql.close_connections()
+
         # rename the original with .old
         old_filepath = db_path
         while os.path.isfile(old_filepath):
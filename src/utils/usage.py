@@ -0,0 +1,257 @@
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from src.utils import sql
+from src.utils.prompt_cache import get_prompt_cache_usage
+from src.utils.rate_limit import estimate_request_tokens
+
+CHAT_CALL = 'chat'
+STRUCTURED_CALL = 'structured'
+SCALAR_CALL = 'scalar'
+
+# the usage fields kept in a message log
+LOG_KEYS = ('prompt_tokens', 'completion_tokens', 'cached_tokens', 'estimated', 'time_to_first_token', 'latency', 'cost')
+
+
+def get_output_text(response) -> str:
+    """Returns the text and tool call arguments of a response or streamed chunk"""
+    if isinstance(response, str):
+        return response
+    choices = getattr(response, 'choices', None)
+    if not choices:
+        return ''
+    choice = choices[0]
+    message = choice.get('delta') or choice.get('message') or {}
+    text = message.get('content') or ''
+    for tool_call in message.get('tool_calls') or []:
+        function = getattr(tool_call, 'function', None)
+        text += getattr(function, 'arguments', None) or ''
+    return text
+
+
+class CallUsage:
+    """
+    The token usage and timings of one provider call, saved to `llm_usage` once the call ends.
+    Token counts the provider doesn't report are estimated from the request and the output, and marked as estimated.
+    Time queued by the API's rate limits isn't counted in the latencies.
+    """
+    def __init__(self,
+                 provider,
+                 model_obj: Dict[str, Any],
+                 call_type: str = CHAT_CALL,
+                 scope: Optional[Dict[str, Any]] = None,
+                 messages: Optional[List[Dict[str, Any]]] = None,
+                 on_usage: Optional[Callable] = None):
+        scope = scope or {}
+        self.provider = provider
+        self.model_obj = {**model_obj, 'model_params': dict(model_obj.get('model_params') or {})}  # providers may change it
+        self.call_type = call_type
+        self.context_id = scope.get('context_id')
+        self.member_id = scope.get('member_id')
+        self.messages = messages or []
+        self.on_usage = on_usage
+
+        self.created_at = time.time()
+        self.started_at = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.queue_time = 0.0
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+        self.cached_tokens = 0
+        self.cache_hit = False
+        self.output: List[str] = []
+        self.record: Optional[Dict[str, Any]] = None
+
+    def on_wait(self, seconds: float):
+        self.queue_time += seconds
+
+    def on_chunk(self, chunk):
+        """Reads a streamed chunk, or the whole response of a call that isn't streamed"""
+        if not isinstance(chunk, str):
+            if not self.cache_hit:
+                self.cache_hit = bool((getattr(chunk, '_hidden_params', None) or {}).get('cache_hit'))
+            self.set_usage(getattr(chunk, 'usage', None))
+        text = get_output_text(chunk)
+        if text:
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            self.output.append(text)
+
+    def set_usage(self, usage):
+        if not usage:
+            return
+        prompt_tokens = getattr(usage, 'prompt_tokens', None)
+        completion_tokens = getattr(usage, 'completion_tokens', None)
+        if prompt_tokens is not None:
+            self.prompt_tokens = prompt_tokens
+        if completion_tokens is not None:
+            self.completion_tokens = completion_tokens
+        cache_usage = get_prompt_cache_usage(usage)
+        if cache_usage:
+            self.cached_tokens = cache_usage['hit_tokens']
+
+    def finish(self, error: Optional[Exception] = None) -> Optional[Dict[str, Any]]:
+        """
+        Saves the usage, once. Returns the saved record.
+        Recording is best effort, it never raises into the response: tokens that can't be estimated are saved as 0, marked estimated.
+        """
+        if self.record is not None:
+            return None
+        ended_at = time.perf_counter()
+        model_name = self.model_obj.get('model_name')
+        estimated = self.prompt_tokens is None or self.completion_tokens is None
+        try:
+            if self.prompt_tokens is None:
+                self.prompt_tokens = estimate_request_tokens(self.messages)
+            if self.completion_tokens is None:
+                from src.utils.messages import count_tokens
+                self.completion_tokens = count_tokens(''.join(self.output), model_name)
+        except Exception as e:
+            print(f'Error estimating LLM usage: {e}')  # eg. the tokenizer can't be downloaded offline
+            self.prompt_tokens = self.prompt_tokens or 0
+            self.completion_tokens = self.completion_tokens or 0
+
+        time_to_first_token = None
+        if self.first_token_at is not None:
+            time_to_first_token = max(self.first_token_at - self.started_at - self.queue_time, 0.0)
+        record = {
+            'context_id': self.context_id,
+            'member_id': self.member_id,
+            'provider': self.model_obj.get('provider'),
+            'model': model_name,
+            'call_type': self.call_type,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cached_tokens': self.cached_tokens,
+            'estimated': estimated,
+            'time_to_first_token': time_to_first_token,
+            'latency': max(ended_at - self.started_at - self.queue_time, 0.0),
+            'cost': None,
+            'cache_hit': self.cache_hit,
+            'error': type(error).__name__ if error is not None else None,
+        }
+        if self.cache_hit:
+            record['cost'] = 0.0  # answered from the response cache, the API wasn't called
+        elif hasattr(self.provider, 'get_cost'):
+            try:
+                record['cost'] = self.provider.get_cost(self.model_obj, self.prompt_tokens, self.completion_tokens, self.cached_tokens)
+            except Exception as e:
+                print(f'Error getting LLM call cost: {e}')
+        self.record = record
+        save_usage(record, self.created_at)
+        if self.on_usage:
+            self.on_usage(record)
+        return record
+
+
+async def record_usage_stream(stream, usage: CallUsage):
+    """Passes the chunks through, and saves the call's usage once the stream ends, fails or is abandoned"""
+    error = None
+    try:
+        async for chunk in stream:
+            usage.on_chunk(chunk)
+            yield chunk
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        usage.finish(error)
+
+
+def save_usage(record: Dict[str, Any], created_at: float):
+    """Inserts a call's usage, the `llm_usage_daily` totals are updated by a trigger"""
+    try:
+        sql.execute("""
+            INSERT INTO llm_usage (
+                context_id, member_id, provider, model, call_type, day, created_at,
+                prompt_tokens, completion_tokens, cached_tokens, estimated,
+                time_to_first_token, latency, cost, cache_hit, error
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (
+            record['context_id'],
+            record['member_id'],
+            record['provider'] or '',
+            record['model'] or '',
+            record['call_type'],
+            time.strftime('%Y-%m-%d', time.localtime(created_at)),
+            created_at,
+            record['prompt_tokens'],
+            record['completion_tokens'],
+            record['cached_tokens'],
+            int(record['estimated']),
+            record['time_to_first_token'],
+            record['latency'],
+            record['cost'],
+            int(record['cache_hit']),
+            record['error'],
+        ))
+    except Exception as e:
+        print(f'Error saving LLM usage: {e}')  # the response is still returned
+
+
+def get_log_usage(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the usage to keep in a message log, rounded"""
+    log_usage = {}
+    for key in LOG_KEYS:
+        value = record.get(key)
+        if value is None or value is False or (key == 'cached_tokens' and not value):
+            continue
+        log_usage[key] = round(value, 3) if key in ('time_to_first_token', 'latency') else value
+    return log_usage
+
+
+def format_usage(usage: Dict[str, Any]) -> str:
+    """Returns a one line summary of a message's usage, eg. `120 + 35 tokens, 0.42s to first token, 1.30s, $0.000120`"""
+    parts = [f"{usage.get('prompt_tokens', 0)} + {usage.get('completion_tokens', 0)} tokens"]
+    if usage.get('estimated'):
+        parts[0] += ' (estimated)'
+    if usage.get('cached_tokens'):
+        parts.append(f"{usage['cached_tokens']} cached")
+    if usage.get('time_to_first_token') is not None:
+        parts.append(f"{usage['time_to_first_token']:.2f}s to first token")
+    if usage.get('latency') is not None:
+        parts.append(f"{usage['latency']:.2f}s")
+    if usage.get('cost') is not None:
+        parts.append(f"${usage['cost']:.6f}")
+    return ', '.join(parts)
+
+
+def get_context_usage(context_id: int) -> List[Dict[str, Any]]:
+    """Returns the usage totals of a context, per member and model"""
+    rows, col_names = sql.get_results("""
+        SELECT
+            member_id,
+            provider,
+            model,
+            COUNT(*) AS calls,
+            SUM(prompt_tokens) AS prompt_tokens,
+            SUM(completion_tokens) AS completion_tokens,
+            SUM(cached_tokens) AS cached_tokens,
+            SUM(cost) AS cost,
+            AVG(time_to_first_token) AS avg_time_to_first_token,
+            AVG(latency) AS avg_latency
+        FROM llm_usage
+        WHERE context_id = ?
+        GROUP BY member_id, provider, model
+        ORDER BY member_id, provider, model""", (context_id,), incl_column_names=True)
+    return [dict(zip(col_names, row)) for row in rows]
+
+
+def get_daily_usage(start_day: Optional[str] = None, end_day: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Returns the usage totals of each day and model from the rollup table, newest first. Days are `YYYY-MM-DD`"""
+    rows, col_names = sql.get_results("""
+        SELECT
+            day,
+            provider,
+            model,
+            calls,
+            errors,
+            prompt_tokens,
+            completion_tokens,
+            cached_tokens,
+            cost,
+            CASE WHEN first_token_calls > 0 THEN total_time_to_first_token / first_token_calls END AS avg_time_to_first_token,
+            total_latency / calls AS avg_latency
+        FROM llm_usage_daily
+        WHERE day >= ? AND day <= ?
+        ORDER BY day DESC, cost DESC, provider, model""", (start_day or '0000-00-00', end_day or '9999-99-99'), incl_column_names=True)
+    return [dict(zip(col_names, row)) for row in rows]
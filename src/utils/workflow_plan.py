@@ -0,0 +1,185 @@
+import hashlib
+import heapq
+import json
+import re
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+PARALLEL_MEMBER_TYPES = ('workflow', 'agent', 'block')
+MAX_CACHED_PLANS = 256
+
+_plan_cache: 'OrderedDict[str, WorkflowPlan]' = OrderedDict()
+
+
+class WorkflowCycleError(ValueError):
+    def __init__(self, member_ids: List[str]):
+        self.member_ids = member_ids
+        super().__init__(f"Workflow members have circular inputs: {' -> '.join(member_ids)}")
+
+
+class LoopConfigError(ValueError):
+    def __init__(self, source_id: str, target_id: str, stop_condition: str, error: re.error):
+        self.source_id = source_id
+        self.target_id = target_id
+        super().__init__(f"The looper input from member {source_id} to {target_id} has an invalid stop condition '{stop_condition}': {error}")
+
+
+def compile_stop_condition(source_id: str, target_id: str, stop_condition: str) -> Optional[re.Pattern]:
+    """Returns the compiled stop condition regex of a looper input, or None if it has none"""
+    if not stop_condition:
+        return None
+    try:
+        return re.compile(stop_condition)
+    except re.error as e:
+        raise LoopConfigError(source_id, target_id, stop_condition, e)
+
+
+class WorkflowPlan:
+    """
+    The execution plan of a workflow, compiled from its members and input edges.
+    `order` is a topological order, ties are broken by canvas position.
+    A member without inputs follows every member before it, like the turns of a chat.
+    Members in the same level can't depend on each other, so they can run in parallel.
+    """
+    def __init__(self,
+        order: List[str],
+        inputs: Dict[str, List[str]],
+        dependencies: Dict[str, List[str]],
+        levels: List[List[str]],
+        parallel_groups: List[List[str]],
+        looper_inputs: Dict[str, List[str]],
+    ):
+        self.order = order
+        self.inputs = inputs  # {member_id: [source_member_id]} of the non-looper input edges
+        self.dependencies = dependencies  # {member_id: [member_id]} that must finish first, including the implicit ones
+        self.levels = levels
+        self.parallel_groups = parallel_groups  # [[member_id]] of runnable members sharing a level
+        self.looper_inputs = looper_inputs  # {member_id: [source_member_id]} of the looper input edges
+        self.member_levels = {member_id: i for i, level in enumerate(levels) for member_id in level}
+        self.member_indexes = {member_id: i for i, member_id in enumerate(order)}
+        self._loop_bodies: Dict[Tuple[str, str], List[str]] = {}
+
+    def get_loop_body(self, target_id: str, source_id: str) -> List[str]:
+        """Returns the members a looper input from `source_id` to `target_id` runs again, in order"""
+        loop_key = (target_id, source_id)
+        if loop_key not in self._loop_bodies:
+            # the members between the target and the source, both included
+            descendants = {target_id}
+            for member_id in self.order[self.member_indexes[target_id] + 1:]:
+                if any(dep_id in descendants for dep_id in self.dependencies[member_id]):
+                    descendants.add(member_id)
+            ancestors = {source_id}
+            for member_id in reversed(self.order[:self.member_indexes[source_id] + 1]):
+                if member_id in ancestors:
+                    ancestors.update(self.dependencies[member_id])
+            self._loop_bodies[loop_key] = [member_id for member_id in self.order
+                                           if member_id in descendants and member_id in ancestors]
+        return self._loop_bodies[loop_key]
+
+
+def get_plan_key(members: List[Dict[str, Any]], inputs: List[Dict[str, Any]]) -> str:
+    """Hashes the parts of a workflow config that the plan depends on, so editing a member's settings keeps the plan"""
+    graph = {
+        'members': [(str(m['id']), m.get('config', {}).get('_TYPE', 'agent'), m.get('loc_x', 50), m.get('loc_y', 0)) for m in members],
+        'inputs': [(str(i['source_member_id']), str(i['target_member_id']), bool(i.get('config', {}).get('looper', False))) for i in inputs],
+    }
+    return hashlib.sha1(json.dumps(graph).encode('utf-8')).hexdigest()
+
+
+def get_workflow_plan(members: List[Dict[str, Any]], inputs: List[Dict[str, Any]]) -> WorkflowPlan:
+    """Returns the compiled plan of a workflow, cached by the hash of its graph"""
+    plan_key = get_plan_key(members, inputs)
+    plan = _plan_cache.get(plan_key)
+    if plan is not None:
+        _plan_cache.move_to_end(plan_key)
+        return plan
+
+    plan = compile_workflow_plan(members, inputs)
+    _plan_cache[plan_key] = plan
+    if len(_plan_cache) > MAX_CACHED_PLANS:
+        _plan_cache.popitem(last=False)
+    return plan
+
+
+def compile_workflow_plan(members: List[Dict[str, Any]], inputs: List[Dict[str, Any]]) -> WorkflowPlan:
+    member_ids = [str(m['id']) for m in members]
+    member_types = {str(m['id']): m.get('config', {}).get('_TYPE', 'agent') for m in members}
+    positions = {str(m['id']): (m.get('loc_x', 50), i) for i, m in enumerate(members)}
+
+    member_inputs = {member_id: [] for member_id in member_ids}
+    looper_inputs = {member_id: [] for member_id in member_ids}
+    dependents = {member_id: [] for member_id in member_ids}
+    for input_dict in inputs:
+        source_id, target_id = str(input_dict['source_member_id']), str(input_dict['target_member_id'])
+        if source_id not in member_inputs or target_id not in member_inputs:
+            raise ValueError(f"Workflow input references a missing member: {source_id} -> {target_id}")
+        if input_dict.get('config', {}).get('looper', False):
+            looper_inputs[target_id].append(source_id)
+            continue
+        if source_id in member_inputs[target_id]:
+            continue
+        member_inputs[target_id].append(source_id)
+        dependents[source_id].append(target_id)
+
+    # Kahn's algorithm, the ready member furthest left on the canvas goes first
+    pending_input_counts = {member_id: len(member_inputs[member_id]) for member_id in member_ids}
+    ready = [(positions[member_id], member_id) for member_id in member_ids if pending_input_counts[member_id] == 0]
+    heapq.heapify(ready)
+
+    order = []
+    dependencies = {}
+    member_levels = {}
+    frontier = []  # members that nothing added so far depends on
+    while ready:
+        _, member_id = heapq.heappop(ready)
+        if member_inputs[member_id]:
+            member_dependencies = member_inputs[member_id]
+        else:
+            member_dependencies = list(frontier)
+
+        order.append(member_id)
+        dependencies[member_id] = member_dependencies
+        member_levels[member_id] = max((member_levels[dep_id] + 1 for dep_id in member_dependencies), default=0)
+        dependency_set = set(member_dependencies)
+        frontier = [frontier_id for frontier_id in frontier if frontier_id not in dependency_set] + [member_id]
+
+        for dependent_id in dependents[member_id]:
+            pending_input_counts[dependent_id] -= 1
+            if pending_input_counts[dependent_id] == 0:
+                heapq.heappush(ready, (positions[dependent_id], dependent_id))
+
+    if len(order) < len(member_ids):
+        raise WorkflowCycleError(find_cycle({member_id: member_inputs[member_id]
+                                             for member_id in member_ids if member_id not in member_levels}))
+
+    levels = [[] for _ in range(max(member_levels.values(), default=-1) + 1)]
+    for member_id in order:
+        levels[member_levels[member_id]].append(member_id)
+
+    parallel_groups = []
+    for level in levels:
+        group = [member_id for member_id in level if member_types[member_id] in PARALLEL_MEMBER_TYPES]
+        if len(group) > 1:
+            parallel_groups.append(group)
+
+    return WorkflowPlan(
+        order=order,
+        inputs=member_inputs,
+        dependencies=dependencies,
+        levels=levels,
+        parallel_groups=parallel_groups,
+        looper_inputs=looper_inputs,
+    )
+
+
+def find_cycle(member_inputs: Dict[str, List[str]]) -> List[str]:
+    """Returns a cycle [a, b, ..., a] in the members left over by the topological sort, every one of them is in or after a cycle"""
+    member_id = next(iter(member_inputs))
+    path: List[str] = []
+    path_indexes: Dict[str, int] = {}
+    while member_id not in path_indexes:
+        path_indexes[member_id] = len(path)
+        path.append(member_id)
+        member_id = next(source_id for source_id in member_inputs[member_id] if source_id in member_inputs)
+    cycle = path[path_indexes[member_id]:] + [member_id]
+    return list(reversed(cycle))
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from src.utils import sql
+from src.utils.batch import JsonlResults, SqliteResults, open_batch_results, read_batch_rows, run_batch
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class EchoProvider:
+    """Echoes the last message after `model_params.delay` seconds like a local mock LLM, fails when the message says FAIL"""
+    async def run_model(self, model_obj, messages=None, **kwargs):
+        last_message = messages[-1]['content']
+        if 'FAIL' in last_message:
+            raise ConnectionError('Mock model failed')
+
+        async def stream():
+            await asyncio.sleep(model_obj['model_params'].get('delay', 0))
+            for i, word in enumerate(f'Echo {last_message}'.split(' ')):
+                yield SimpleNamespace(choices=[{'delta': {'content': word if i == 0 else ' ' + word}}])
+        return stream()
+
+    def get_model(self, model_obj):
+        return None
+
+    def get_model_context_window(self, model_obj):
+        return None
+
+
+def agent_config(delay=0.0):
+    model = {'kind': 'CHAT', 'provider': 'echo', 'model_name': 'echo', 'model_params': {'delay': delay}}
+    return {
+        '_TYPE': 'workflow',
+        'members': [
+            {'id': '1', 'agent_id': None, 'loc_x': 20, 'loc_y': 0, 'config': {'_TYPE': 'user'}},
+            {'id': '2', 'agent_id': None, 'loc_x': 100, 'loc_y': 0, 'config': {'_TYPE': 'agent', 'chat.model': model}},
+        ],
+        'inputs': [],
+    }
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        from src.system.base import manager
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+        self.providers_patch = mock.patch.dict(manager.providers.providers, {'echo': EchoProvider()})
+        self.providers_patch.start()
+
+    def tearDown(self):
+        self.providers_patch.stop()
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def path(self, filename):
+        return os.path.join(self.temp_dir.name, filename)
+
+    def run_batch(self, rows, results_path, config=None, concurrency=4):
+        results = open_batch_results(results_path)
+        try:
+            start = time.perf_counter()
+            summary = asyncio.run(run_batch(config or agent_config(), rows, results, concurrency=concurrency))
+            return summary, time.perf_counter() - start
+        finally:
+            results.close()
+
+    def test_read_batch_rows(self):
+        with open(self.path('rows.jsonl'), 'w') as f:
+            f.write('{"id": "a", "input": "first"}\n\n"second"\n{"prompt": "third"}\n')
+        self.assertEqual(read_batch_rows(self.path('rows.jsonl')), [('a', 'first'), ('3', 'second'), ('4', 'third')])
+
+        with open(self.path('bad.jsonl'), 'w') as f:
+            f.write('{"id": "a"}\n')
+        with self.assertRaises(ValueError):
+            read_batch_rows(self.path('bad.jsonl'))
+
+    def test_jsonl_results(self):
+        rows = [('1', 'hello'), ('2', 'FAIL please')]
+        summary, _ = self.run_batch(rows, self.path('results.jsonl'))
+        self.assertEqual(summary, {'skipped': 0, 'ok': 1, 'error': 1})
+
+        with open(self.path('results.jsonl')) as f:
+            results = {result['id']: result for result in map(json.loads, f)}
+        self.assertEqual(results['1']['output'], 'Echo hello')
+        self.assertEqual(results['1']['status'], 'ok')
+        self.assertGreater(results['1']['input_tokens'], 0)
+        self.assertGreater(results['1']['output_tokens'], 0)
+        self.assertEqual(results['2']['status'], 'error')
+        self.assertIn('Mock model failed', results['2']['error'])
+
+    def test_recorded_usage(self):
+        from src.plugins.mock.modules.provider_plugin import add_mock_api
+        from src.system.base import manager
+        add_mock_api()
+        manager.providers.load()
+        config = agent_config()
+        config['members'][1]['config']['chat.model'] = {'kind': 'CHAT', 'provider': 'mock', 'model_name': 'echo', 'model_params': {}}
+        # a provider's tokenizer counts differently than the local estimate
+        with mock.patch('src.plugins.mock.modules.provider_plugin.count_prompt_tokens', return_value=1000):
+            self.run_batch([('1', 'hello there')], self.path('results.jsonl'), config=config)
+
+        with open(self.path('results.jsonl')) as f:
+            result = json.loads(f.readline())
+        recorded = sql.get_results("SELECT SUM(prompt_tokens), SUM(completion_tokens), MAX(estimated) FROM llm_usage")[0]
+        self.assertEqual(recorded[2], 0)  # the mock reports its usage
+        self.assertEqual((result['input_tokens'], result['output_tokens']), tuple(recorded[:2]))
+        self.assertEqual(result['input_tokens'], 1000)
+
+    def test_sqlite_results(self):
+        summary, _ = self.run_batch([('1', 'hello'), ('2', 'world')], self.path('results.db'))
+        self.assertEqual(summary['ok'], 2)
+        self.assertIsInstance(open_batch_results(self.path('results.db')), SqliteResults)
+        self.assertIsInstance(open_batch_results(self.path('results.jsonl')), JsonlResults)
+
+        conn = sqlite3.connect(self.path('results.db'))
+        outputs = dict(conn.execute("SELECT id, output FROM results"))
+        conn.close()
+        self.assertEqual(outputs, {'1': 'Echo hello', '2': 'Echo world'})
+
+    def test_resume(self):
+        for filename in ('results.jsonl', 'results.db'):
+            with self.subTest(filename=filename):
+                self.run_batch([('1', 'hello'), ('2', 'FAIL')], self.path(filename))
+                # the ok row is skipped, the failed row runs again
+                summary, _ = self.run_batch([('1', 'hello'), ('2', 'retried'), ('3', 'new')], self.path(filename))
+                self.assertEqual(summary, {'skipped': 1, 'ok': 2, 'error': 0})
+
+                summary, _ = self.run_batch([('1', 'hello'), ('2', 'retried'), ('3', 'new')], self.path(filename))
+                self.assertEqual(summary, {'skipped': 3, 'ok': 0, 'error': 0})
+
+    def test_benchmark_throughput(self):
+        rows = [(str(i), f'row {i}') for i in range(40)]
+        config = agent_config(delay=0.05)
+        _, sequential_time = self.run_batch(rows, self.path('sequential.jsonl'), config, concurrency=1)
+        _, concurrent_time = self.run_batch(rows, self.path('concurrent.db'), config, concurrency=8)
+        print(f'\n40 rows with a 50ms mock LLM: {len(rows) / sequential_time:.1f} rows/s sequential, '
+              f'{len(rows) / concurrent_time:.1f} rows/s with a concurrency of 8')
+        self.assertLess(concurrent_time, sequential_time / 2)
+
+        # in-memory rows don't write to the app database
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM contexts_messages WHERE msg LIKE 'row %'"), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from src.system.blocks import BlockManager, compile_template
+from src.utils import sql
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestBlockManager(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+        sql.execute("DELETE FROM blocks")
+
+        self.blocks = BlockManager(parent=None)
+        self.workflow_runs = []
+        self.run_prompts = []
+
+        async def compute_block_async(name, params=None, prompt=None):
+            self.workflow_runs.append(name)
+            self.run_prompts.append(prompt)
+            return f'<{name} output {len(self.workflow_runs)}>'
+        self.blocks.compute_block_async = compute_block_async
+
+    def tearDown(self):
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def save_block(self, name, data, block_type='Text', **config):
+        config = {'_TYPE': 'block', 'block_type': block_type, 'data': data, **config}
+        if sql.get_scalar("SELECT 1 FROM blocks WHERE name = ?", (name,)):
+            sql.execute("UPDATE blocks SET config = ? WHERE name = ?", (json.dumps(config), name))
+        else:
+            sql.execute("INSERT INTO blocks (name, config) VALUES (?, ?)", (name, json.dumps(config)))
+        self.blocks.load()
+
+    def test_compile_template(self):
+        self.assertEqual(compile_template('Hi {name}, {name} and {other}!'),
+                         ((False, 'Hi '), (True, 'name'), (False, ', '), (True, 'name'), (False, ' and '), (True, 'other'), (False, '!')))
+        self.assertEqual(compile_template('no placeholders'), ((False, 'no placeholders'),))
+
+    def test_nested_blocks(self):
+        self.save_block('greeting', 'Hello {user-name}')
+        self.save_block('user-name', '{first-name} Smith')
+        self.save_block('first-name', 'Jane')
+        content = self.blocks.format_string('{greeting}. {unknown} {greeting}.', additional_blocks={'unknown': 'Bye'})
+        self.assertEqual(content, 'Hello Jane Smith. Bye Hello Jane Smith.')
+        self.assertEqual(self.workflow_runs, [])
+
+    def test_cache_invalidated_by_referenced_block(self):
+        self.save_block('greeting', 'Hello {user-name}')
+        self.save_block('user-name', 'Jane')
+        self.save_block('unrelated', 'Something else')
+        self.assertEqual(self.blocks.format_string('{greeting}'), 'Hello Jane')
+        self.assertEqual(set(self.blocks.block_cache), {'greeting', 'user-name'})
+
+        self.save_block('unrelated', 'Changed')
+        self.assertEqual(set(self.blocks.block_cache), {'greeting', 'user-name'})
+
+        self.save_block('user-name', 'John')
+        self.assertEqual(self.blocks.block_cache, {})
+        self.assertEqual(self.blocks.format_string('{greeting}'), 'Hello John')
+
+    def test_non_deterministic_blocks_are_not_cached(self):
+        self.save_block('machine', 'return 1', block_type='Code')
+        self.save_block('info', 'Machine: {machine}')
+        self.assertEqual(self.blocks.format_string('{info}'), 'Machine: <machine output 1>')
+        self.assertEqual(self.blocks.format_string('{info}'), 'Machine: <machine output 2>')
+        self.assertEqual(self.blocks.block_cache, {})
+
+    def test_cycle_detection(self):
+        self.save_block('a', 'A {b}')
+        self.save_block('b', 'B {c}')
+        self.save_block('c', 'C {a}')
+        with self.assertRaisesRegex(RecursionError, 'a -> b -> c -> a'):
+            self.blocks.compute_block('a')
+
+        self.save_block('c', 'C')
+        self.assertEqual(self.blocks.compute_block('a'), 'A B C')
+
+    def test_prompt_cache_ttl(self):
+        self.save_block('summary', 'Summarize {topic}', block_type='Prompt', prompt_model={'model_name': 'gpt-4o'}, cache_ttl=600)
+        self.save_block('topic', 'cats')
+        self.assertEqual(self.blocks.compute_block('summary'), '<summary output 1>')
+        self.assertEqual(self.blocks.compute_block('summary'), '<summary output 1>')
+
+        self.save_block('topic', 'dogs')
+        self.assertEqual(self.blocks.compute_block('summary'), '<summary output 2>')
+
+        self.save_block('summary', 'Summarize {topic}', block_type='Prompt', prompt_model={'model_name': 'gpt-4o'}, cache_ttl=60)
+        self.save_block('topic', 'birds')
+        self.assertEqual(self.blocks.compute_block('summary'), '<summary output 3>')
+        with mock.patch('src.system.blocks.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(self.blocks.compute_block('summary'), '<summary output 4>')
+        self.assertEqual(len(self.blocks.prompt_cache), 3)
+        self.assertEqual(self.run_prompts, ['Summarize cats', 'Summarize dogs', 'Summarize birds', 'Summarize birds'])
+
+    def test_prompt_cache_off_by_default(self):
+        self.save_block('joke', 'Tell me a joke', block_type='Prompt', prompt_model={'model_name': 'gpt-4o', 'model_params': {'temperature': 1}})
+        self.assertEqual(self.blocks.compute_block('joke'), '<joke output 1>')
+        self.assertEqual(self.blocks.compute_block('joke'), '<joke output 2>')
+        self.assertEqual(self.blocks.prompt_cache, {})
+
+    def test_prompt_formatted_once(self):
+        self.save_block('machine', 'return 1', block_type='Code')
+        self.save_block('summary', 'Summarize {machine}', block_type='Prompt', prompt_model={'model_name': 'gpt-4o'})
+        self.assertEqual(self.blocks.compute_block('summary'), '<summary output 2>')
+        self.assertEqual(self.workflow_runs, ['machine', 'summary'])  # the nested block ran once
+        self.assertEqual(self.run_prompts[-1], 'Summarize <machine output 1>')  # the prompt the cache key was made from
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from src import cli
+from src.utils import sql
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestCli(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.db_path = os.path.join(cls.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), cls.db_path)
+        config = {
+            '_TYPE': 'workflow',
+            'members': [
+                {'id': '1', 'agent_id': None, 'loc_x': 20, 'loc_y': 0, 'config': {'_TYPE': 'user', 'info.name': 'User'}},
+                {'id': '2', 'agent_id': None, 'loc_x': 100, 'loc_y': 0, 'config': {'_TYPE': 'block', 'block_type': 'Text', 'data': 'You said: {user_1}'}},
+            ],
+            'inputs': [],
+        }
+        with sql.write_to_file(cls.db_path):
+            cls.entity_id = sql.execute("INSERT INTO entities (name, kind, config) VALUES ('Echo', 'AGENT', ?)", (json.dumps(config),))
+        sql.close_connections(cls.db_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    def run_cli(self, *args, input_text=None):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-m', 'src.cli', *args, '--db', self.db_path],
+                                input=input_text, capture_output=True, text=True, cwd=PACKAGE_DIR, timeout=120)
+        return result, time.perf_counter() - start
+
+    def test_text_output(self):
+        result, _ = self.run_cli('Echo', '-m', 'hello')
+        self.assertEqual(result.returncode, cli.EXIT_OK, result.stderr)
+        self.assertEqual(result.stdout, 'You said: hello\n')
+
+        result, _ = self.run_cli(str(self.entity_id), input_text='from stdin')
+        self.assertEqual(result.stdout, 'You said: from stdin\n')
+
+    def test_jsonl_output(self):
+        result, _ = self.run_cli('Echo', '-m', 'hello', '--format', 'jsonl')
+        events = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual(events[0], {'type': 'chunk', 'role': 'block', 'content': 'You said: hello'})
+        self.assertEqual(events[-1]['type'], 'done')
+        self.assertIsNone(events[-1]['context_id'])
+
+    def test_exit_codes(self):
+        result, _ = self.run_cli('Missing', '-m', 'hello', '--format', 'jsonl')
+        self.assertEqual(result.returncode, cli.EXIT_NOT_FOUND)
+        self.assertEqual(json.loads(result.stdout)['type'], 'error')
+
+        result, _ = self.run_cli('Echo', input_text='')
+        self.assertEqual(result.returncode, cli.EXIT_USAGE)
+
+    def test_no_gui(self):
+        code = ("import sys; from src import cli; exit_code = cli.main(['Echo', '-m', 'hi', '--db', sys.argv[1]]); "
+                "from PySide6.QtWidgets import QApplication; print('src.gui.main' in sys.modules, QApplication.instance()); sys.exit(exit_code)")
+        result = subprocess.run([sys.executable, '-c', code, self.db_path], capture_output=True, text=True, cwd=PACKAGE_DIR, timeout=120)
+        self.assertEqual(result.returncode, cli.EXIT_OK, result.stderr)
+        self.assertEqual(result.stdout.splitlines()[-1], 'False None')
+
+    def test_no_multimedia(self):
+        # a server without audio libraries can't import QtMultimedia
+        code = ("import sys; sys.modules['PySide6.QtMultimedia'] = None; from src import cli; "
+                "sys.exit(cli.main(['Echo', '-m', 'hi', '--db', sys.argv[1]]))")
+        result = subprocess.run([sys.executable, '-c', code, self.db_path], capture_output=True, text=True, cwd=PACKAGE_DIR, timeout=120)
+        self.assertEqual(result.returncode, cli.EXIT_OK, result.stderr)
+        self.assertEqual(result.stdout, 'You said: hi\n')
+
+    def test_batch(self):
+        batch_path = os.path.join(self.temp_dir.name, 'batch.jsonl')
+        with open(batch_path, 'w') as f:
+            f.write('{"id": "a", "input": "one"}\n{"id": "b", "input": "two"}\n')
+        result, _ = self.run_cli('Echo', '--batch', batch_path, '--concurrency', '2', '--format', 'jsonl')
+        self.assertEqual(result.returncode, cli.EXIT_OK, result.stderr)
+        events = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual(events[-1], {'type': 'done', 'skipped': 0, 'ok': 2, 'error': 0})
+
+        with open(batch_path + '.results.jsonl') as f:
+            outputs = {r['id']: r['output'] for r in map(json.loads, f)}
+        self.assertEqual(outputs, {'a': 'You said: one', 'b': 'You said: two'})
+
+    def test_benchmark_startup(self):
+        result, _ = self.run_cli('Echo', '-m', 'hello', '--format', 'jsonl')
+        timing = json.loads(result.stdout.splitlines()[-1])
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import src.gui.main'], capture_output=True, cwd=PACKAGE_DIR, timeout=120)
+        gui_import_time = time.perf_counter() - start
+
+        print(f"\nHeadless first token {timing['first_token_ms']}ms, GUI imports alone {gui_import_time * 1000:.0f}ms")
+        self.assertLess(timing['first_token_ms'] / 1000, gui_import_time / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
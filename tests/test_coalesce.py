@@ -0,0 +1,159 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from src.utils import sql
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def mock_model(**model_params):
+    return {'kind': 'CHAT', 'provider': 'mock', 'model_name': 'echo', 'model_params': model_params}
+
+
+class TestCoalesce(unittest.TestCase):
+    def setUp(self):
+        from src.system.base import manager
+        from src.plugins.mock.modules.provider_plugin import add_mock_api
+        import src.members.workflow  # noqa, applies nest_asyncio like the app
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+        add_mock_api()
+        manager.providers.load()
+        self.manager = manager
+        self.provider = manager.providers.providers['mock']
+
+        self.open_streams = 0
+        original_stream = self.provider.stream
+
+        async def counted_stream(*args):
+            self.open_streams += 1
+            try:
+                async for chunk in original_stream(*args):
+                    yield chunk
+            finally:
+                self.open_streams -= 1
+
+        self.patches = [
+            mock.patch.object(self.provider, 'run_model', wraps=self.provider.run_model),
+            mock.patch.object(self.provider, 'stream', counted_stream),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    async def stream(self, model, message='Will it rain today?'):
+        response = await self.manager.providers.run_model(model, messages=[{'role': 'user', 'content': message}])
+        return ''.join([chunk.choices[0].delta.content or '' async for chunk in response])
+
+    def get_cache_hits(self):
+        return sql.get_results("SELECT cache_hit FROM llm_usage ORDER BY id", return_type='list')
+
+    def test_identical_requests_share_call(self):
+        model = mock_model(time_to_first_token=0.1, tokens_per_second=100.0)
+
+        async def run():
+            return await asyncio.gather(self.stream(model), self.stream(model), self.stream(model))
+
+        self.assertEqual(asyncio.run(run()), ['Will it rain today?'] * 3)
+        self.assertEqual(self.provider.run_model.call_count, 1)
+        self.assertEqual(sorted(self.get_cache_hits()), [0, 1, 1])  # each caller's usage is recorded
+
+    def test_different_requests_not_shared(self):
+        model = mock_model(time_to_first_token=0.1)
+
+        async def run():
+            return await asyncio.gather(self.stream(model, 'one'), self.stream(model, 'two'), self.stream(mock_model(), 'one'))
+
+        self.assertEqual(asyncio.run(run()), ['one', 'two', 'one'])
+        self.assertEqual(self.provider.run_model.call_count, 3)
+
+        asyncio.run(self.stream(model, 'one'))  # the earlier one finished
+        self.assertEqual(self.provider.run_model.call_count, 4)
+
+    def test_late_joiner_gets_whole_stream(self):
+        model = mock_model(tokens_per_second=20.0)
+
+        async def run():
+            first = asyncio.create_task(self.stream(model))
+            await asyncio.sleep(0.1)  # a few tokens in
+            return await asyncio.gather(first, self.stream(model))
+
+        self.assertEqual(asyncio.run(run()), ['Will it rain today?'] * 2)
+        self.assertEqual(self.provider.run_model.call_count, 1)
+
+    def test_cancelled_waiter(self):
+        model = mock_model(time_to_first_token=0.1, tokens_per_second=20.0)
+
+        async def run():
+            first = asyncio.create_task(self.stream(model))
+            second = asyncio.create_task(self.stream(model))
+            await asyncio.sleep(0.15)
+            first.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            return await second
+
+        self.assertEqual(asyncio.run(run()), 'Will it rain today?')
+        self.assertEqual(self.provider.run_model.call_count, 1)
+
+    def test_all_waiters_gone(self):
+        model = mock_model(time_to_first_token=0.1, tokens_per_second=5.0)
+
+        async def run():
+            tasks = [asyncio.create_task(self.stream(model)) for _ in range(2)]
+            await asyncio.sleep(0.3)
+            self.assertEqual(self.open_streams, 1)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.sleep(0)
+            self.assertEqual(self.open_streams, 0)  # the provider's stream was closed
+
+            return await self.stream(model)  # a new request isn't joined to the cancelled one
+
+        self.assertEqual(asyncio.run(run()), 'Will it rain today?')
+        self.assertEqual(self.provider.run_model.call_count, 2)
+
+    def test_error_reaches_every_waiter(self):
+        from src.plugins.mock.modules.provider_plugin import MockProviderError
+        model = mock_model(time_to_first_token=0.1, error='Overloaded', error_after=2)
+
+        async def run():
+            return await asyncio.gather(self.stream(model), self.stream(model), return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertTrue(all(isinstance(result, MockProviderError) for result in results))
+        self.assertEqual(self.provider.run_model.call_count, 1)
+
+    def test_scalar_from_threads(self):
+        model = mock_model(time_to_first_token=0.3)
+        results = []
+        with mock.patch.object(self.provider, 'get_scalar', wraps=self.provider.get_scalar) as get_scalar:
+            threads = [
+                threading.Thread(target=lambda: results.append(self.manager.providers.get_scalar('A title', model_obj=model)))
+                for _ in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(results, ['A title'] * 2)
+        self.assertEqual(get_scalar.call_count, 1)
+        self.assertEqual(sorted(self.get_cache_hits()), [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from src.utils import sql
+from src.utils.llm_cache import ResponseCache, close_response_caches, get_response_cache
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def mock_model(**params):
+    return {'kind': 'CHAT', 'provider': 'mock', 'model_name': 'echo', 'model_params': {'cache_responses': True, **params}}
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        from src.system.base import manager
+        from src.plugins.mock.modules.provider_plugin import add_mock_api
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+        add_mock_api()
+        manager.providers.load()
+        self.manager = manager
+        self.provider = manager.providers.providers['mock']
+
+    def tearDown(self):
+        close_response_caches()
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def stream(self, model, message='hello there'):
+        async def run():
+            response = await self.manager.providers.run_model(model, messages=[{'role': 'user', 'content': message}])
+            return [chunk async for chunk in response]
+        return asyncio.run(run())
+
+    def run_agent(self, model):
+        from src.members.workflow import Workflow
+        config = {
+            '_TYPE': 'workflow',
+            'members': [
+                {'id': '1', 'agent_id': None, 'loc_x': 20, 'loc_y': 0, 'config': {'_TYPE': 'user'}},
+                {'id': '2', 'agent_id': None, 'loc_x': 100, 'loc_y': 0, 'config': {'_TYPE': 'agent', 'chat.model': model}},
+            ],
+            'inputs': [],
+        }
+        workflow = Workflow(config=config, persist=False)
+        workflow.save_message('user', 'hello there', member_id='1')
+
+        async def receive():
+            return ''.join([chunk async for key, chunk in workflow.behaviour.receive()])
+        return asyncio.run(receive()), workflow.message_history.messages[-1]
+
+    def test_replay(self):
+        with mock.patch.object(self.provider, 'run_model', wraps=self.provider.run_model) as run_model:
+            first_chunks = self.stream(mock_model(response='One two three'))
+            second_chunks = self.stream(mock_model(response='One two three'))
+            self.assertEqual(run_model.call_count, 1)
+
+            self.stream(mock_model(response='One two three'), message='something else')
+            self.stream(mock_model(response='One two three', temperature=0.5))
+            self.assertEqual(run_model.call_count, 3)
+
+        contents = [[c.choices[0].delta.content for c in chunks] for chunks in (first_chunks, second_chunks)]
+        self.assertEqual(contents[0], contents[1])
+        self.assertEqual(second_chunks[-1].choices[0].finish_reason, 'stop')
+        self.assertTrue(second_chunks[0]._hidden_params['cache_hit'])
+
+    def test_opt_in(self):
+        with mock.patch.object(self.provider, 'run_model', wraps=self.provider.run_model) as run_model:
+            self.stream(mock_model(cache_responses=False))
+            self.stream(mock_model(cache_responses=False))
+            self.assertEqual(run_model.call_count, 2)
+
+    def test_failed_stream_not_cached(self):
+        with self.assertRaises(ConnectionError):
+            self.stream(mock_model(error='Reset', error_type='Connection', error_after=1))
+        self.assertEqual(get_response_cache().sizes, {})
+
+    def test_cache_hit_in_log(self):
+        model = mock_model()
+        output, msg = self.run_agent(model)
+        self.assertNotIn('cache_hit', msg.log)
+
+        replayed_output, msg = self.run_agent(model)
+        self.assertEqual(replayed_output, output)
+        self.assertTrue(msg.log['cache_hit'])
+
+    def test_persistent(self):
+        with mock.patch.object(self.provider, 'run_model', wraps=self.provider.run_model) as run_model:
+            self.stream(mock_model())
+            close_response_caches()
+            self.stream(mock_model())
+            self.assertEqual(run_model.call_count, 1)
+
+    def test_get_scalar(self):
+        with mock.patch.object(self.provider, 'get_scalar', wraps=self.provider.get_scalar) as get_scalar:
+            titles = [self.manager.providers.get_scalar('A title', single_line=True, model_obj=mock_model()) for _ in range(2)]
+            self.assertEqual(titles, ['A title', 'A title'])
+            self.assertEqual(get_scalar.call_count, 1)
+
+    def test_eviction(self):
+        cache = ResponseCache(os.path.join(self.temp_dir.name, 'small_cache.db'), max_bytes=1000)
+        for i in range(20):
+            cache.put(f'key {i}', {'chunks': [{'content': 'x' * 100}]})
+        self.assertLessEqual(cache.total_size, 1000)
+        self.assertIsNone(cache.get('key 0'))
+        self.assertIsNotNone(cache.get('key 19'))
+
+        cache.get('key 15')  # used recently, so it outlives the entries after it
+        for i in range(20, 26):
+            cache.put(f'key {i}', {'chunks': [{'content': 'x' * 100}]})
+        self.assertIsNotNone(cache.get('key 15'))
+        self.assertIsNone(cache.get('key 16'))
+        cache.close()
+
+    def test_benchmark_miss(self):
+        cache = get_response_cache()
+        for i in range(1000):
+            cache.put(f'key {i}', {'chunks': [{'content': 'cached'}]})
+
+        lookup_count = 10000
+        start = time.perf_counter()
+        for i in range(lookup_count):
+            self.manager.providers.get_cache_key(mock_model(), {'messages': [{'role': 'user', 'content': f'miss {i}'}]})
+            cache.get(f'miss {i}')
+        miss_time = (time.perf_counter() - start) / lookup_count
+
+        start = time.perf_counter()
+        for i in range(1000):
+            cache.get(f'key {i}')
+        hit_time = (time.perf_counter() - start) / 1000
+        print(f'\nCache miss including the key hash {miss_time * 1e6:.1f}us, hit {hit_time * 1e6:.1f}us')
+        self.assertLess(miss_time, 0.0002)
+
+
+if __name__ == '__main__':
+    unittest.main()
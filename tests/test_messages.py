@@ -0,0 +1,398 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from src.utils import sql
+from src.utils.messages import count_tokens, TRUNCATED_SUFFIX
+from src.utils.prompt_log import compact_log, delete_unused_prompts, expand_log, get_prompt_hashes
+from src.utils.search import search_contexts, search_messages
+from src.utils.sql_upgrade import upgrade_script
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestMessageHistory(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.db_path = os.path.join(cls.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), cls.db_path)
+        sql.set_db_filepath(cls.db_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        cls.temp_dir.cleanup()
+
+    def new_workflow(self):
+        from src.members.workflow import Workflow
+        return Workflow()
+
+    def add_turn(self, workflow, i):
+        message_history = workflow.message_history
+        if message_history.messages:
+            message_history.alt_turn_state = 1 - message_history.alt_turn_state
+        workflow.save_message('user', f'Question {i}', member_id='1')
+        workflow.save_message('assistant', f'Answer {i}', member_id='2')
+
+    def test_add_matches_reload(self):
+        workflow = self.new_workflow()
+        for i in range(25):
+            self.add_turn(workflow, i)
+        message_history = workflow.message_history
+
+        added = [(m.id, m.role, m.content, m.member_id, m.alt_turn, m.log) for m in message_history.messages]
+        last_outputs = dict(message_history.member_last_outputs)
+        turn_outputs = dict(message_history.member_turn_outputs)
+
+        message_history.load()
+        loaded = [(m.id, m.role, m.content, m.member_id, m.alt_turn, m.log) for m in message_history.messages]
+        self.assertEqual(added, loaded)
+        self.assertEqual(last_outputs, message_history.member_last_outputs)
+        self.assertEqual(turn_outputs, message_history.member_turn_outputs)
+        self.assertEqual(workflow.members['2'].last_output, 'Answer 24')
+
+    def test_truncate_recomputes_outputs(self):
+        workflow = self.new_workflow()
+        for i in range(3):
+            self.add_turn(workflow, i)
+        message_history = workflow.message_history
+
+        message_history.truncate(message_history.messages[-2].id)
+        self.assertEqual(len(message_history.messages), 4)
+        self.assertEqual(workflow.members['1'].last_output, 'Question 1')
+        self.assertEqual(workflow.members['2'].last_output, 'Answer 1')
+
+    def test_token_counts_are_lazy_and_persisted(self):
+        workflow = self.new_workflow()
+        self.add_turn(workflow, 0)
+        message_history = workflow.message_history
+        self.assertEqual(message_history.messages[0].token_counts, {})
+
+        token_counts = message_history.get_token_counts(model_name='gpt-4o')
+        self.assertEqual(list(token_counts.values()), [count_tokens('Question 0', 'gpt-4o'), count_tokens('Answer 0', 'gpt-4o')])
+
+        message_history.load()
+        self.assertEqual(list(message_history.messages[0].token_counts), ['o200k_base'])
+        self.assertEqual(message_history.messages[0].get_token_count('openai/gpt-4o'), token_counts[message_history.messages[0].id])
+        self.assertEqual(message_history.messages[0].get_token_count('mistral/mistral-large-latest'), count_tokens('Question 0'))
+
+    def test_token_budget(self):
+        workflow = self.new_workflow()
+        for i in range(5):
+            self.add_turn(workflow, i)
+        workflow.save_message('user', 'word ' * 500, member_id='1')
+        message_history = workflow.message_history
+
+        all_msgs = message_history.get_llm_messages(calling_member_id='2')
+        context_cuts = []
+        msgs = message_history.get_llm_messages(calling_member_id='2', token_budget=60, context_cuts=context_cuts)
+        self.assertEqual(msgs[-1], all_msgs[-1])
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual([cut['action'] for cut in context_cuts], ['dropped'] * 10)
+
+        workflow.members['2'].config['chat.on_context_overflow'] = 'Truncate oldest'
+        workflow.save_message('user', 'Short question', member_id='1')
+        context_cuts = []
+        msgs = message_history.get_llm_messages(calling_member_id='2', token_budget=200, context_cuts=context_cuts)
+        self.assertEqual(len(msgs), 2)
+        self.assertTrue(msgs[0]['content'].endswith(TRUNCATED_SUFFIX))
+        self.assertLessEqual(sum(count_tokens(msg['content']) + 4 for msg in msgs), 210)
+        self.assertEqual([cut['action'] for cut in context_cuts], ['dropped'] * 10 + ['truncated'])
+
+    def test_benchmark_token_budget(self):
+        workflow = self.new_workflow()
+        for i in range(2500):
+            self.add_turn(workflow, i)
+        message_history = workflow.message_history
+        message_history.get_token_counts()
+
+        start = time.perf_counter()
+        msgs = message_history.get_llm_messages(calling_member_id='2', token_budget=8000)
+        elapsed = time.perf_counter() - start
+
+        print(f'\nToken budget on 5,000 messages: {elapsed * 1000:.1f}ms')
+        self.assertLess(sum(count_tokens(msg['content']) for msg in msgs), 8000)
+        self.assertLess(elapsed, 0.5)
+
+    def test_benchmark_add(self):
+        workflow = self.new_workflow()
+        sample_size = 50
+        per_add_times = {}
+        for history_size in (10, 100, 1000, 10000):
+            while len(workflow.message_history.messages) < history_size:
+                self.add_turn(workflow, len(workflow.message_history.messages))
+
+            start = time.perf_counter()
+            for i in range(sample_size // 2):
+                self.add_turn(workflow, i)
+            per_add_times[history_size] = (time.perf_counter() - start) / sample_size
+
+        print('\nTime per add: ' + ', '.join(f'{size} messages {t * 1000:.2f}ms' for size, t in per_add_times.items()))
+        self.assertLess(per_add_times[10000], per_add_times[10] * 3)
+
+
+class TestSearch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.db_path = os.path.join(cls.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), cls.db_path)
+        sql.set_db_filepath(cls.db_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        cls.temp_dir.cleanup()
+
+    def new_workflow(self, **kwargs):
+        from src.members.workflow import Workflow
+        return Workflow(**kwargs)
+
+    def test_ranking_and_pagination(self):
+        workflow = self.new_workflow()
+        for i in range(30):
+            workflow.save_message('user', f'Message {i} ' + 'quokka ' * (i + 1) + 'filler ' * 20, member_id='1')
+
+        results = search_messages('quokka', context_id=workflow.context_id, limit=30)
+        self.assertEqual(len(results), 30)
+        ranks = [result['rank'] for result in results]
+        self.assertEqual(ranks, sorted(ranks))
+        self.assertTrue(all('quokka' in result['snippet'] for result in results))
+        self.assertEqual(workflow.message_history.messages[-1].id, results[0]['msg_id'])
+
+        pages = [search_messages('quok', context_id=workflow.context_id, limit=10, offset=offset) for offset in (0, 10, 20, 30)]
+        self.assertEqual([len(page) for page in pages], [10, 10, 10, 0])
+        self.assertEqual([result['msg_id'] for page in pages for result in page], [result['msg_id'] for result in results])
+
+    def test_index_follows_edits_and_deletes(self):
+        workflow = self.new_workflow()
+        msg = workflow.save_message('user', 'The wombat sleeps', member_id='1')
+        self.assertEqual([result['msg_id'] for result in search_messages('wombat')], [msg.id])
+
+        sql.execute("UPDATE contexts_messages SET msg = ? WHERE id = ?", ('The platypus sleeps', msg.id))
+        self.assertEqual(search_messages('wombat'), [])
+        self.assertEqual([result['msg_id'] for result in search_messages('platypus')], [msg.id])
+
+        sql.execute("DELETE FROM contexts_messages WHERE id = ?", (msg.id,))
+        self.assertEqual(search_messages('platypus'), [])
+
+    def test_search_contexts(self):
+        named_workflow = self.new_workflow()
+        sql.execute("UPDATE contexts SET name = ? WHERE id = ?", ('Echidna facts', named_workflow.context_id))
+        named_workflow.save_message('user', 'Tell me about the echidna', member_id='1')
+        workflow = self.new_workflow()
+        msg = workflow.save_message('user', 'Is an echidna a mammal?', member_id='1')
+
+        results = search_contexts('echidna')
+        self.assertEqual([result['context_id'] for result in results], [named_workflow.context_id, workflow.context_id])
+        self.assertEqual(results[0]['name'], 'Echidna facts')
+        self.assertIsNone(results[0]['msg_id'])
+        self.assertEqual(results[1]['msg_id'], msg.id)
+        self.assertEqual(search_contexts('echidna', kind='BLOCK'), [])
+
+    def test_activate_branch_path(self):
+        workflow = self.new_workflow()
+        message_history = workflow.message_history
+        question = workflow.save_message('user', 'Original question', member_id='1')
+        answer = workflow.save_message('assistant', 'The answer mentions a numbat', member_id='2')
+
+        # Edit the question, as `start_new_branch` does
+        message_history.truncate(question.id)
+        workflow.leaf_id = sql.execute("INSERT INTO contexts (kind, parent_id, branch_msg_id, root_id) VALUES ('CHAT', ?, ?, ?)",
+                                       (workflow.context_id, question.id, workflow.context_id))
+        workflow.save_message('user', 'Edited question', member_id='1')
+        workflow.save_message('assistant', 'Edited answer', member_id='2')
+        message_history.load()
+        self.assertNotIn(answer.id, [m.id for m in message_history.messages])
+
+        result = search_messages('numbat', context_id=workflow.context_id)[0]
+        workflow = self.new_workflow(context_id=workflow.context_id)
+        workflow.message_history.activate_branch_path(result['msg_id'])
+        workflow.message_history.load()
+        self.assertEqual([m.id for m in workflow.message_history.messages], [question.id, answer.id])
+
+        # And back into the branch
+        edited_answer_id = search_messages('edited answer', context_id=workflow.context_id)[0]['msg_id']
+        workflow.message_history.activate_branch_path(edited_answer_id)
+        workflow.message_history.load()
+        self.assertEqual([m.content for m in workflow.message_history.messages], ['Edited question', 'Edited answer'])
+
+    def test_benchmark_add(self):
+        sample_size = 500
+
+        def time_adds():
+            workflow = self.new_workflow()
+            start = time.perf_counter()
+            for i in range(sample_size):
+                workflow.save_message('user', f'Question {i} ' + 'lorem ipsum dolor sit amet ' * 20, member_id='1')
+            return (time.perf_counter() - start) / sample_size
+
+        indexed_time = time_adds()
+        triggers = sql.get_results("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'messages_fts_%'")
+        for name, _ in triggers:
+            sql.execute(f"DROP TRIGGER {name}")
+        try:
+            unindexed_time = time_adds()
+        finally:
+            for _, trigger_sql in triggers:
+                sql.execute(trigger_sql)
+            sql.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+        print(f'\nTime per add: indexed {indexed_time * 1000:.2f}ms, unindexed {unindexed_time * 1000:.2f}ms')
+        self.assertLess(indexed_time - unindexed_time, 0.001)
+
+
+class TestEphemeralWorkflow(unittest.TestCase):
+    def setUp(self):
+        from src.system.base import manager
+        from src.system.tools import ToolManager
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+
+        tool_config = {'_TYPE': 'block', 'block_type': 'Text', 'data': 'Hello {name}'}
+        sql.execute("INSERT INTO tools (name, config) VALUES ('greet', ?)", (json.dumps(tool_config),))
+        self.tools = ToolManager(parent=manager)
+        self.tools.load()
+        self.tool_uuid = next(iter(self.tools.tool_id_names))
+
+    def tearDown(self):
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def count_writes(self, func, *args, **kwargs):
+        with mock.patch.object(sql, 'execute', wraps=sql.execute) as execute, \
+                mock.patch.object(sql, 'execute_multiple', wraps=sql.execute_multiple) as execute_multiple:
+            result = func(*args, **kwargs)
+        return result, execute.call_count + execute_multiple.call_count
+
+    def counts(self):
+        return sql.get_results("SELECT (SELECT COUNT(*) FROM contexts), (SELECT COUNT(*) FROM contexts_messages)")[0]
+
+    def test_tool_writes(self):
+        from src.system.base import manager
+        counts_before = self.counts()
+        result, ephemeral_writes = self.count_writes(self.tools.compute_tool, self.tool_uuid, {'name': 'Ada'})
+        self.assertEqual(json.loads(result), {'output': 'Hello Ada', 'status': 'success', 'tool_uuid': self.tool_uuid})
+        self.assertEqual(self.counts(), counts_before)
+
+        with mock.patch.dict(manager.config.dict, {'system.persist_sub_workflows': True}):
+            persisted_result, persisted_writes = self.count_writes(self.tools.compute_tool, self.tool_uuid, {'name': 'Ada'})
+        self.assertEqual(persisted_result, result)
+        context_count, msg_count = self.counts()
+        self.assertEqual((context_count - counts_before[0], msg_count - counts_before[1]), (1, 1))
+
+        print(f'\nDB writes per tool call: persisted {persisted_writes}, ephemeral {ephemeral_writes}')
+        self.assertEqual(ephemeral_writes, 0)
+        self.assertGreater(persisted_writes, 0)
+
+    def test_ephemeral_history(self):
+        from src.members.workflow import Workflow
+        workflow = Workflow(persist=False)
+        self.assertIsNone(workflow.context_id)
+        workflow.save_message('user', 'Question', member_id='1')
+        workflow.save_message('assistant', 'Answer', member_id='2')
+        self.assertEqual([(m.id, m.content) for m in workflow.message_history.messages], [(1, 'Question'), (2, 'Answer')])
+        self.assertEqual(workflow.members['2'].last_output, 'Answer')
+
+
+class TestPromptLog(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        sql.set_db_filepath(self.new_db('data.db'))
+
+    def tearDown(self):
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def new_db(self, filename):
+        db_path = os.path.join(self.temp_dir.name, filename)
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        return db_path
+
+    def synthetic_logs(self, turn_count):
+        messages = [{'role': 'system', 'content': 'You are a helpful assistant. ' * 20}]
+        for i in range(turn_count):
+            messages.append({'role': 'user', 'content': f'Question {i} ' + 'lorem ipsum ' * 30})
+            yield {'id': 0, 'context_id': 1, 'member_id': '2', 'model': {'model_name': 'gpt-4o'},
+                   'messages': list(messages), 'role_responses': {'assistant': f'Answer {i}'}}
+            messages.append({'role': 'assistant', 'content': f'Answer {i} ' + 'dolor sit amet ' * 30})
+
+    def insert_logs(self, logs):
+        for log in logs:
+            sql.execute("INSERT INTO contexts_messages (context_id, member_id, role, msg, log) VALUES (1, '2', 'assistant', '', ?)",
+                        (json.dumps(log),))
+
+    def db_size(self):
+        sql.execute("VACUUM")
+        return sql.get_scalar("SELECT page_count * page_size FROM pragma_page_count(), pragma_page_size()")
+
+    def test_round_trip(self):
+        logs = list(self.synthetic_logs(5))
+        for log in logs:
+            compacted = compact_log(log)
+            self.assertNotIn('messages', compacted)
+            self.assertEqual(json.dumps(expand_log(compacted)), json.dumps(log))
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM prompt_messages"), 10)
+
+    def test_migration(self):
+        logs = list(self.synthetic_logs(5))
+        self.insert_logs(logs)
+        upgrade_script.v0_5_1()
+
+        stored_logs = [json.loads(log) for log in sql.get_results("SELECT log FROM contexts_messages WHERE role = 'assistant' ORDER BY id", return_type='list')]
+        self.assertTrue(all('prompt_hash' in log for log in stored_logs))
+        self.assertEqual([expand_log(log) for log in stored_logs], logs)
+
+    def test_delete_unused(self):
+        logs = list(self.synthetic_logs(4))
+        self.insert_logs(compact_log(log) for log in logs[:2])
+        other_log = compact_log({**logs[3], 'messages': logs[3]['messages'][:1] + [{'role': 'user', 'content': 'Other chat'}]})
+        sql.execute("INSERT INTO contexts_messages (context_id, member_id, role, msg, log) VALUES (2, '2', 'assistant', '', ?)",
+                    (json.dumps(other_log),))
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM prompt_messages"), 5)
+
+        last_msg_id = sql.get_scalar("SELECT MAX(id) FROM contexts_messages WHERE context_id = 1")
+        prompt_hashes = get_prompt_hashes("id = ?", (last_msg_id,))
+        sql.execute("DELETE FROM contexts_messages WHERE id = ?", (last_msg_id,))
+        delete_unused_prompts(prompt_hashes)
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM prompt_messages"), 3)  # the first prompt is still used
+
+        prompt_hashes = get_prompt_hashes("context_id = ?", (1,))
+        sql.execute("DELETE FROM contexts_messages WHERE context_id = 1")
+        delete_unused_prompts(prompt_hashes)
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM prompt_messages"), 2)  # the shared system message is kept
+        self.assertEqual(expand_log(other_log)['messages'][1]['content'], 'Other chat')
+
+        prompt_hashes = get_prompt_hashes("1")
+        sql.execute("DELETE FROM contexts_messages")
+        delete_unused_prompts(prompt_hashes)
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM prompt_messages"), 0)
+
+    def test_size_of_long_chat(self):
+        turn_count = 300
+        empty_size = self.db_size()
+        self.insert_logs(self.synthetic_logs(turn_count))
+        full_size = self.db_size()
+
+        sql.set_db_filepath(self.new_db('compact.db'))
+        self.insert_logs(compact_log(log) for log in self.synthetic_logs(turn_count))
+        compact_size = self.db_size()
+
+        print(f'\nLog storage for a {turn_count} turn chat: '
+              f'full prompts {(full_size - empty_size) / 1e6:.1f}MB, deduplicated {(compact_size - empty_size) / 1e6:.2f}MB')
+        self.assertLess(compact_size - empty_size, (full_size - empty_size) / 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
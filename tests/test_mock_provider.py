@@ -0,0 +1,175 @@
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from src.utils import sql
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def mock_model(**params):
+    return {'kind': 'CHAT', 'provider': 'mock', 'model_name': 'echo', 'model_params': params}
+
+
+class TestMockProvider(unittest.TestCase):
+    def setUp(self):
+        from src.system.base import manager
+        from src.plugins.mock.modules.provider_plugin import add_mock_api
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+        add_mock_api()
+        manager.providers.load()
+        self.manager = manager
+
+    def tearDown(self):
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def run_agent(self, model, message='hello there', tools_table=()):
+        from src.members.workflow import Workflow
+        config = {
+            '_TYPE': 'workflow',
+            'members': [
+                {'id': '1', 'agent_id': None, 'loc_x': 20, 'loc_y': 0, 'config': {'_TYPE': 'user'}},
+                {'id': '2', 'agent_id': None, 'loc_x': 100, 'loc_y': 0, 'config': {'_TYPE': 'agent', 'chat.model': model}},
+            ],
+            'inputs': [],
+        }
+        workflow = Workflow(config=config, persist=False)
+        agent = workflow.members['2']
+        agent.tools_table = list(tools_table)
+
+        async def stream():
+            return [(role, chunk) async for role, chunk in agent.stream(model, [{'role': 'user', 'content': message}])]
+        return asyncio.run(stream())
+
+    def test_loaded_from_database(self):
+        provider = self.manager.providers.providers['mock']
+        self.assertEqual(provider.get_model({'kind': 'CHAT', 'model_name': 'slow'})['tokens_per_second'], 20.0)
+
+    def test_not_shipped(self):
+        from src.plugins.mock.modules.provider_plugin import add_mock_api
+        shipped_db = sqlite3.connect(f"file:{os.path.join(PACKAGE_DIR, 'data.db')}?mode=ro", uri=True)
+        self.assertIsNone(shipped_db.execute("SELECT id FROM apis WHERE provider_plugin = 'mock'").fetchone())
+        shipped_db.close()
+        self.assertEqual(add_mock_api(), add_mock_api())  # added once
+
+    def test_echo_and_script(self):
+        chunks = self.run_agent(mock_model())
+        self.assertEqual(''.join(chunk for _, chunk in chunks), 'hello there')
+
+        chunks = self.run_agent(mock_model(response='You said: {input}'))
+        self.assertEqual(''.join(chunk for _, chunk in chunks), 'You said: hello there')
+
+    def test_xml_roles(self):
+        model = mock_model(response='<think>hmm</think>Hi', **{'xml_roles.data': [{'xml_tag': 'think', 'map_to_role': 'thought'}]})
+        chunks = self.run_agent(model)
+        roles = {}
+        for role, chunk in chunks:
+            roles[role] = roles.get(role, '') + chunk
+        self.assertEqual(roles.get('thought'), 'hmm')
+        self.assertEqual(roles.get('assistant'), '<think></think>Hi')  # the tags stay in the default role
+
+    def test_tool_calls(self):
+        tool_config = {'description': 'Gets the weather', 'params': [{'name': 'city', 'description': 'The city', 'type': 'String', 'req': True, 'default': ''}]}
+        model = mock_model(response='Checking', tool_call='Get weather', tool_arguments='{"city": "Paris, France"}')
+        chunks = self.run_agent(model, tools_table=[('uuid', 'Get weather', json.dumps(tool_config))])
+        tools = dict(chunks)['tools']
+        self.assertEqual(len(tools), 1)
+        self.assertEqual(tools[0]['function'], {'name': 'get_weather', 'arguments': '{"city": "Paris, France"}'})
+        self.assertTrue(tools[0]['id'].startswith('call_'))
+
+        chunks = self.run_agent(model)  # without the tool
+        self.assertNotIn('tools', dict(chunks))
+
+    def test_structured_output(self):
+        model = mock_model(**{'structure.data': [{'attribute': 'Answer', 'type': 'str', 'req': True},
+                                                 {'attribute': 'Score', 'type': 'int', 'req': True}]})
+        output = asyncio.run(self.manager.providers.get_structured_output(model, messages=[{'role': 'user', 'content': 'hi'}]))
+        self.assertEqual(json.loads(output), {'answer': 'hi', 'score': 0})
+
+    def test_streamed_structured_output(self):
+        from src.members.workflow import Workflow
+        model = mock_model(time_to_first_token=0.2, **{'structure.data': [{'attribute': 'Answer', 'type': 'str', 'req': True},
+                                                                          {'attribute': 'Score', 'type': 'int', 'req': True}]})
+        config = {
+            '_TYPE': 'workflow',
+            'members': [
+                {'id': '1', 'agent_id': None, 'loc_x': 20, 'loc_y': 0, 'config': {'_TYPE': 'user'}},
+                {'id': '2', 'agent_id': None, 'loc_x': 100, 'loc_y': 0, 'config': {'_TYPE': 'agent', 'chat.model': model}},
+            ],
+            'inputs': [],
+        }
+        agent = Workflow(config=config, persist=False).members['2']
+
+        async def stream(message):
+            return [chunk async for _, chunk in agent.stream_structured_output(model, [{'role': 'user', 'content': message}])]
+
+        async def stream_both():
+            return await asyncio.gather(stream('hello there'), stream('hi'))
+
+        start = time.perf_counter()
+        first_chunks, second_chunks = asyncio.run(stream_both())
+        self.assertLess(time.perf_counter() - start, 0.35)  # the two members waited at the same time
+        self.assertGreater(len(first_chunks), 1)
+        self.assertEqual(json.loads(''.join(first_chunks)), {'answer': 'hello there', 'score': 0})
+        self.assertEqual(json.loads(''.join(second_chunks)), {'answer': 'hi', 'score': 0})
+
+    def test_injected_errors(self):
+        from src.plugins.mock.modules.provider_plugin import MockProviderError
+        with self.assertRaises(MockProviderError) as cm:
+            self.run_agent(mock_model(error='Overloaded', error_type='Rate limit'))
+        self.assertEqual(cm.exception.status_code, 429)
+
+        with self.assertRaises(ConnectionError):
+            self.run_agent(mock_model(error='Reset', error_type='Connection', error_after=2), message='one two three four')
+
+        # the same prompts fail on every run
+        model = mock_model(error_rate=0.5, seed=1)
+        outcomes = []
+        for _ in range(2):
+            run_outcomes = []
+            for i in range(20):
+                try:
+                    self.run_agent(model, message=f'message {i}')
+                    run_outcomes.append(True)
+                except MockProviderError:
+                    run_outcomes.append(False)
+            outcomes.append(run_outcomes)
+        self.assertEqual(outcomes[0], outcomes[1])
+        self.assertTrue(0 < outcomes[0].count(False) < 20)
+
+    def test_timing(self):
+        provider = self.manager.providers.providers['mock']
+        model = mock_model(response=' '.join(['word'] * 20), time_to_first_token=0.2, tokens_per_second=100.0)
+
+        async def stream():
+            start = time.perf_counter()
+            chunk_times = []
+            response = await provider.run_model(model, messages=[{'role': 'user', 'content': 'hi'}])
+            async for chunk in response:
+                chunk_times.append(time.perf_counter() - start)
+                last_chunk = chunk
+            return chunk_times, last_chunk
+
+        chunk_times, last_chunk = asyncio.run(stream())
+        self.assertAlmostEqual(chunk_times[0], 0.2, delta=0.05)
+        self.assertAlmostEqual(chunk_times[-1], 0.2 + 19 / 100, delta=0.05)
+        self.assertEqual(last_chunk.choices[0].finish_reason, 'stop')
+        self.assertEqual(last_chunk.usage.completion_tokens, 20)
+
+    def test_get_scalar(self):
+        provider = self.manager.providers.providers['mock']
+        self.assertEqual(provider.get_scalar('first\nsecond', single_line=True, model_obj=mock_model()), 'first')
+
+
+if __name__ == '__main__':
+    unittest.main()
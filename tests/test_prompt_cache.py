@@ -0,0 +1,119 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from src.utils import sql
+from src.utils.llm_cache import ResponseObject
+from src.utils.prompt_cache import get_prompt_cache_usage, mark_cache_prefix, strip_cache_control
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SYSTEM_MESSAGE = 'You are a helpful assistant that answers questions about the weather. ' * 20
+
+
+class TestPromptCache(unittest.TestCase):
+    def setUp(self):
+        from src.system.base import manager
+        from src.plugins.mock.modules.provider_plugin import add_mock_api
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+        add_mock_api()
+        manager.providers.load()
+        self.manager = manager
+        self.provider = manager.providers.providers['mock']
+        self.provider.cached_prefixes.clear()
+
+    def tearDown(self):
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def run_conversation(self, model, user_messages):
+        from src.members.workflow import Workflow
+        config = {
+            '_TYPE': 'workflow',
+            'members': [
+                {'id': '1', 'agent_id': None, 'loc_x': 20, 'loc_y': 0, 'config': {'_TYPE': 'user'}},
+                {'id': '2', 'agent_id': None, 'loc_x': 100, 'loc_y': 0, 'config': {
+                    '_TYPE': 'agent', 'chat.model': model, 'chat.sys_msg': SYSTEM_MESSAGE,
+                }},
+            ],
+            'inputs': [],
+        }
+        workflow = Workflow(config=config, persist=False)
+
+        async def receive():
+            async for _ in workflow.behaviour.receive():
+                pass
+
+        logs = []
+        for message in user_messages:
+            workflow.save_message('user', message, member_id='1')
+            asyncio.run(receive())
+            logs.append(workflow.message_history.messages[-1].log)
+        return logs
+
+    def test_mark_cache_prefix(self):
+        messages = [
+            {'role': 'system', 'content': 'System'},
+            {'role': 'user', 'content': 'First'},
+            {'role': 'assistant', 'content': 'Reply'},
+            {'role': 'user', 'content': [{'type': 'text', 'text': 'Second'}]},
+        ]
+        marked = mark_cache_prefix(messages)
+        self.assertEqual(marked[0]['content'], [{'type': 'text', 'text': 'System', 'cache_control': {'type': 'ephemeral'}}])
+        self.assertIs(marked[1], messages[1])
+        self.assertEqual(marked[3]['content'][0]['cache_control'], {'type': 'ephemeral'})
+        self.assertEqual(messages[3]['content'], [{'type': 'text', 'text': 'Second'}])  # not changed
+        self.assertEqual([strip_cache_control(msg) for msg in marked[:3]], messages[:3])
+
+    def test_get_prompt_cache_usage(self):
+        self.assertIsNone(get_prompt_cache_usage(ResponseObject(prompt_tokens=100)))
+
+        openai_usage = ResponseObject(prompt_tokens=100, prompt_tokens_details=ResponseObject(cached_tokens=80))
+        self.assertEqual(get_prompt_cache_usage(openai_usage), {'hit_tokens': 80, 'miss_tokens': 20, 'write_tokens': 0})
+
+        anthropic_usage = ResponseObject(prompt_tokens=100, cache_read_input_tokens=0, cache_creation_input_tokens=90)
+        self.assertEqual(get_prompt_cache_usage(anthropic_usage), {'hit_tokens': 0, 'miss_tokens': 100, 'write_tokens': 90})
+
+    def test_prefix_stable_across_turns(self):
+        model = {'kind': 'CHAT', 'provider': 'mock', 'model_name': 'echo', 'model_params': {'prompt_caching': True}}
+        requests = []
+        original_run_model = self.provider.run_model
+
+        async def recorded_run_model(model_obj, **kwargs):
+            requests.append([strip_cache_control(msg) for msg in kwargs['messages']])
+            return await original_run_model(model_obj, **kwargs)
+
+        with mock.patch.object(self.provider, 'run_model', recorded_run_model):
+            logs = self.run_conversation(model, ['Will it rain?', 'And tomorrow?', 'Thanks'])
+
+        for previous_request, request in zip(requests, requests[1:]):
+            self.assertEqual(request[:len(previous_request)], previous_request)  # each turn extends the last one
+
+        self.assertEqual(logs[0]['prompt_cache']['hit_tokens'], 0)
+        self.assertGreater(logs[0]['prompt_cache']['write_tokens'], 0)
+        for log in logs[1:]:
+            cache_usage = log['prompt_cache']
+            self.assertGreater(cache_usage['hit_tokens'], cache_usage['miss_tokens'])
+        self.assertGreater(logs[2]['prompt_cache']['hit_tokens'], logs[1]['prompt_cache']['hit_tokens'])
+
+    def test_changed_system_message_misses(self):
+        model = {'kind': 'CHAT', 'provider': 'mock', 'model_name': 'echo', 'model_params': {'prompt_caching': True}}
+        self.run_conversation(model, ['Will it rain?'])
+        with mock.patch(f'{__name__}.SYSTEM_MESSAGE', 'A different system message'):
+            logs = self.run_conversation(model, ['Will it rain?'])
+        self.assertEqual(logs[0]['prompt_cache']['hit_tokens'], 0)
+
+    def test_off_by_default(self):
+        model = {'kind': 'CHAT', 'provider': 'mock', 'model_name': 'echo', 'model_params': {}}
+        logs = self.run_conversation(model, ['Will it rain?', 'And tomorrow?'])
+        self.assertNotIn('prompt_cache', logs[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+import asyncio
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+os.environ.setdefault('LITELLM_LOCAL_MODEL_COST_MAP', 'True')  # litellm fetches the cost map on import otherwise
+
+from src.utils import sql, retry
+from src.utils.retry import (AUTH_ERROR, BAD_REQUEST_ERROR, NETWORK_ERROR, RATE_LIMIT_ERROR, SERVER_ERROR,
+                             CircuitBreaker, CircuitOpenError, classify_error)
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f'Status {status_code}')
+        self.status_code = status_code
+
+
+class FaultInjectingHandler(BaseHTTPRequestHandler):
+    """
+    An OpenAI compatible chat completions endpoint, answering each request with the next scripted fault.
+    A fault is an HTTP status, 'drop' to close the connection without a response, 'ok' to stream a response,
+    or 'slow' to stream it after a second.
+    """
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            server.requests.append(request)
+            fault = server.faults.pop(0) if server.faults else server.default_fault
+
+        if fault == 'drop':
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        if fault not in ('ok', 'slow'):
+            body = json.dumps({'error': {'message': f'Injected {fault}', 'type': 'error', 'code': fault}}).encode()
+            self.send_response(fault)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if fault == 'slow':
+            time.sleep(1.0)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for i, token in enumerate(['Hello', ' from', ' the', ' stand-in']):
+            chunk = {
+                'id': 'chatcmpl-1', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'stand-in',
+                'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': token} if i == 0 else {'content': token},
+                             'finish_reason': None}],
+            }
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+        if (request.get('stream_options') or {}).get('include_usage'):
+            chunk = {
+                'id': 'chatcmpl-1', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'stand-in', 'choices': [],
+                'usage': {'prompt_tokens': 11, 'completion_tokens': 4, 'total_tokens': 15},
+            }
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestClassifyError(unittest.TestCase):
+    def test_status_codes(self):
+        self.assertEqual(classify_error(StatusError(401)), AUTH_ERROR)
+        self.assertEqual(classify_error(StatusError(429)), RATE_LIMIT_ERROR)
+        self.assertEqual(classify_error(StatusError(400)), BAD_REQUEST_ERROR)
+        self.assertEqual(classify_error(StatusError(503)), SERVER_ERROR)
+        self.assertEqual(classify_error(ConnectionResetError()), NETWORK_ERROR)
+        self.assertEqual(classify_error(asyncio.TimeoutError()), NETWORK_ERROR)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0.1)
+        breaker.record_failure()
+        breaker.check()
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            breaker.check()
+
+        time.sleep(0.1)
+        breaker.check()  # the trial call
+        with self.assertRaises(CircuitOpenError):
+            breaker.check()  # while the trial runs
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            breaker.check()
+
+        time.sleep(0.1)
+        breaker.check()
+        breaker.record_success()
+        breaker.check()
+        self.assertFalse(breaker.is_open)
+
+
+class TestLitellmRetry(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from src.plugins.litellm.modules.provider_plugin import import_litellm
+        import_litellm()  # takes seconds the first time
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FaultInjectingHandler)
+        cls.server.lock = threading.Lock()
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        # with nest_asyncio applied the loop is reused and stops before its last callbacks run,
+        # one of which stops the worker thread litellm finishes streams on
+        asyncio.run(asyncio.sleep(0))
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        from src.system.base import manager
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+        manager.providers.load()
+        self.manager = manager
+
+        self.server.faults = []
+        self.server.default_fault = 'ok'
+        self.server.request_count = 0
+        self.server.requests = []
+        self.patches = [
+            mock.patch.dict(retry._circuit_breakers, clear=True),
+            mock.patch.object(retry, 'RETRY_BACKOFF_BASE', 0.01),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def model(self, **model_params):
+        api_base = f'http://127.0.0.1:{self.server.server_address[1]}/v1'
+        return {'kind': 'CHAT', 'provider': 'litellm', 'model_name': 'openai/stand-in',
+                'model_params': {'api_base': api_base, 'api_key': 'sk-test', **model_params}}
+
+    async def complete(self, model=None):
+        stream = await self.manager.providers.run_model(model or self.model(), messages=[{'role': 'user', 'content': 'hello'}])
+        return ''.join([chunk.choices[0].delta.content or '' async for chunk in stream if chunk.choices])
+
+    def test_transient_errors_retried(self):
+        self.server.faults = [500, 'drop', 503]
+        self.assertEqual(asyncio.run(self.complete()), 'Hello from the stand-in')
+        self.assertEqual(self.server.request_count, 4)
+
+    def test_usage_recorded(self):
+        self.assertEqual(asyncio.run(self.complete()), 'Hello from the stand-in')
+        self.assertEqual(self.server.requests[0]['stream_options'], {'include_usage': True})
+        usage = sql.get_results("SELECT prompt_tokens, completion_tokens, estimated, cost FROM llm_usage", return_type='tuple')
+        self.assertEqual(usage, (11, 4, 0, None))  # the stand-in isn't in litellm's price list
+
+        asyncio.run(self.complete(self.model(input_cost=1.0, output_cost=2.0)))
+        cost = sql.get_scalar("SELECT cost FROM llm_usage ORDER BY id DESC LIMIT 1")
+        self.assertAlmostEqual(cost, (11 * 1.0 + 4 * 2.0) / 1_000_000)
+
+    def test_auth_error_not_retried(self):
+        self.server.faults = [401]
+        with self.assertRaises(Exception) as context:
+            asyncio.run(self.complete())
+        self.assertEqual(classify_error(context.exception), AUTH_ERROR)
+        self.assertEqual(self.server.request_count, 1)
+
+    def test_circuit_opens(self):
+        self.server.default_fault = 503
+        with mock.patch.object(retry, 'CIRCUIT_FAILURE_THRESHOLD', 3):
+            with self.assertRaises(Exception) as context:
+                asyncio.run(self.complete())
+            self.assertEqual(classify_error(context.exception), SERVER_ERROR)
+            self.assertEqual(self.server.request_count, 3)  # opened before the attempts ran out
+
+            with self.assertRaises(CircuitOpenError):
+                asyncio.run(self.complete())
+            self.assertEqual(self.server.request_count, 3)
+
+    def test_cancelled_trial_call(self):
+        breaker = self.manager.providers.get_circuit_breaker(self.model())
+        breaker.failures = breaker.failure_threshold
+        breaker.opened_at = time.monotonic() - breaker.reset_seconds  # due a trial call
+        self.server.faults = ['slow']
+
+        async def cancel_trial():
+            trial = asyncio.create_task(self.complete())
+            await asyncio.sleep(0.3)
+            trial.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await trial
+
+        asyncio.run(cancel_trial())
+        self.assertFalse(breaker.trial_running)
+        self.assertEqual(asyncio.run(self.complete()), 'Hello from the stand-in')  # the next call is the trial
+        self.assertFalse(breaker.is_open)
+
+    def test_failures_dont_block_loop(self):
+        self.server.default_fault = 'drop'
+
+        async def run():
+            gaps = []
+
+            async def tick():
+                last = time.monotonic()
+                while True:
+                    await asyncio.sleep(0.01)
+                    gaps.append(time.monotonic() - last)
+                    last = time.monotonic()
+
+            ticker = asyncio.create_task(tick())
+            with self.assertRaises(Exception):
+                await self.complete()
+            ticker.cancel()
+            return gaps
+
+        gaps = asyncio.run(run())
+        self.assertEqual(self.server.request_count, retry.MAX_ATTEMPTS)
+        self.assertLess(max(gaps), 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
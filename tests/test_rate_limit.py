@@ -0,0 +1,196 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from src.utils import sql, rate_limit
+from src.utils.rate_limit import RateLimiter, get_retry_after
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def mock_model(**params):
+    return {'kind': 'CHAT', 'provider': 'mock', 'model_name': 'echo', 'model_params': params}
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_requests_per_minute(self):
+        limiter = RateLimiter(requests_per_minute=1200)
+
+        async def run():
+            for _ in range(1200):
+                await limiter.acquire()
+                limiter.release()
+            start = time.monotonic()
+            for _ in range(10):  # the budget of the minute is used, so these come at 20 a second
+                await limiter.acquire()
+                limiter.release()
+            return time.monotonic() - start
+
+        elapsed = asyncio.run(run())
+        self.assertGreater(elapsed, 0.4)
+        self.assertLess(elapsed, 1.0)
+
+    def test_tokens_per_minute(self):
+        limiter = RateLimiter(tokens_per_minute=600)
+
+        async def run():
+            waited = await limiter.acquire(tokens=590)
+            limiter.release(extra_tokens=10)  # the completion used the rest of the minute's budget
+            return waited, await limiter.acquire(tokens=5)
+
+        first_wait, second_wait = asyncio.run(run())
+        self.assertLess(first_wait, 0.05)
+        self.assertGreater(second_wait, 0.4)
+
+    def test_cancelled_waiter(self):
+        limiter = RateLimiter(max_in_flight=1)
+
+        async def run():
+            await limiter.acquire()
+            waiter = asyncio.create_task(limiter.acquire())
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            limiter.release()
+            await asyncio.sleep(0.01)
+            return await asyncio.wait_for(limiter.acquire(), timeout=1)
+
+        asyncio.run(run())
+        self.assertEqual(limiter.in_flight, 1)
+
+    def test_get_retry_after(self):
+        class HeaderError(Exception):
+            def __init__(self, headers):
+                super().__init__('Rate limited')
+                self.litellm_response_headers = headers
+
+        self.assertEqual(get_retry_after(HeaderError({'retry-after': '2'})), 2.0)
+        self.assertEqual(get_retry_after(HeaderError({'retry-after-ms': '1500', 'retry-after': '2'})), 1.5)
+        self.assertEqual(get_retry_after(HeaderError({'retry-after': 'Wed, 21 Oct 2015 07:28:00 GMT'})), 0.0)
+        self.assertIsNone(get_retry_after(HeaderError({'retry-after': 'soon'})))
+        self.assertIsNone(get_retry_after(ValueError('Not a rate limit')))
+
+
+class TestProviderRateLimits(unittest.TestCase):
+    def setUp(self):
+        from src.system.base import manager
+        from src.plugins.mock.modules.provider_plugin import add_mock_api
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+        add_mock_api()
+        self.limiters_patch = mock.patch.dict(rate_limit._rate_limiters, clear=True)
+        self.limiters_patch.start()
+        self.manager = manager
+
+    def tearDown(self):
+        self.limiters_patch.stop()
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def set_api_limits(self, **limits):
+        for key, value in limits.items():
+            sql.execute(f"UPDATE apis SET config = json_set(config, '$.{key}', ?) WHERE provider_plugin = 'mock'", (value,))
+        self.manager.providers.load()
+        return self.manager.providers.providers['mock']
+
+    def run_agent(self, model):
+        from src.members.workflow import Workflow
+        config = {
+            '_TYPE': 'workflow',
+            'members': [
+                {'id': '1', 'agent_id': None, 'loc_x': 20, 'loc_y': 0, 'config': {'_TYPE': 'user'}},
+                {'id': '2', 'agent_id': None, 'loc_x': 100, 'loc_y': 0, 'config': {'_TYPE': 'agent', 'chat.model': model}},
+            ],
+            'inputs': [],
+        }
+        workflow = Workflow(config=config, persist=False)
+        workflow.save_message('user', 'hello there', member_id='1')
+
+        async def receive():
+            return ''.join([chunk async for key, chunk in workflow.behaviour.receive()])
+        return asyncio.run(receive()), workflow.message_history.messages[-1]
+
+    def test_max_in_flight_across_threads(self):
+        provider = self.set_api_limits(max_in_flight=2)
+        counter_lock = threading.Lock()
+        counts = {'active': 0, 'peak': 0}
+        original_stream = provider.stream
+
+        async def counted_stream(*args):
+            with counter_lock:
+                counts['active'] += 1
+                counts['peak'] = max(counts['peak'], counts['active'])
+            try:
+                async for chunk in original_stream(*args):
+                    yield chunk
+            finally:
+                with counter_lock:
+                    counts['active'] -= 1
+
+        async def run_calls():
+            async def call(i):
+                response = await self.manager.providers.run_model(
+                    mock_model(time_to_first_token=0.1), messages=[{'role': 'user', 'content': f'call {i}'}])
+                return ''.join([chunk.choices[0].delta.content or '' async for chunk in response])
+            return await asyncio.gather(*[call(i) for i in range(4)])
+
+        # two event loops, like two workflows running in their own threads
+        results = []
+        with mock.patch.object(provider, 'stream', counted_stream):
+            start = time.monotonic()
+            threads = [threading.Thread(target=lambda: results.extend(asyncio.run(run_calls()))) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - start
+
+        self.assertEqual(len(results), 8)
+        self.assertEqual(counts['peak'], 2)
+        self.assertGreaterEqual(elapsed, 0.4)
+
+    def test_retry_after_in_log(self):
+        from src.plugins.mock.modules.provider_plugin import MockProviderError
+        provider = self.set_api_limits()
+        original_run_model = provider.run_model
+        call_times = []
+
+        async def rate_limited_once(model_obj, **kwargs):
+            call_times.append(time.monotonic())
+            if len(call_times) == 1:
+                raise MockProviderError('Slow down', status_code=429, retry_after=0.3)
+            return await original_run_model(model_obj, **kwargs)
+
+        with mock.patch.object(provider, 'run_model', rate_limited_once):
+            output, msg = self.run_agent(mock_model())
+
+        self.assertEqual(output, 'hello there')
+        self.assertEqual(len(call_times), 2)
+        self.assertGreaterEqual(call_times[1] - call_times[0], 0.3)
+        self.assertGreaterEqual(msg.log['rate_limit_wait'], 0.25)
+
+    def test_rate_limit_errors_exhaust_retries(self):
+        self.set_api_limits()
+        with mock.patch.object(rate_limit, 'MAX_RATE_LIMIT_RETRIES', 1):
+            with self.assertRaises(Exception) as context:
+                asyncio.run(self.manager.providers.run_model(
+                    mock_model(error='Slow down', error_type='Rate limit', retry_after=0.05),
+                    messages=[{'role': 'user', 'content': 'hello'}]))
+        self.assertEqual(context.exception.status_code, 429)
+
+    def test_no_wait_unlimited(self):
+        self.set_api_limits()
+        output, msg = self.run_agent(mock_model())
+        self.assertEqual(output, 'hello there')
+        self.assertNotIn('rate_limit_wait', msg.log)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import aiohttp
+import httpx
+import uvicorn
+
+from src.utils import sql
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class EchoProvider:
+    """Echoes the last message word by word after `model_params.delay` seconds, like a local mock LLM"""
+    def __init__(self):
+        self.produced_chunks = 0
+
+    async def run_model(self, model_obj, messages=None, **kwargs):
+        async def stream():
+            await asyncio.sleep(model_obj['model_params'].get('delay', 0))
+            for i, word in enumerate(f"Echo {messages[-1]['content']}".split(' ')):
+                self.produced_chunks += 1
+                yield SimpleNamespace(choices=[{'delta': {'content': word if i == 0 else ' ' + word}}])
+        return stream()
+
+    def get_model(self, model_obj):
+        return None
+
+    def get_model_context_window(self, model_obj):
+        return None
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TestServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from src.system.base import manager
+        from src.server import create_app
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(cls.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+        cls.provider = EchoProvider()
+        cls.providers_patch = mock.patch.dict(manager.providers.providers, {'echo': cls.provider})
+        cls.providers_patch.start()
+
+        model = {'kind': 'CHAT', 'provider': 'echo', 'model_name': 'echo', 'model_params': {'delay': 0.2}}
+        config = {
+            '_TYPE': 'workflow',
+            'members': [
+                {'id': '1', 'agent_id': None, 'loc_x': 20, 'loc_y': 0, 'config': {'_TYPE': 'user'}},
+                {'id': '2', 'agent_id': None, 'loc_x': 100, 'loc_y': 0, 'config': {'_TYPE': 'agent', 'chat.model': model}},
+            ],
+            'inputs': [],
+        }
+        sql.execute("INSERT INTO entities (name, kind, config) VALUES ('Echo server', 'AGENT', ?)", (json.dumps(config),))
+
+        cls.app = create_app(max_queued_events=4)
+        port = get_free_port()
+        cls.base_url = f'http://127.0.0.1:{port}'
+        cls.server = uvicorn.Server(uvicorn.Config(cls.app, host='127.0.0.1', port=port, loop='asyncio', log_level='warning'))
+        cls.server_thread = threading.Thread(target=cls.server.run, daemon=True)
+        cls.server_thread.start()
+        while not cls.server.started:
+            time.sleep(0.01)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.should_exit = True
+        cls.server_thread.join(timeout=10)
+        cls.providers_patch.stop()
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        cls.temp_dir.cleanup()
+
+    async def run_session(self, session, message):
+        async with session.post(f'{self.base_url}/contexts', json={'target': 'Echo server'}) as response:
+            context_id = (await response.json())['id']
+        async with session.post(f'{self.base_url}/contexts/{context_id}/messages', json={'message': message}) as response:
+            self.assertEqual(response.status, 202)
+
+        events = await self.read_events(session, context_id)
+        async with session.delete(f'{self.base_url}/contexts/{context_id}'):
+            pass
+        return events
+
+    async def read_events(self, session, context_id):
+        events = []
+        async with session.get(f'{self.base_url}/contexts/{context_id}/events') as response:
+            async for line in response.content:
+                if line.startswith(b'data: '):
+                    events.append(json.loads(line[len(b'data: '):]))
+        return events
+
+    def client_session(self):
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+
+    def test_list_workflows(self):
+        response = httpx.get(f'{self.base_url}/workflows')
+        self.assertIn('Echo server', [entity['name'] for entity in response.json()])
+
+    def test_stream_response(self):
+        async def run():
+            async with self.client_session() as session:
+                return await self.run_session(session, 'hello there')
+
+        events = asyncio.run(run())
+        self.assertEqual(''.join(e['content'] for e in events if e['type'] == 'chunk'), 'Echo hello there')
+        self.assertEqual(events[-1]['type'], 'done')
+
+    def test_errors(self):
+        self.assertEqual(httpx.post(f'{self.base_url}/contexts', json={'target': 'Missing'}).status_code, 404)
+        self.assertEqual(httpx.get(f'{self.base_url}/contexts/missing/events').status_code, 404)
+
+        context_id = httpx.post(f'{self.base_url}/contexts', json={'target': 'Echo server'}).json()['id']
+        self.assertEqual(httpx.post(f'{self.base_url}/contexts/{context_id}/messages', json={'message': ''}).status_code, 400)
+        self.assertEqual(httpx.post(f'{self.base_url}/contexts/{context_id}/messages', json={'message': 'hi'}).status_code, 202)
+        self.assertEqual(httpx.post(f'{self.base_url}/contexts/{context_id}/messages', json={'message': 'hi'}).status_code, 409)
+        httpx.delete(f'{self.base_url}/contexts/{context_id}')
+
+    def test_websocket(self):
+        from websockets.sync.client import connect
+        context_id = httpx.post(f'{self.base_url}/contexts', json={'target': 'Echo server'}).json()['id']
+        with connect(f"{self.base_url.replace('http', 'ws')}/contexts/{context_id}/ws") as websocket:
+            for message in ('one', 'two'):
+                websocket.send(json.dumps({'message': message}))
+                events = []
+                while not events or events[-1]['type'] not in ('done', 'error'):
+                    events.append(json.loads(websocket.recv()))
+                self.assertEqual(''.join(e['content'] for e in events if e['type'] == 'chunk'), f'Echo {message}')
+        httpx.delete(f'{self.base_url}/contexts/{context_id}')
+
+    def test_backpressure(self):
+        context_id = httpx.post(f'{self.base_url}/contexts', json={'target': 'Echo server'}).json()['id']
+        message = ' '.join(f'word{i}' for i in range(200))
+        produced_before = self.provider.produced_chunks
+        httpx.post(f'{self.base_url}/contexts/{context_id}/messages', json={'message': message})
+        time.sleep(0.5)
+
+        # nobody is reading, so the workflow waits on the full queue
+        context = self.app.state.contexts[context_id]
+        self.assertTrue(context.running)
+        self.assertEqual(context.events.qsize(), 4)
+
+        # and the model's stream isn't read any further
+        produced = self.provider.produced_chunks - produced_before
+        self.assertLess(produced, 100)
+        time.sleep(0.3)
+        self.assertEqual(self.provider.produced_chunks - produced_before, produced)
+
+        async def run():
+            async with self.client_session() as session:
+                return await self.read_events(session, context_id)
+
+        events = asyncio.run(run())
+        self.assertEqual(''.join(e['content'] for e in events if e['type'] == 'chunk'), f'Echo {message}')
+        httpx.delete(f'{self.base_url}/contexts/{context_id}')
+
+    def test_benchmark_concurrent_sessions(self):
+        session_count = 200
+
+        async def run():
+            async with self.client_session() as session:
+                return await asyncio.gather(*(self.run_session(session, f'session {i}') for i in range(session_count)))
+
+        start = time.perf_counter()
+        all_events = asyncio.run(run())
+        elapsed = time.perf_counter() - start
+        print(f'\n{session_count} concurrent streaming sessions with a 200ms mock LLM in {elapsed:.2f}s')
+
+        for i, events in enumerate(all_events):
+            self.assertEqual(''.join(e['content'] for e in events if e['type'] == 'chunk'), f'Echo session {i}')
+        # sequential sessions would take 40s
+        self.assertLess(elapsed, session_count * 0.2 / 10)
+        self.assertEqual(self.app.state.contexts, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
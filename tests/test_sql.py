@@ -0,0 +1,232 @@
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from src.utils import sql
+from src.utils.sql_upgrade import upgrade_script
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+
+def create_message_db(db_path, message_count=100000):
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE "contexts" (
+            "id"	INTEGER,
+            "parent_id"	INTEGER,
+            "branch_msg_id"	INTEGER DEFAULT NULL,
+            "name"	TEXT NOT NULL DEFAULT '',
+            "kind"	TEXT NOT NULL DEFAULT 'CHAT',
+            "active"	INTEGER NOT NULL DEFAULT 1,
+            "folder_id"	INTEGER DEFAULT NULL,
+            "ordr"	INTEGER DEFAULT 0,
+            "config"	TEXT NOT NULL DEFAULT '{}',
+            "pinned"	INTEGER DEFAULT 0,
+            PRIMARY KEY("id" AUTOINCREMENT)
+        );
+        CREATE TABLE "contexts_messages" (
+            "id"	INTEGER,
+            "unix"	INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS TYPE_NAME)),
+            "context_id"	INTEGER,
+            "member_id"	TEXT NOT NULL,
+            "role"	TEXT,
+            "msg"	TEXT,
+            "embedding_id"	INTEGER,
+            "log"	TEXT NOT NULL DEFAULT '',
+            "alt_turn"	INTEGER NOT NULL DEFAULT 0,
+            "del"	INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY("id" AUTOINCREMENT)
+        );
+    """)
+    context_count = max(message_count // 100, 1)
+    conn.executemany("INSERT INTO contexts (id, name) VALUES (?, ?)",
+                     ((i, f'Context {i}') for i in range(1, context_count + 1)))
+    conn.executemany("INSERT INTO contexts_messages (context_id, member_id, role, msg, log) VALUES (?, ?, ?, ?, ?)",
+                     (((i % context_count) + 1, '2', 'user' if i % 2 else 'assistant', f'Message number {i}', '{}')
+                      for i in range(message_count)))
+    conn.commit()
+    conn.close()
+
+
+class TestConnectionPool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.db_path = os.path.join(cls.temp_dir.name, 'data.db')
+        create_message_db(cls.db_path)
+        sql.set_db_filepath(cls.db_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        cls.temp_dir.cleanup()
+
+    def test_read_your_writes(self):
+        msg_id = sql.execute("INSERT INTO contexts_messages (context_id, member_id, role, msg) VALUES (1, '1', 'user', 'hi')")
+        self.assertEqual(sql.get_scalar("SELECT msg FROM contexts_messages WHERE id = ?", (msg_id,)), 'hi')
+        sql.execute("DELETE FROM contexts_messages WHERE id = ?", (msg_id,))
+        self.assertIsNone(sql.get_scalar("SELECT msg FROM contexts_messages WHERE id = ?", (msg_id,)))
+
+    def test_execute_multiple_rolls_back(self):
+        count_before = sql.get_scalar("SELECT COUNT(*) FROM contexts")
+        with self.assertRaises(sqlite3.Error):
+            sql.execute_multiple(
+                ["INSERT INTO contexts (name) VALUES (?)", "INSERT INTO no_such_table (name) VALUES (?)"],
+                [('a',), ('b',)],
+            )
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM contexts"), count_before)
+
+    def test_concurrent_threads(self):
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(50):
+                    sql.execute("INSERT INTO contexts (name) VALUES (?)", (f'thread-{n}-{i}',))
+                    sql.get_scalar("SELECT COUNT(*) FROM contexts_messages WHERE context_id = ?", (i + 1,))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM contexts WHERE name LIKE 'thread-%'"), 400)
+
+    def test_close_connections_before_file_replace(self):
+        sql.get_scalar("SELECT 1")
+        sql.close_connections(self.db_path)
+        self.assertNotIn(self.db_path, sql._pools)
+        self.assertEqual(sql.get_scalar("SELECT 1"), 1)
+
+    def test_benchmark_per_query_overhead(self):
+        query = "SELECT msg FROM contexts_messages WHERE id = ?"
+        query_count = 2000
+
+        start = time.perf_counter()
+        for i in range(query_count):
+            with sqlite3.connect(self.db_path) as conn:  # the previous connect-per-query behaviour
+                conn.execute(query, (i + 1,)).fetchone()
+        per_query_before = (time.perf_counter() - start) / query_count
+
+        sql.get_scalar(query, (1,))  # warm the pool
+        start = time.perf_counter()
+        for i in range(query_count):
+            sql.get_scalar(query, (i + 1,))
+        per_query_after = (time.perf_counter() - start) / query_count
+
+        print(f"\nPer query overhead on 100k messages: "
+              f"connect per query {per_query_before * 1e6:.1f}us, pooled {per_query_after * 1e6:.1f}us")
+        self.assertLess(per_query_after, per_query_before)
+
+
+
+class TestQueryPlans(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.db_path = os.path.join(cls.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(os.path.dirname(SRC_DIR), 'data.db'), cls.db_path)
+        sql.set_db_filepath(cls.db_path)
+        upgrade_script.v0_5_1()
+
+    @classmethod
+    def tearDownClass(cls):
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        cls.temp_dir.cleanup()
+
+    def assertNoTableScans(self, query, params):
+        # scanning the rows of a CTE is expected, scanning a table is not
+        cte_names = set(re.findall(r'(\w+)(?:\([^)]*\))?\s+AS\s+\(', query))
+        cte_names |= {
+            alias for name, alias in re.findall(r'(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(\w+)', query)
+            if name in cte_names
+        }
+        plan = sql.get_results(f"EXPLAIN QUERY PLAN {query}", params)
+        table_scans = [
+            detail for _, _, _, detail in plan
+            if detail.startswith('SCAN ') and detail.split()[1] not in cte_names
+            and not detail.endswith('CONSTANT ROWS')
+        ]
+        self.assertEqual(table_scans, [], msg=f"Full table scan in query:\n{query}")
+
+    def test_message_history_queries(self):
+        from src.members.workflow import Workflow
+        workflow = Workflow()
+        for i in range(3):
+            workflow.save_message('user', f'Question {i}', member_id='1')
+            workflow.save_message('assistant', f'Answer {i}', member_id='2')
+        branch_msg_id = workflow.message_history.messages[2].id
+        workflow.leaf_id = sql.execute("""
+            INSERT INTO contexts (kind, parent_id, branch_msg_id, root_id)
+            VALUES ('CHAT', ?, ?, ?)""", (workflow.context_id, branch_msg_id, workflow.context_id))
+        workflow.save_message('user', 'Edited question', member_id='1')
+
+        queries = []
+        get_results = sql.get_results
+
+        def recording_get_results(query, params=None, *args, **kwargs):
+            queries.append((query, params))
+            return get_results(query, params, *args, **kwargs)
+
+        sql.get_results = recording_get_results
+        try:
+            workflow.message_history.load()
+            workflow.deactivate_all_branches_with_msg(workflow.message_history.messages[-1].id)
+        finally:
+            sql.get_results = get_results
+
+        self.assertEqual([m.content for m in workflow.message_history.messages],
+                         ['Question 0', 'Answer 0', 'Edited question'])
+        self.assertEqual(workflow.message_history.branches, {branch_msg_id: [workflow.message_history.messages[-1].id]})
+        self.assertGreater(len(queries), 0)
+        for query, params in queries:
+            self.assertNotIn('RECURSIVE', query)
+            self.assertNoTableScans(query, params)
+
+    def test_prompt_cleanup_queries(self):
+        from src.utils.prompt_log import compact_log, delete_unused_prompts, get_prompt_hashes
+        messages = [{'role': 'user', 'content': f'Question {i}'} for i in range(3)]
+        log = compact_log({'messages': messages})
+        msg_id = sql.execute("INSERT INTO contexts_messages (context_id, member_id, role, msg, log) VALUES (1, '2', 'assistant', '', ?)",
+                             (json.dumps(log),))
+
+        queries = []
+        get_scalar = sql.get_scalar
+
+        def recording_get_scalar(query, params=None, *args, **kwargs):
+            queries.append((query, params))
+            return get_scalar(query, params, *args, **kwargs)
+
+        prompt_hashes = get_prompt_hashes("id = ?", (msg_id,))
+        sql.execute("DELETE FROM contexts_messages WHERE id = ?", (msg_id,))
+        sql.get_scalar = recording_get_scalar
+        try:
+            delete_unused_prompts(prompt_hashes)
+        finally:
+            sql.get_scalar = get_scalar
+
+        self.assertEqual(prompt_hashes, [log['prompt_hash']])
+        self.assertGreater(len(queries), 0)
+        for query, params in queries:
+            self.assertNoTableScans(query, params)
+
+    def test_contexts_page_query(self):
+        from src.gui.pages.contexts import CONTEXTS_QUERY
+        query = CONTEXTS_QUERY.replace('{{kind}}', 'CHAT')
+        self.assertNoTableScans(query, (100, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault('LITELLM_LOCAL_MODEL_COST_MAP', 'True')  # litellm fetches the cost map on import otherwise
+
+from src.utils import sql
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESPONSE_DELAY = 0.3
+
+
+class ToolCallHandler(BaseHTTPRequestHandler):
+    """An OpenAI compatible endpoint that slowly streams the forced tool call's arguments, filled from `server.arguments`"""
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        self.server.requests.append(request)
+        tool_name = request['tool_choice']['function']['name']
+        arguments = json.dumps(self.server.arguments)
+        pieces = [arguments[i:i + 8] for i in range(0, len(arguments), 8)]
+
+        time.sleep(RESPONSE_DELAY)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for i, piece in enumerate(pieces):
+            tool_call = {'index': 0, 'function': {'arguments': piece}}
+            if i == 0:
+                tool_call.update(id='call_1', type='function', function={'name': tool_name, 'arguments': piece})
+            chunk = {
+                'id': 'chatcmpl-1', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'stand-in',
+                'choices': [{'index': 0, 'delta': {'tool_calls': [tool_call]}, 'finish_reason': None}],
+            }
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            self.wfile.flush()
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestStructuredOutput(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from src.plugins.litellm.modules.provider_plugin import import_litellm
+        import_litellm()  # takes seconds the first time
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), ToolCallHandler)
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        # with nest_asyncio applied the loop is reused and stops before its last callbacks run,
+        # one of which stops the worker thread litellm finishes streams on
+        asyncio.run(asyncio.sleep(0))
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        from src.system.base import manager
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+        manager.providers.load()
+        self.manager = manager
+        self.server.requests = []
+        self.server.arguments = {'answer': 'A streamed answer', 'score': 7}
+
+    def tearDown(self):
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def model(self, structure_data=None):
+        api_base = f'http://127.0.0.1:{self.server.server_address[1]}/v1'
+        return {'kind': 'CHAT', 'provider': 'litellm', 'model_name': 'openai/stand-in', 'model_params': {
+            'api_base': api_base,
+            'api_key': 'sk-test',
+            'structured.class_name': 'Review',
+            'structure.data': structure_data or [{'attribute': 'Answer', 'type': 'str', 'req': True},
+                                                 {'attribute': 'Score', 'type': 'int', 'req': False}],
+        }}
+
+    async def stream(self, model):
+        stream = await self.manager.providers.stream_structured_output(model, messages=[{'role': 'user', 'content': 'hi'}])
+        return [chunk async for chunk in stream]
+
+    def test_stream_fields(self):
+        chunks = asyncio.run(self.stream(self.model()))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(json.loads(''.join(chunks)), self.server.arguments)
+
+        parameters = self.server.requests[0]['tools'][0]['function']['parameters']
+        self.assertEqual(parameters['required'], ['answer'])
+        self.assertEqual(parameters['properties']['score']['anyOf'][0]['type'], 'integer')
+
+    def test_invalid_response(self):
+        self.server.arguments = {'score': 7}  # the required answer is missing
+        with self.assertRaises(ValueError):
+            asyncio.run(self.stream(self.model()))
+
+    def test_concurrent_members_not_blocked(self):
+        async def run_both():
+            return await asyncio.gather(self.stream(self.model()), self.stream(self.model()))
+
+        asyncio.run(self.stream(self.model()))  # litellm sets up its client on the first request
+        start = time.perf_counter()
+        results = asyncio.run(run_both())
+        self.assertLess(time.perf_counter() - start, RESPONSE_DELAY * 2)
+        self.assertEqual([json.loads(''.join(chunks)) for chunks in results], [self.server.arguments] * 2)
+
+    def test_response_model_reused(self):
+        from src.plugins.litellm.modules.provider_plugin import get_response_model
+        model = self.model()
+        response_model = get_response_model(model)
+        self.assertIs(get_response_model(self.model()), response_model)
+        self.assertEqual(model['model_params']['structure.data'][0]['attribute'], 'Answer')  # the config isn't changed
+
+        changed_model = self.model([{'attribute': 'Answer', 'type': 'str', 'req': False}])
+        self.assertIsNot(get_response_model(changed_model), response_model)
+
+
+if __name__ == '__main__':
+    unittest.main()
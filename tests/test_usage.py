@@ -0,0 +1,142 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from src.utils import sql
+from src.utils.llm_cache import close_response_caches
+from src.utils.usage import format_usage, get_context_usage, get_daily_usage
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestUsage(unittest.TestCase):
+    def setUp(self):
+        from src.system.base import manager
+        from src.plugins.mock.modules.provider_plugin import add_mock_api
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+        add_mock_api()
+        manager.providers.load()
+        self.manager = manager
+
+    def tearDown(self):
+        close_response_caches()
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def model(self, **model_params):
+        return {'kind': 'CHAT', 'provider': 'mock', 'model_name': 'echo', 'model_params': model_params}
+
+    def run_workflow(self, model, message='What is the weather like?'):
+        from src.members.workflow import Workflow
+        config = {
+            '_TYPE': 'workflow',
+            'members': [
+                {'id': '1', 'agent_id': None, 'loc_x': 20, 'loc_y': 0, 'config': {'_TYPE': 'user'}},
+                {'id': '2', 'agent_id': None, 'loc_x': 100, 'loc_y': 0, 'config': {'_TYPE': 'agent', 'chat.model': model}},
+            ],
+            'inputs': [],
+        }
+        workflow = Workflow(config=config)
+        workflow.save_message('user', message, member_id='1')
+
+        async def receive():
+            async for _ in workflow.behaviour.receive():
+                pass
+
+        asyncio.run(receive())
+        return workflow
+
+    def get_usage_rows(self):
+        rows, col_names = sql.get_results("SELECT * FROM llm_usage ORDER BY id", incl_column_names=True)
+        return [dict(zip(col_names, row)) for row in rows]
+
+    def test_message_usage(self):
+        model = self.model(time_to_first_token=0.2, tokens_per_second=50.0, input_cost=2.0, output_cost=10.0)
+        workflow = self.run_workflow(model)
+
+        usage = workflow.message_history.messages[-1].log['usage']
+        self.assertGreater(usage['prompt_tokens'], 0)
+        self.assertGreater(usage['completion_tokens'], 0)
+        self.assertNotIn('estimated', usage)  # the mock reports its usage
+        self.assertAlmostEqual(usage['time_to_first_token'], 0.2, delta=0.1)
+        self.assertGreater(usage['latency'], usage['time_to_first_token'])
+        self.assertAlmostEqual(usage['cost'], (usage['prompt_tokens'] * 2.0 + usage['completion_tokens'] * 10.0) / 1_000_000)
+        self.assertIn('tokens', format_usage(usage))
+
+        rows = self.get_usage_rows()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['context_id'], workflow.context_id)
+        self.assertEqual(rows[0]['member_id'], '2')
+        self.assertEqual((rows[0]['provider'], rows[0]['model'], rows[0]['call_type']), ('mock', 'echo', 'chat'))
+
+        context_usage = get_context_usage(workflow.context_id)
+        self.assertEqual([(u['member_id'], u['calls']) for u in context_usage], [('2', 1)])
+
+    def test_daily_totals(self):
+        workflow = self.run_workflow(self.model(input_cost=1.0))
+        self.run_workflow(self.model(input_cost=1.0), 'A second question')
+        asyncio.run(self.manager.providers.get_structured_output(self.model(**{
+            'structure.data': [{'attribute': 'Answer', 'type': 'str', 'req': True}],
+        }), messages=[{'role': 'user', 'content': 'hi'}], usage_scope={'context_id': workflow.context_id}))
+
+        rows = self.get_usage_rows()
+        self.assertEqual([row['call_type'] for row in rows], ['chat', 'chat', 'structured'])
+        self.assertTrue(rows[2]['estimated'])  # structured output doesn't report usage
+
+        daily_usage = get_daily_usage(start_day=rows[0]['day'], end_day=rows[0]['day'])
+        self.assertEqual(len(daily_usage), 1)
+        self.assertEqual(daily_usage[0]['calls'], 3)
+        self.assertEqual(daily_usage[0]['prompt_tokens'], sum(row['prompt_tokens'] for row in rows))
+        self.assertEqual(daily_usage[0]['completion_tokens'], sum(row['completion_tokens'] for row in rows))
+        self.assertAlmostEqual(daily_usage[0]['cost'], sum(row['cost'] or 0.0 for row in rows))
+        self.assertEqual(get_daily_usage(start_day='2000-01-01', end_day='2000-01-01'), [])
+
+    def test_failed_call(self):
+        from src.plugins.mock.modules.provider_plugin import MockProviderError
+        with self.assertRaises(MockProviderError):
+            self.run_workflow(self.model(response='A partial answer', error='Overloaded', error_after=2))
+
+        rows = self.get_usage_rows()
+        self.assertEqual(rows[0]['error'], 'MockProviderError')
+        self.assertTrue(rows[0]['estimated'])
+        self.assertGreater(rows[0]['completion_tokens'], 0)  # the streamed tokens before the error
+        self.assertEqual(get_daily_usage()[0]['errors'], 1)
+
+    def test_estimate_failure(self):
+        # offline, the tokenizer can't be downloaded to estimate the tokens of a provider that doesn't report them
+        with mock.patch('src.utils.usage.CallUsage.set_usage'), \
+                mock.patch('src.utils.usage.estimate_request_tokens', side_effect=ConnectionError('No network')):
+            workflow = self.run_workflow(self.model(input_cost=1.0))
+        self.assertEqual(workflow.message_history.messages[-1].content, 'What is the weather like?')
+
+        rows = self.get_usage_rows()
+        self.assertEqual((rows[0]['prompt_tokens'], rows[0]['estimated'], rows[0]['error']), (0, 1, None))
+
+    def test_scalar(self):
+        title = self.manager.providers.get_scalar('A title', single_line=True, model_obj=self.model(),
+                                                  usage_scope={'context_id': 7})
+        self.assertEqual(title, 'A title')
+        rows = self.get_usage_rows()
+        self.assertEqual((rows[0]['call_type'], rows[0]['context_id'], rows[0]['member_id']), ('scalar', 7, None))
+        self.assertGreater(rows[0]['prompt_tokens'], 0)
+
+    def test_cache_hit_free(self):
+        model = self.model(cache_responses=True, input_cost=1.0)
+        self.run_workflow(model)
+        self.run_workflow(model)
+
+        rows = self.get_usage_rows()
+        self.assertEqual([row['cache_hit'] for row in rows], [0, 1])
+        self.assertGreater(rows[0]['cost'], 0.0)
+        self.assertEqual(rows[1]['cost'], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
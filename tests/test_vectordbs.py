@@ -0,0 +1,156 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from src.system.vectordbs import LocalVecStore, LocalVectorDB, VectorDBManager, embed_messages
+from src.utils import sql
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIMENSIONS = 64
+
+
+def hash_embedding(texts):
+    """Deterministic bag of words embedding, texts sharing words are similar"""
+    vectors = np.zeros((len(texts), DIMENSIONS), dtype=np.float32)
+    for i, text in enumerate(texts):
+        for word in re.findall(r'\w+', text.lower()):
+            digest = hashlib.md5(word.encode('utf-8')).digest()
+            vectors[i, int.from_bytes(digest[:4], 'little') % DIMENSIONS] += 1 if digest[4] % 2 else -1
+    return vectors
+
+
+class TestLocalVecStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.vec_db = LocalVectorDB('test', path=self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_search(self):
+        texts = ['the cat sat on the mat', 'dogs chase cats', 'stock market news', 'a recipe for bread', 'bread and butter']
+        vec_store = self.vec_db.create_vec_store('docs', dimensions=DIMENSIONS)
+        vec_store.insert(range(len(texts)), hash_embedding(texts))
+
+        results = vec_store.search(hash_embedding(['bread recipe'])[0], k=2)
+        self.assertEqual([item_id for item_id, _ in results], [3, 4])
+        self.assertGreater(results[0][1], results[1][1])
+        self.assertEqual(vec_store.search(hash_embedding(['the cat sat on the mat'])[0], k=1)[0][0], 0)
+        self.assertEqual(len(vec_store.search(hash_embedding(['cat'])[0], k=10)), 5)
+
+    def test_delete_and_replace(self):
+        vec_store = self.vec_db.create_vec_store('docs', dimensions=DIMENSIONS)
+        vec_store.insert([1, 2], hash_embedding(['apples', 'oranges']))
+        self.assertEqual(vec_store.delete([1, 99]), 1)
+        self.assertEqual([item_id for item_id, _ in vec_store.search(hash_embedding(['apples'])[0], k=5)], [2])
+
+        vec_store.insert([2, 1], hash_embedding(['pears', 'apples']))
+        self.assertEqual(len(vec_store), 2)
+        self.assertEqual(vec_store.search(hash_embedding(['pears'])[0], k=1)[0][0], 2)
+        self.assertEqual(vec_store.search(hash_embedding(['apples'])[0], k=1)[0][0], 1)
+
+    def test_persistence(self):
+        vec_store = self.vec_db.create_vec_store('docs', dimensions=DIMENSIONS, metric='euclidean')
+        vec_store.insert([1, 2, 3], hash_embedding(['one', 'two', 'three']))
+        vec_store.delete([2])
+        vec_store.insert([2], hash_embedding(['two again']))
+        vec_store.delete([3])
+        expected = vec_store.search(hash_embedding(['two'])[0], k=5)
+
+        reopened = LocalVectorDB('test', path=self.temp_dir.name).get_vec_store('docs')
+        self.assertEqual(reopened.metric, 'euclidean')
+        self.assertEqual(reopened.search(hash_embedding(['two'])[0], k=5), expected)
+
+        reopened.compact()
+        self.assertFalse(os.path.exists(os.path.join(reopened.path, LocalVecStore.TOMBSTONES_FILENAME)))
+        compacted = LocalVectorDB('test', path=self.temp_dir.name).get_vec_store('docs')
+        self.assertEqual(compacted.search(hash_embedding(['two'])[0], k=5), expected)
+        self.assertEqual(compacted.count, 2)
+
+    def test_vec_stores(self):
+        self.vec_db.create_vec_store('a', dimensions=DIMENSIONS)
+        self.vec_db.create_vec_store('b', dimensions=DIMENSIONS)
+        self.assertEqual(self.vec_db.list_vec_stores(), ['a', 'b'])
+        with self.assertRaises(ValueError):
+            self.vec_db.create_vec_store('a', dimensions=DIMENSIONS)
+        self.vec_db.delete_vec_store('a')
+        self.assertEqual(self.vec_db.list_vec_stores(), ['b'])
+        self.assertIsNone(self.vec_db.get_vec_store('a'))
+
+    def test_invalid_names(self):
+        outside_path = os.path.join(self.temp_dir.name, 'outside')
+        for name in ('', '..', '../outside', 'a/b', outside_path):
+            with self.assertRaises(ValueError):
+                self.vec_db.create_vec_store(name, dimensions=DIMENSIONS)
+            with self.assertRaises(ValueError):
+                self.vec_db.delete_vec_store(name)
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+    def test_benchmark_search(self):
+        vector_count, dimensions = 300_000, 384
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((vector_count, dimensions), dtype=np.float32)
+        vec_store = self.vec_db.create_vec_store('bench', dimensions=dimensions)
+        start = time.perf_counter()
+        for i in range(0, vector_count, 10_000):
+            vec_store.insert(range(i, i + 10_000), vectors[i:i + 10_000])
+        insert_time = time.perf_counter() - start
+
+        queries = vectors[:20] + rng.standard_normal((20, dimensions), dtype=np.float32) * 0.1
+        start = time.perf_counter()
+        results = [vec_store.search(query, k=10) for query in queries]
+        search_time = (time.perf_counter() - start) / len(queries)
+
+        print(f'\n{vector_count:,} vectors of {dimensions} dimensions: insert {insert_time:.2f}s, search {search_time * 1000:.1f}ms')
+        self.assertEqual([result[0][0] for result in results], list(range(20)))
+        self.assertLess(search_time, 0.25)
+
+
+class TestVectorDBManager(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+
+    def tearDown(self):
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def test_embed_messages(self):
+        sql.execute("INSERT INTO vectordbs (name) VALUES ('memory')")
+        manager = VectorDBManager(parent=None)
+        manager.load()
+        vec_db = manager.get_vec_db('memory')
+        self.assertIsInstance(vec_db, LocalVectorDB)
+        self.assertEqual(vec_db.path, os.path.join(self.temp_dir.name, 'vectordbs', 'memory'))
+
+        context_id = sql.execute("INSERT INTO contexts (kind, config) VALUES ('CHAT', '{}')")
+        contents = ['How do I bake sourdough bread?', 'Feed the starter and bake it hot', 'What is the capital of France?']
+        msg_ids = [sql.execute("INSERT INTO contexts_messages (context_id, member_id, role, msg) VALUES (?, '1', 'user', ?)", (context_id, content))
+                   for content in contents]
+
+        vec_store = vec_db.create_vec_store('messages', dimensions=DIMENSIONS)
+        self.assertEqual(embed_messages(vec_store, hash_embedding, context_id=context_id), 3)
+        self.assertEqual(embed_messages(vec_store, hash_embedding, context_id=context_id), 0)
+        embedding_ids = sql.get_results("SELECT embedding_id FROM contexts_messages WHERE context_id = ? ORDER BY id", (context_id,), return_type='list')
+        self.assertEqual(embedding_ids, msg_ids)
+        self.assertEqual(vec_store.search(hash_embedding(['capital of France'])[0], k=1)[0][0], msg_ids[2])
+
+    def test_invalid_db_name(self):
+        sql.execute("INSERT INTO vectordbs (name) VALUES ('../outside')")
+        manager = VectorDBManager(parent=None)
+        manager.load()
+        with self.assertRaises(ValueError):
+            manager.get_vec_db('../outside')
+
+
+if __name__ == '__main__':
+    unittest.main()
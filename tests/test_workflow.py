@@ -0,0 +1,202 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from src.utils import sql
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class DelayedProvider:
+    """Replies with the model name after `model_params.delay` seconds, like a remote model would, `{count}` is the number of messages"""
+    async def run_model(self, model_obj, messages=None, **kwargs):
+        reply = model_obj['model_name'].replace('{count}', str(len(messages or [])))
+
+        async def stream():
+            await asyncio.sleep(model_obj['model_params'].get('delay', 0))
+            for i, word in enumerate(reply.split(' ')):
+                yield SimpleNamespace(choices=[{'delta': {'content': word if i == 0 else ' ' + word}}])
+        return stream()
+
+    def get_model(self, model_obj):
+        return None
+
+    def get_model_context_window(self, model_obj):
+        return None
+
+
+def agent(member_id, loc_x, delay, loc_y=0, reply=None):
+    model = {'kind': 'CHAT', 'provider': 'delayed', 'model_name': reply or f'Reply {member_id}', 'model_params': {'delay': delay}}
+    return {'id': member_id, 'agent_id': None, 'loc_x': loc_x, 'loc_y': loc_y,
+            'config': {'_TYPE': 'agent', 'info.name': f'Agent {member_id}', 'chat.model': model}}
+
+
+def edge(source_id, target_id, **config):
+    return {'source_member_id': source_id, 'target_member_id': target_id, 'config': {'looper': False, **config}}
+
+
+class TestWorkflowBehaviour(unittest.TestCase):
+    def setUp(self):
+        from src.system.base import manager
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+        self.providers_patch = mock.patch.dict(manager.providers.providers, {'delayed': DelayedProvider()})
+        self.providers_patch.start()
+
+    def tearDown(self):
+        self.providers_patch.stop()
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def fan_out_config(self, max_concurrency=4):
+        # The slowest branch is first in the plan, so the other branches finish before it
+        return {
+            '_TYPE': 'workflow',
+            'config': {'max_concurrency': max_concurrency},
+            'members': [
+                {'id': '1', 'agent_id': None, 'loc_x': 20, 'loc_y': 0, 'config': {'_TYPE': 'user'}},
+                agent('2', 100, 0.3, loc_y=0), agent('3', 100, 0.1, loc_y=100), agent('4', 100, 0.2, loc_y=200),
+                agent('5', 300, 0.1),
+            ],
+            'inputs': [edge('1', '2'), edge('1', '3'), edge('1', '4'), edge('2', '5'), edge('3', '5'), edge('4', '5')],
+        }
+
+    def run_workflow(self, config):
+        from src.members.workflow import Workflow
+        workflow = Workflow(config=config, persist=False)
+        workflow.save_message('user', 'Hi', member_id='1')
+
+        async def receive():
+            return [chunk async for key, chunk in workflow.behaviour.receive()]
+
+        start = time.perf_counter()
+        chunks = asyncio.run(receive())
+        elapsed = time.perf_counter() - start
+        return workflow, chunks, elapsed
+
+    def test_fan_out_fan_in(self):
+        workflow, chunks, concurrent_time = self.run_workflow(self.fan_out_config())
+        messages = [(msg.member_id, msg.content) for msg in workflow.message_history.messages]
+        self.assertEqual(messages, [('1', 'Hi'), ('2', 'Reply 2'), ('3', 'Reply 3'), ('4', 'Reply 4'), ('5', 'Reply 5')])
+        self.assertEqual(''.join(chunks), 'Reply 5')
+
+        sequential_workflow, _, sequential_time = self.run_workflow(self.fan_out_config(max_concurrency=1))
+        sequential_messages = [(msg.member_id, msg.content) for msg in sequential_workflow.message_history.messages]
+        self.assertEqual(sequential_messages, messages)
+
+        print(f'\nFan-out/fan-in workflow: sequential {sequential_time:.2f}s, concurrent {concurrent_time:.2f}s (longest path 0.40s)')
+        self.assertGreaterEqual(sequential_time, 0.7)
+        self.assertLess(concurrent_time, 0.55)
+
+    def test_held_messages_returned(self):
+        from src.members.workflow import Workflow
+        workflow = Workflow(config=self.fan_out_config(), persist=True)
+        workflow.save_message('user', 'Hi', member_id='1')
+        saved_messages = []
+        original_save_message = workflow.save_message
+
+        def save_message(*args, **kwargs):
+            msg = original_save_message(*args, **kwargs)
+            saved_messages.append((msg, msg.id))
+            return msg
+
+        async def receive():
+            return [chunk async for key, chunk in workflow.behaviour.receive()]
+
+        with mock.patch.object(workflow, 'save_message', save_message):
+            asyncio.run(receive())
+        self.assertEqual([msg_id for msg, msg_id in saved_messages], [None] * 4)  # held while their member ran
+        self.assertCountEqual([msg for msg, _ in saved_messages], workflow.message_history.messages[1:])
+        self.assertNotEqual([msg.member_id for msg, _ in saved_messages], ['2', '3', '4', '5'])  # saved in finish order
+        msg_ids = [msg.id for msg in workflow.message_history.messages[1:]]  # given ids in plan order
+        self.assertEqual(msg_ids, sorted(msg_ids))
+        self.assertEqual(sql.get_results("SELECT id FROM contexts_messages WHERE context_id = ? AND member_id != '1' ORDER BY id",
+                                         (workflow.context_id,), return_type='list'), msg_ids)
+
+    def test_implicit_chain_runs_in_order(self):
+        config = {
+            '_TYPE': 'workflow',
+            'members': [
+                {'id': '1', 'agent_id': None, 'loc_x': 20, 'loc_y': 0, 'config': {'_TYPE': 'user'}},
+                agent('2', 100, 0.05), agent('3', 200, 0),
+            ],
+            'inputs': [],
+        }
+        workflow, chunks, _ = self.run_workflow(config)
+        self.assertEqual([msg.member_id for msg in workflow.message_history.messages], ['1', '2', '3'])
+        self.assertEqual(''.join(chunks), 'Reply 3')
+
+    def loop_config(self, **loop_config):
+        return {
+            '_TYPE': 'workflow',
+            'members': [
+                {'id': '1', 'agent_id': None, 'loc_x': 20, 'loc_y': 0, 'config': {'_TYPE': 'user'}},
+                agent('2', 100, 0, reply='Draft {count}'), agent('3', 200, 0, reply='Review {count}'),
+                agent('4', 300, 0, reply='Final {count}'),
+            ],
+            'inputs': [edge('1', '2'), edge('2', '3'), edge('3', '4'), edge('3', '2', looper=True, **loop_config)],
+        }
+
+    def test_loop(self):
+        workflow, chunks, _ = self.run_workflow(self.loop_config(max_iterations=3))
+        messages = [(msg.member_id, msg.content, msg.loop_iteration) for msg in workflow.message_history.messages]
+        self.assertEqual(messages, [
+            ('1', 'Hi', None),
+            ('2', 'Draft 1', 1), ('3', 'Review 2', 1),
+            ('2', 'Draft 3', 2), ('3', 'Review 4', 2),
+            ('2', 'Draft 5', 3), ('3', 'Review 6', 3),
+            ('4', 'Final 7', None),
+        ])
+        self.assertEqual(''.join(chunks), 'Final 7')
+
+    def test_loop_stop_condition(self):
+        workflow, _, _ = self.run_workflow(self.loop_config(max_iterations=10, stop_condition=r'Review [4-9]'))
+        contents = [msg.content for msg in workflow.message_history.messages]
+        self.assertEqual(contents, ['Hi', 'Draft 1', 'Review 2', 'Draft 3', 'Review 4', 'Final 5'])
+
+    def test_loop_invalid_stop_condition(self):
+        from src.members.workflow import Workflow
+        from src.utils.workflow_plan import LoopConfigError
+        workflow = Workflow(config=self.loop_config(stop_condition='('), persist=False)
+        workflow.save_message('user', 'Hi', member_id='1')
+        with self.assertRaises(LoopConfigError) as context:
+            asyncio.run(workflow.behaviour.receive().__anext__())
+        self.assertEqual((context.exception.source_id, context.exception.target_id), ('3', '2'))
+        self.assertEqual([msg.content for msg in workflow.message_history.messages], ['Hi'])  # nothing ran
+
+    def test_loop_final_member(self):
+        config = self.loop_config(max_iterations=2)
+        config['members'] = config['members'][:3]
+        config['inputs'] = [edge('1', '2'), edge('2', '3'), edge('3', '2', looper=True, max_iterations=2)]
+        workflow, chunks, _ = self.run_workflow(config)
+        self.assertEqual(len(workflow.message_history.messages), 5)
+        self.assertEqual(''.join(chunks), 'Review 4')
+
+    def test_benchmark_loop(self):
+        iterations = 100
+        from src.members.workflow import Workflow
+        workflow = Workflow(config=self.loop_config(max_iterations=iterations), persist=False)
+        member_objects = dict(workflow.members)
+        workflow.save_message('user', 'Hi', member_id='1')
+
+        start = time.perf_counter()
+        asyncio.run(workflow.behaviour.start())
+        elapsed = time.perf_counter() - start
+
+        messages = workflow.message_history.messages
+        self.assertEqual(len(messages), 2 + iterations * 2)
+        self.assertEqual(messages[-2].loop_iteration, iterations)
+        self.assertEqual(workflow.members, member_objects)
+        print(f'\n{iterations} loop iterations: {elapsed:.2f}s, {iterations / elapsed:.0f} iterations/s')
+
+
+if __name__ == '__main__':
+    unittest.main()
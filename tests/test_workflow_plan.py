@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from src.utils import sql
+from src.utils.workflow_plan import compile_workflow_plan, get_workflow_plan, WorkflowCycleError
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def member(member_id, loc_x, member_type='block'):
+    return {'id': member_id, 'agent_id': None, 'loc_x': loc_x, 'loc_y': 0,
+            'config': {'_TYPE': member_type, 'block_type': 'Text', 'data': f'Member {member_id}'}}
+
+
+def edge(source_id, target_id, looper=False):
+    return {'source_member_id': source_id, 'target_member_id': target_id, 'config': {'looper': looper}}
+
+
+class TestWorkflowPlan(unittest.TestCase):
+    def test_chat_order_follows_canvas(self):
+        members = [member('3', 300, 'agent'), member('1', 20, 'user'), member('2', 100, 'agent')]
+        plan = compile_workflow_plan(members, [])
+        self.assertEqual(plan.order, ['1', '2', '3'])
+        self.assertEqual(plan.levels, [['1'], ['2'], ['3']])
+        self.assertEqual(plan.dependencies, {'1': [], '2': ['1'], '3': ['2']})
+        self.assertEqual(plan.parallel_groups, [])
+
+    def test_fan_out_fan_in(self):
+        # Layout doesn't matter, the branches share a level because of their inputs
+        members = [member('1', 20, 'user'), member('2', 100), member('3', 400), member('4', 250), member('5', 500)]
+        inputs = [edge('1', '2'), edge('1', '3'), edge('1', '4'), edge('2', '5'), edge('3', '5'), edge('4', '5')]
+        plan = compile_workflow_plan(members, inputs)
+        self.assertEqual(plan.order, ['1', '2', '4', '3', '5'])
+        self.assertEqual(plan.levels, [['1'], ['2', '4', '3'], ['5']])
+        self.assertEqual(plan.parallel_groups, [['2', '4', '3']])
+        self.assertEqual(plan.inputs['5'], ['2', '3', '4'])
+
+    def test_inputs_placed_left_of_their_source(self):
+        members = [member('1', 20, 'user'), member('2', 50), member('3', 100)]
+        plan = compile_workflow_plan(members, [edge('3', '2')])
+        self.assertEqual(plan.order, ['1', '3', '2'])
+        self.assertEqual(plan.dependencies['3'], ['1'])
+
+    def test_member_without_inputs_waits_for_branches(self):
+        members = [member('1', 20, 'user'), member('2', 100), member('3', 100), member('4', 200)]
+        plan = compile_workflow_plan(members, [edge('1', '2'), edge('1', '3')])
+        self.assertEqual(sorted(plan.dependencies['4']), ['2', '3'])
+        self.assertEqual(plan.levels, [['1'], ['2', '3'], ['4']])
+
+    def test_cycle_error(self):
+        members = [member('1', 20, 'user'), member('2', 100), member('3', 200), member('4', 300)]
+        inputs = [edge('1', '2'), edge('2', '3'), edge('3', '4'), edge('4', '2')]
+        with self.assertRaises(WorkflowCycleError) as context:
+            compile_workflow_plan(members, inputs)
+        self.assertEqual(sorted(context.exception.member_ids[:-1]), ['2', '3', '4'])
+        self.assertEqual(context.exception.member_ids[0], context.exception.member_ids[-1])
+
+        # Looper inputs aren't part of the order
+        plan = compile_workflow_plan(members, inputs[:-1] + [edge('4', '2', looper=True)])
+        self.assertEqual(plan.order, ['1', '2', '3', '4'])
+        self.assertEqual(plan.looper_inputs['2'], ['4'])
+
+    def test_missing_member(self):
+        with self.assertRaises(ValueError):
+            compile_workflow_plan([member('1', 20)], [edge('9', '1')])
+
+    def test_cache(self):
+        members = [member('1', 20, 'user'), member('2', 100)]
+        plan = get_workflow_plan(members, [edge('1', '2')])
+        edited_members = [member('1', 20, 'user'), {**member('2', 100), 'config': {'_TYPE': 'block', 'data': 'Edited'}}]
+        self.assertIs(get_workflow_plan(edited_members, [edge('1', '2')]), plan)
+        self.assertIsNot(get_workflow_plan(members, []), plan)
+
+    def test_benchmark_compile(self):
+        member_count = 500
+        members = [member('1', 0, 'user')] + [member(str(i), i * 10) for i in range(2, member_count + 1)]
+        inputs = [edge(str(i // 2), str(i)) for i in range(2, member_count + 1)]
+        start = time.perf_counter()
+        plan = compile_workflow_plan(members, inputs)
+        compile_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        get_workflow_plan(members, inputs)
+        get_workflow_plan(members, inputs)
+        cached_time = (time.perf_counter() - start) / 2
+
+        print(f'\nPlan for {member_count} members: compile {compile_time * 1000:.2f}ms, cached {cached_time * 1000:.2f}ms')
+        self.assertEqual(len(plan.order), member_count)
+        self.assertLess(compile_time, 0.05)
+
+
+class TestWorkflowLoad(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.temp_dir.name, 'data.db')
+        shutil.copyfile(os.path.join(PACKAGE_DIR, 'data.db'), db_path)
+        sql.set_db_filepath(db_path)
+
+    def tearDown(self):
+        sql.close_connections()
+        sql.set_db_filepath(None)
+        self.temp_dir.cleanup()
+
+    def test_load_members(self):
+        from src.members.workflow import Workflow
+        config = {
+            '_TYPE': 'workflow',
+            'members': [member('1', 20, 'user'), member('4', 90), member('2', 300), member('3', 300)],
+            'inputs': [edge('1', '2'), edge('1', '3'), edge('2', '4'), edge('3', '4')],
+        }
+        workflow = Workflow(config=config, persist=False)
+        self.assertEqual(list(workflow.members), ['1', '2', '3', '4'])
+        self.assertEqual(workflow.boxes, [{'2', '3'}])
+        self.assertEqual(workflow.members['4'].inputs, ['2', '3'])
+
+
+if __name__ == '__main__':
+    unittest.main()